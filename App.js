@@ -18,6 +18,9 @@ import {
 
 initializeApp(firebaseConfig);
 
+// Milliseconds to wait before polling again after a failed request
+const RETRY_DELAY = 10000;
+
 // Main App component
 const App = () => {
   // State variables declaration using hooks
@@ -63,52 +66,77 @@ const App = () => {
     };
   }, []);
 
-  // Function to fetch parking spots data
-  const fetchSpots = async () => {
-    let spots = 0;
-    let handicapSpots = 0;
-
-    // Fetching regular parking spots data
-    await fetch(`${process.env.REACT_PARKINGSPOTS_URL}`)
-      .then((response) => response.text())
-      .then((text) => {
-        return JSON.parse(text);
-      })
-      .then((data) => {
-        console.log('Data fetched successfully', data);
-        spots = data.free_spots;
-      })
-      .catch((error) => {
-        console.error('Error fetching data', error);
-      });
-
-    // Fetching handicap parking spots data
-    await fetch(`${process.env.REACT_HANDICAP_PARKINGSPOTS_URL}`)
-      .then((response) => response.text())
-      .then((text) => {
-        return JSON.parse(text);
-      })
-      .then((data) => {
-        console.log('Data fetched successfully', data);
-        handicapSpots = data.free_handicap_spots;
-      })
-      .catch((error) => {
-        console.error('Error fetching data', error);
-      });
-
-    // Updating state variables
-    setSpots(spots);
-    setHandicapSpots(handicapSpots);
+  // Function to show the free spots of a lot status
+  const showStatus = async (status) => {
+    setSpots(status.free_spots);
+    setHandicapSpots(status.free_handicap_spots);
 
     // Scheduling push notification if user is inside geofence
     if (isInside) {
-      await schedulePushNotification(spots, handicapSpots);
+      await schedulePushNotification(
+        status.free_spots,
+        status.free_handicap_spots,
+      );
+    }
+  };
+
+  // Function to long-poll the lot status: the server answers as soon as the
+  // status differs from the cursor, or with 204 when nothing changed in time.
+  // Returns the cursor of the status shown.
+  const pollStatus = async (cursor, options = {}) => {
+    const query = new URLSearchParams();
+    if (cursor !== null) {
+      query.append('cursor', cursor);
+    }
+    if (options.timeout !== undefined) {
+      query.append('timeout', options.timeout);
     }
+    const response = await fetch(
+      `${process.env.REACT_STATUS_POLL_URL}?${query}`,
+      {signal: options.signal},
+    );
+    if (response.status === 204) {
+      return cursor;
+    }
+    if (!response.ok) {
+      throw new Error(`Status poll failed with ${response.status}`);
+    }
+    const data = await response.json();
+    console.log('Data fetched successfully', data);
+    await showStatus(data.status);
+    return data.cursor;
   };
 
-  // Effect hook to fetch parking spots data periodically and register background fetch task
+  // Function to fetch parking spots data once, without waiting for a change
+  const fetchSpots = async () => {
+    try {
+      await pollStatus(null, {timeout: 0});
+    } catch (error) {
+      console.error('Error fetching data', error);
+    }
+  };
+
+  // Effect hook to follow parking spots data and register background fetch task
   useEffect(() => {
-    fetchSpots();
+    const controller = new AbortController();
+
+    // Waiting for each change in turn instead of fetching on a timer
+    const followSpots = async () => {
+      let cursor = null;
+      while (!controller.signal.aborted) {
+        try {
+          cursor = await pollStatus(cursor, {signal: controller.signal});
+        } catch (error) {
+          if (controller.signal.aborted) {
+            return;
+          }
+          console.error('Error fetching data', error);
+          // Backing off so an unreachable server is not retried in a loop
+          await new Promise((resolve) => setTimeout(resolve, RETRY_DELAY));
+        }
+      }
+    };
+    followSpots();
 
     // Registering background fetch task
     BackgroundFetch.registerTaskAsync(BACKGROUND_FETCH_TASK, {
@@ -116,11 +144,8 @@ const App = () => {
     });
     console.log('Background fetch task registered');
 
-    // Setting up periodic fetching of parking spots data
-    const intervalId = setInterval(fetchSpots, 10000);
-
-    // Cleanup function to clear interval
-    return () => clearInterval(intervalId);
+    // Cleanup function to stop following the status
+    return () => controller.abort();
   }, []);
 
   // Effect hook to start location tracking and fetch spots on location change
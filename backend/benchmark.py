@@ -0,0 +1,264 @@
+"""
+This module contains benchmarks for the detection pipeline.
+Run it from the project root, for example:
+    python backend/benchmark.py suppression
+    python backend/benchmark.py backends --variant n --export
+    python backend/benchmark.py resolution --policies legacy 160,320,640 640
+"""
+import argparse
+import glob
+import os
+import time
+import cv2
+import numpy as np
+from streamyolo import (
+    LAYOUT_PATH,
+    MODEL_VARIANT,
+    ROI_MAX_UPSCALE,
+    RUNTIME_ARTIFACTS,
+    TILE_SIZE,
+    boxes_overlap,
+    compile_spots,
+    get_regions_of_interest,
+    load_model,
+    model_artifact,
+    read_points,
+    roi_input_size,
+    result_arrays,
+    run_batched_inference,
+    suppress_duplicates,
+)
+
+SOURCE_IMAGES = "./backend/source/*.jpg"
+EXPORT_FORMATS = {'openvino': 'openvino', 'onnx': 'onnx', 'torchscript': 'torchscript'}
+
+
+def random_boxes(count, frame_shape=(1080, 1920), seed=0):
+    """
+    Generate car sized boxes scattered over a frame, with some near duplicates.
+    """
+    rng = np.random.default_rng(seed)
+    height, width = frame_shape
+    corners = rng.uniform(0, [width - 200, height - 120], (count, 2))
+    sizes = rng.uniform([80, 50], [200, 120], (count, 2))
+    boxes = np.concatenate([corners, corners + sizes], axis=1)
+    duplicates = rng.random(count) < 0.3
+    boxes[duplicates] = boxes[rng.integers(0, count, duplicates.sum())] + rng.normal(0, 3, (duplicates.sum(), 4))
+    return boxes
+
+
+def loop_suppression(boxes):
+    """
+    The original pairwise suppression loop, kept as the baseline.
+    """
+    detected_boxes = []
+    for box in boxes:
+        if not any(boxes_overlap(box, other_box) for other_box in detected_boxes):
+            detected_boxes.append(box)
+    return detected_boxes
+
+
+def best_time(function, repeat):
+    """
+    Return the fastest of several runs of a function, in milliseconds.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start) * 1000)
+    return min(timings)
+
+
+def benchmark_suppression(args):
+    """
+    Compare the pairwise loop with the vectorized duplicate suppression.
+    """
+    print(f"{'boxes':>8} {'kept':>8} {'loop ms':>12} {'vectorized ms':>15} {'speedup':>9}")
+    for count in args.counts:
+        boxes = random_boxes(count)
+        kept = suppress_duplicates(boxes)
+        if len(loop_suppression(boxes)) != int(kept.sum()):
+            raise AssertionError("Vectorized suppression disagrees with the loop")
+        loop_ms = best_time(lambda: loop_suppression(boxes), args.repeat)
+        vectorized_ms = best_time(lambda: suppress_duplicates(boxes), args.repeat)
+        print(f"{count:>8} {int(kept.sum()):>8} {loop_ms:>12.2f} {vectorized_ms:>15.2f} "
+              f"{loop_ms / vectorized_ms:>8.1f}x")
+
+
+def export_models(variant, runtimes):
+    """
+    Export the PyTorch weights of a variant to every requested runtime that is missing.
+    """
+    for runtime in runtimes:
+        if runtime == 'pytorch' or os.path.exists(model_artifact(variant, runtime)):
+            continue
+        print(f"Exporting yolov8{variant} to {runtime}")
+        exported = load_model(model_artifact(variant, 'pytorch')).export(
+            format=EXPORT_FORMATS[runtime], imgsz=TILE_SIZE, dynamic=True)
+        target = model_artifact(variant, runtime)
+        if os.path.abspath(exported) != os.path.abspath(target):
+            os.replace(exported, target)
+
+
+def benchmark_backends(args):
+    """
+    Compare the latency of every model runtime on the bundled images and
+    check that they detect the same objects as the PyTorch weights.
+    """
+    images = [cv2.imread(path) for path in sorted(glob.glob(args.images))]
+    if not images:
+        raise FileNotFoundError(f"No images found at {args.images}")
+    if args.export:
+        export_models(args.variant, args.runtimes)
+
+    reference = None
+    print(f"{'runtime':>12} {'load s':>8} {'mean ms':>9} {'p50 ms':>8} {'max ms':>8} "
+          f"{'boxes':>6} {'matches':>8}")
+    for runtime in args.runtimes:
+        path = model_artifact(args.variant, runtime)
+        if runtime != 'pytorch' and not os.path.exists(path):
+            print(f"{runtime:>12} missing {path}, run with --export")
+            continue
+        start = time.perf_counter()
+        model = load_model(path)
+        load_seconds = time.perf_counter() - start
+        model(images[0], verbose=False)  # Warm up
+
+        timings, detections = [], []
+        for image in images:
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                result = model(image, imgsz=TILE_SIZE, verbose=False)[0]
+                timings.append((time.perf_counter() - start) * 1000)
+            detections.append(result_arrays(result))
+
+        classes = [tuple(sorted(cls.astype(int))) for _, cls, _ in detections]
+        if reference is None:
+            reference = classes
+        matches = sum(ours == theirs for ours, theirs in zip(classes, reference))
+        print(f"{runtime:>12} {load_seconds:>8.2f} {np.mean(timings):>9.1f} "
+              f"{np.median(timings):>8.1f} {np.max(timings):>8.1f} "
+              f"{sum(len(cls) for cls in classes):>6} {matches:>4}/{len(images)}")
+
+
+def spots_inside(points_np, frame_shape):
+    """
+    Keep the spots whose bounding rectangle lies within the frame, so a layout
+    annotated on a larger image can be run on every sample image.
+    """
+    frame_height, frame_width = frame_shape[:2]
+    inside = []
+    for points in points_np:
+        x, y, w, h = cv2.boundingRect(points)
+        if x >= 0 and y >= 0 and x + w <= frame_width and y + h <= frame_height:
+            inside.append(points)
+    return inside
+
+
+def legacy_spots(points_np, frame_shape):
+    """
+    Compile spots with the original upscale of twice the frame to spot size ratio,
+    kept as the baseline.
+    """
+    frame_height, frame_width = frame_shape[:2]
+    return [
+        spot._replace(scale=max(2*max(frame_height // spot.rect[3], frame_width // spot.rect[2]), 1),
+                      interpolation=cv2.INTER_LINEAR)
+        for spot in compile_spots(points_np, frame_shape)
+    ]
+
+
+def policy_spots(policy, points_np, frame_shape):
+    """
+    Compile spots for a resolution policy, either "legacy" or a comma separated list of input sizes.
+    Returns the spots and the input sizes to batch them by.
+    """
+    if policy == 'legacy':
+        return legacy_spots(points_np, frame_shape), (TILE_SIZE,)
+    sizes = tuple(sorted(int(size) for size in policy.split(',')))
+    return compile_spots(points_np, frame_shape, sizes, ROI_MAX_UPSCALE), sizes
+
+
+def benchmark_resolution(args):
+    """
+    Compare the latency and per spot occupancy of spot crop resolution policies
+    on the bundled images. The first policy is the reference the others are compared to.
+    """
+    paths = sorted(glob.glob(args.images))
+    if not paths:
+        raise FileNotFoundError(f"No images found at {args.images}")
+    normal_points, handicap_points = read_points(args.layout)
+    points_np = list(normal_points) + list(handicap_points)
+    model = load_model(model_artifact(args.variant))
+    frames = [cv2.imread(path) for path in paths]
+    model(frames[0], verbose=False)  # Warm up
+
+    reference = None
+    print(f"{'policy':>14} {'sizes':>14} {'mean ms':>9} {'max ms':>8} {'pixels':>9} "
+          f"{'boxes':>6} {'occupied':>9} {'agreement':>10}")
+    for policy in args.policies:
+        timings, occupancy, pixels, boxes = [], [], 0, 0
+        size_counts = {}
+        for frame in frames:
+            spots, sizes = policy_spots(policy, spots_inside(points_np, frame.shape), frame.shape)
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                regions, scales_and_offsets = get_regions_of_interest(frame, spots)
+                detections = run_batched_inference(model, regions, scales_and_offsets, sizes=sizes)
+                timings.append((time.perf_counter() - start) * 1000)
+            region_ids = detections[3]
+            occupancy.append(np.isin(np.arange(len(spots)), region_ids))
+            boxes += len(region_ids)
+            pixels += sum(region.shape[0] * region.shape[1] for region in regions)
+            for region in regions:
+                size = roi_input_size(max(region.shape[:2]), sizes)
+                size_counts[size] = size_counts.get(size, 0) + 1
+
+        occupancy = np.concatenate(occupancy)
+        if reference is None:
+            reference = occupancy
+        agreement = np.mean(occupancy == reference) if len(occupancy) else 1.0
+        buckets = '/'.join(f"{size_counts[size]}x{size}" for size in sorted(size_counts))
+        print(f"{policy:>14} {buckets:>14} {np.mean(timings):>9.1f} {np.max(timings):>8.1f} "
+              f"{pixels / len(frames) / 1e6:>8.2f}M {boxes:>6} {int(occupancy.sum()):>9} "
+              f"{agreement:>9.1%}")
+
+
+def main():
+    """
+    Parse the command line and run the selected benchmark.
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    suppression = subparsers.add_parser('suppression', help='duplicate box suppression')
+    suppression.add_argument('--counts', type=int, nargs='+', default=[50, 500, 5000])
+    suppression.add_argument('--repeat', type=int, default=3)
+    suppression.set_defaults(run=benchmark_suppression)
+
+    backends = subparsers.add_parser('backends', help='model runtime latency')
+    backends.add_argument('--variant', default='l', choices=['n', 's', 'm', 'l', 'x'])
+    backends.add_argument('--runtimes', nargs='+', default=list(reversed(RUNTIME_ARTIFACTS)),
+                          choices=list(RUNTIME_ARTIFACTS))
+    backends.add_argument('--images', default=SOURCE_IMAGES)
+    backends.add_argument('--repeat', type=int, default=3)
+    backends.add_argument('--export', action='store_true',
+                          help='export missing runtimes from the PyTorch weights first')
+    backends.set_defaults(run=benchmark_backends)
+
+    resolution = subparsers.add_parser('resolution', help='spot crop resolution policies')
+    resolution.add_argument('--policies', nargs='+', default=['legacy', '160,320,640', '320,640', '640'],
+                            help='"legacy" or comma separated model input sizes')
+    resolution.add_argument('--variant', default=MODEL_VARIANT, choices=['n', 's', 'm', 'l', 'x'])
+    resolution.add_argument('--layout', default=LAYOUT_PATH)
+    resolution.add_argument('--images', default=SOURCE_IMAGES)
+    resolution.add_argument('--repeat', type=int, default=3)
+    resolution.set_defaults(run=benchmark_resolution)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,28 +2,104 @@
 and fetches all the rows from a table."""
 
 import os
+import time
 import logging
+import threading
+from collections import namedtuple
 import mysql.connector
+from mysql.connector import pooling
 from dotenv import load_dotenv
+try:
+    from metrics import Counter, Histogram
+except ImportError:
+    from backend.metrics import Counter, Histogram
 
 load_dotenv()
 
 logging.basicConfig(level=logging.INFO)
 
+DB_POOL_NAME = 'parking'
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+# Seconds to wait for a free pooled connection before giving up
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '5'))
+# Connections idle for longer than DB_PING_INTERVAL seconds are pinged on checkout and
+# reconnected up to DB_RECONNECT_ATTEMPTS times if the server has dropped them
+DB_PING_INTERVAL = float(os.getenv('DB_PING_INTERVAL', '30'))
+DB_RECONNECT_ATTEMPTS = int(os.getenv('DB_RECONNECT_ATTEMPTS', '3'))
+# The pure Python driver does its I/O through the socket module, so under gevent a
+# query waiting on the server yields to other requests instead of blocking them all.
+# Unset leaves the choice to mysql.connector, which falls back to the pure driver
+# where the C extension is not installed.
+DB_USE_PURE = os.getenv('DB_USE_PURE')
+
+POOL = None
+POOL_LOCK = threading.Lock()
+# Last checkout time of every pooled connection, keyed by the id of the raw connection
+LAST_CHECKOUT = {}
+
+# Time of every database call, waiting for a pooled connection included
+DB_QUERY_SECONDS = Histogram('parkspotter_db_query_seconds', 'Time of database calls.', ['operation'])
+DB_ERRORS = Counter('parkspotter_db_errors_total', 'Database calls that failed.', ['operation'])
+
+LOT_ID = 1
+# All counters of the lot as read in one query. cycle_id is bumped by every write of
+# the free counts and updated_at is the time of that write.
+LotSnapshot = namedtuple('LotSnapshot', [
+    'free_spots', 'free_handicap_spots', 'total_spots', 'total_handicap_spots',
+    'image', 'cycle_id', 'updated_at',
+])
+
+def get_pool():
+    """Creates the connection pool on first use and returns it."""
+    global POOL
+    with POOL_LOCK:
+        if POOL is None:
+            options = {}
+            if DB_USE_PURE is not None:
+                options['use_pure'] = DB_USE_PURE.lower() == 'true'
+            POOL = pooling.MySQLConnectionPool(
+                pool_name=DB_POOL_NAME,
+                pool_size=DB_POOL_SIZE,
+                pool_reset_session=False,
+                host=os.getenv('DB_HOST'),
+                user=os.getenv('DB_USER'),
+                password=os.getenv('DB_PASS'),
+                database=os.getenv('DB_NAME'),
+                **options
+            )
+        return POOL
+
 def connect_to_db():
-    """Connects to the database and returns the connection object."""
+    """Checks a connection out of the pool and returns it.
+    Closing the connection returns it to the pool."""
+    deadline = time.monotonic() + DB_POOL_TIMEOUT
     try:
-        cnx = mysql.connector.connect(
-            host=os.getenv('DB_HOST'),
-            user=os.getenv('DB_USER'),
-            password=os.getenv('DB_PASS'),
-            database=os.getenv('DB_NAME')
-        )
+        pool = get_pool()
+        while True:
+            try:
+                cnx = pool.get_connection()
+                break
+            except pooling.PoolError:
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(0.05)
+        key = id(getattr(cnx, '_cnx', cnx))
+        now = time.monotonic()
+        if now - LAST_CHECKOUT.get(key, float('-inf')) > DB_PING_INTERVAL:
+            try:
+                cnx.ping(reconnect=True, attempts=DB_RECONNECT_ATTEMPTS, delay=1)
+            except mysql.connector.Error:
+                LAST_CHECKOUT.pop(key, None)
+                cnx.close()
+                raise
+        LAST_CHECKOUT[key] = now
         return cnx
     except mysql.connector.Error as err:
+        DB_ERRORS.inc(operation='connect')
         logging.error('Error connecting to the database %s', err)
         return None
 
+@DB_QUERY_SECONDS.time(operation='fetch_token')
 def fetch_token():
     """Fetches token from the database."""
     cnx = connect_to_db()
@@ -38,6 +114,7 @@ def fetch_token():
         if result is not None:
             return result[0]
     except mysql.connector.Error as err:
+        DB_ERRORS.inc(operation='fetch_token')
         print(f"Something went wrong: {err}")
     finally:
         cnx.close()
@@ -45,6 +122,7 @@ def fetch_token():
     print("No available tokens found")
     return 0
 
+@DB_QUERY_SECONDS.time(operation='save_token')
 def save_token(token):
     """save token to the database."""
     cnx = connect_to_db()
@@ -57,6 +135,7 @@ def save_token(token):
         cursor.execute(query, (1, token, token))
         cnx.commit()
     except mysql.connector.Error as err:
+        DB_ERRORS.inc(operation='save_token')
         print(f"Something went wrong: {err}")
         print("No available tokens found")
     finally:
@@ -65,6 +144,7 @@ def save_token(token):
     print("Token saved successfully")
     return 0
 
+@DB_QUERY_SECONDS.time(operation='fetch_available_free_spots')
 def fetch_available_free_spots():
     """Fetches the available parking spots from the database."""
     cnx = connect_to_db()
@@ -79,6 +159,7 @@ def fetch_available_free_spots():
         if result is not None:
             return result[0]
     except mysql.connector.Error as err:
+        DB_ERRORS.inc(operation='fetch_available_free_spots')
         print(f"Something went wrong: {err}")
         return {"error": str(err)}
     finally:
@@ -87,6 +168,7 @@ def fetch_available_free_spots():
     print("No available spots found")
     return 0
 
+@DB_QUERY_SECONDS.time(operation='save_available_free_spots')
 def save_available_free_spots(free_spots):
     """Stores the number of free parking spots in the database."""
     cnx = connect_to_db()
@@ -99,10 +181,12 @@ def save_available_free_spots(free_spots):
         cursor.execute(query, (free_spots, 1))
         cnx.commit()
     except mysql.connector.Error as err:
+        DB_ERRORS.inc(operation='save_available_free_spots')
         print(f"Something went wrong: {err}")
     finally:
         cnx.close()
 
+@DB_QUERY_SECONDS.time(operation='fetch_available_handicap_spots')
 def fetch_available_handicap_spots():
     """Fetches the available handicap parking spots from the database."""
     cnx = connect_to_db()
@@ -117,6 +201,7 @@ def fetch_available_handicap_spots():
         if result is not None:
             return result[0]
     except mysql.connector.Error as err:
+        DB_ERRORS.inc(operation='fetch_available_handicap_spots')
         print(f"Something went wrong: {err}")
     finally:
         cnx.close()
@@ -124,6 +209,7 @@ def fetch_available_handicap_spots():
     print("No available handicap spots found")
     return 0
 
+@DB_QUERY_SECONDS.time(operation='save_available_handicap_spots')
 def save_available_handicap_spots(free_handicap_spots):
     """Stores the number of free handicap parking spots in the database."""
     cnx = connect_to_db()
@@ -136,11 +222,13 @@ def save_available_handicap_spots(free_handicap_spots):
         cursor.execute(query, (free_handicap_spots, 1))
         cnx.commit()
     except mysql.connector.Error as err:
+        DB_ERRORS.inc(operation='save_available_handicap_spots')
         print(f"Something went wrong: {err}")
     finally:
         cnx.close()
 
 
+@DB_QUERY_SECONDS.time(operation='fetch_total_handicap_spots')
 def fetch_total_handicap_spots():
     """Fetches the total handicap parking spots from the database."""
     cnx = connect_to_db()
@@ -155,6 +243,7 @@ def fetch_total_handicap_spots():
         if result is not None:
             return result[0]
     except mysql.connector.Error as err:
+        DB_ERRORS.inc(operation='fetch_total_handicap_spots')
         print(f"Something went wrong: {err}")
     finally:
         cnx.close()
@@ -162,6 +251,7 @@ def fetch_total_handicap_spots():
     print("No total handicap spots found")
     return 0
 
+@DB_QUERY_SECONDS.time(operation='save_total_handicap_spots')
 def save_total_handicap_spots(total_handicap_spots):
     """Saves the total handicap parking spots to the database."""
     if not isinstance(total_handicap_spots, int):
@@ -179,11 +269,13 @@ def save_total_handicap_spots(total_handicap_spots):
         cnx.commit()
         print(f"Updated total handicap spots to {total_handicap_spots}")
     except mysql.connector.Error as err:
+        DB_ERRORS.inc(operation='save_total_handicap_spots')
         print(f"Something went wrong: {err}")
     finally:
         cnx.close()
 
 
+@DB_QUERY_SECONDS.time(operation='fetch_total_spots')
 def fetch_total_spots():
     """Fetches the total parking spots from the database."""
     cnx = connect_to_db()
@@ -198,6 +290,7 @@ def fetch_total_spots():
         if result is not None:
             return result[0]
     except mysql.connector.Error as err:
+        DB_ERRORS.inc(operation='fetch_total_spots')
         print(f"Something went wrong: {err}")
     finally:
         cnx.close()
@@ -205,6 +298,7 @@ def fetch_total_spots():
     print("No total spots found")
     return 0
 
+@DB_QUERY_SECONDS.time(operation='save_total_spots')
 def save_total_spots(total_spots):
     """Saves the total parking spots to the database."""
     if not isinstance(total_spots, int):
@@ -222,10 +316,12 @@ def save_total_spots(total_spots):
         cnx.commit()
         print(f"Updated total spots to {total_spots}")
     except mysql.connector.Error as err:
+        DB_ERRORS.inc(operation='save_total_spots')
         print(f"Something went wrong: {err}")
     finally:
         cnx.close()
 
+@DB_QUERY_SECONDS.time(operation='fetch_image')
 def fetch_image():
     """Fetches the image path from the database."""
     cnx = connect_to_db()
@@ -240,6 +336,7 @@ def fetch_image():
         if result is not None:
             return result[0]
     except mysql.connector.Error as err:
+        DB_ERRORS.inc(operation='fetch_image')
         print(f"Something went wrong: {err}")
     finally:
         cnx.close()
@@ -247,6 +344,7 @@ def fetch_image():
     print("No image path found")
     return 0
 
+@DB_QUERY_SECONDS.time(operation='save_image')
 def save_image(image_path):
     """Saves the image path to the database."""
     cnx = connect_to_db()
@@ -259,6 +357,118 @@ def save_image(image_path):
         cursor.execute(query, (image_path, 1))
         cnx.commit()
     except mysql.connector.Error as err:
+        DB_ERRORS.inc(operation='save_image')
+        print(f"Something went wrong: {err}")
+    finally:
+        cnx.close()
+
+@DB_QUERY_SECONDS.time(operation='fetch_lot_snapshot')
+def fetch_lot_snapshot():
+    """Fetches all counters of the lot in one query and returns them as a LotSnapshot."""
+    cnx = connect_to_db()
+    if cnx is None:
+        return None
+
+    try:
+        cursor = cnx.cursor()
+        query = ("SELECT PARKSPOTS, HANDICAPSPOTS, TOTALSPOTS, TOTALHANDICAPSPOTS, IMAGE, "
+                 "CYCLE_ID, UPDATED_AT FROM AVAILABLE_SPOTS WHERE ID = %s")
+        cursor.execute(query, (LOT_ID,))
+        result = cursor.fetchone()
+        if result is not None:
+            return LotSnapshot(*result)
+    except mysql.connector.Error as err:
+        DB_ERRORS.inc(operation='fetch_lot_snapshot')
+        print(f"Something went wrong: {err}")
+        return None
+    finally:
+        cnx.close()
+
+    print("No parking lot found")
+    return None
+
+@DB_QUERY_SECONDS.time(operation='save_free_counts')
+def save_free_counts(free_spots, free_handicap_spots):
+    """Stores both free counts of one detection cycle in a single transaction.
+    Returns the new cycle id, or None if nothing was written."""
+    cnx = connect_to_db()
+    if cnx is None:
+        return None
+
+    try:
+        cursor = cnx.cursor()
+        # LAST_INSERT_ID(expr) hands the new cycle id back without another query
+        query = ("UPDATE AVAILABLE_SPOTS SET PARKSPOTS = %s, HANDICAPSPOTS = %s, "
+                 "CYCLE_ID = LAST_INSERT_ID(CYCLE_ID + 1), UPDATED_AT = CURRENT_TIMESTAMP(3) "
+                 "WHERE ID = %s")
+        cursor.execute(query, (free_spots, free_handicap_spots, LOT_ID))
+        cnx.commit()
+        return cursor.lastrowid
+    except mysql.connector.Error as err:
+        cnx.rollback()
+        DB_ERRORS.inc(operation='save_free_counts')
+        print(f"Something went wrong: {err}")
+        return None
+    finally:
+        cnx.close()
+
+@DB_QUERY_SECONDS.time(operation='save_occupancy_history')
+def save_occupancy_history(rows):
+    """Appends rows of (RECORDED_AT, CYCLE_ID, PARKSPOTS, HANDICAPSPOTS, TOTALSPOTS,
+    TOTALHANDICAPSPOTS) to the occupancy history in one transaction.
+    Returns True if they were written."""
+    return save_rows(
+        "INSERT INTO OCCUPANCY_HISTORY (RECORDED_AT, CYCLE_ID, PARKSPOTS, HANDICAPSPOTS, "
+        "TOTALSPOTS, TOTALHANDICAPSPOTS) VALUES (%s, %s, %s, %s, %s, %s)", rows,
+        'save_occupancy_history')
+
+@DB_QUERY_SECONDS.time(operation='save_spot_events')
+def save_spot_events(rows):
+    """Appends rows of (RECORDED_AT, CAMERA, SPOT_ID, HANDICAP, OCCUPIED) to the
+    per-spot events in one transaction. Returns True if they were written."""
+    return save_rows(
+        "INSERT INTO SPOT_EVENTS (RECORDED_AT, CAMERA, SPOT_ID, HANDICAP, OCCUPIED) "
+        "VALUES (%s, %s, %s, %s, %s)", rows, 'save_spot_events')
+
+def save_rows(query, rows, operation='save_rows'):
+    """Inserts many rows with one executemany and commits them together.
+    Failures are counted under operation."""
+    if not rows:
+        return True
+    cnx = connect_to_db()
+    if cnx is None:
+        return False
+
+    try:
+        cursor = cnx.cursor()
+        cursor.executemany(query, rows)
+        cnx.commit()
+        return True
+    except mysql.connector.Error as err:
+        cnx.rollback()
+        DB_ERRORS.inc(operation=operation)
+        print(f"Something went wrong: {err}")
+        return False
+    finally:
+        cnx.close()
+
+@DB_QUERY_SECONDS.time(operation='fetch_occupancy_history')
+def fetch_occupancy_history(start, end):
+    """Fetches the occupancy history rows recorded between two UTC datetimes, oldest first."""
+    cnx = connect_to_db()
+    if cnx is None:
+        return []
+
+    try:
+        cursor = cnx.cursor()
+        query = ("SELECT RECORDED_AT, CYCLE_ID, PARKSPOTS, HANDICAPSPOTS, TOTALSPOTS, "
+                 "TOTALHANDICAPSPOTS FROM OCCUPANCY_HISTORY "
+                 "WHERE RECORDED_AT >= %s AND RECORDED_AT < %s ORDER BY RECORDED_AT")
+        cursor.execute(query, (start, end))
+        return cursor.fetchall()
+    except mysql.connector.Error as err:
+        DB_ERRORS.inc(operation='fetch_occupancy_history')
         print(f"Something went wrong: {err}")
+        return []
     finally:
         cnx.close()
@@ -10,8 +10,14 @@ CREATE TABLE AVAILABLE_SPOTS (
         HANDICAPSPOTS INT,
         TOTALHANDICAPSPOTS INT,
         TOTALSPOTS INT,
-        IMAGE VARCHAR(255)
+        IMAGE VARCHAR(255),
+        CYCLE_ID BIGINT NOT NULL DEFAULT 0,
+        UPDATED_AT TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3)
 );
+-- Upgrading an existing database:
+-- ALTER TABLE AVAILABLE_SPOTS
+--         ADD COLUMN CYCLE_ID BIGINT NOT NULL DEFAULT 0,
+--         ADD COLUMN UPDATED_AT TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3);
 INSERT INTO AVAILABLE_SPOTS (PARKSPOTS, HANDICAPSPOTS, TOTALHANDICAPSPOTS, TOTALSPOTS, IMAGE) VALUES (0, 0, 0, 0, '');
 
 -- Create the table for the push notifications register token
@@ -20,3 +26,27 @@ CREATE TABLE DEVICE_TOKEN (
     TOKEN VARCHAR(255) NOT NULL
 );
 INSERT INTO DEVICE_TOKEN (TOKEN) VALUES ('');
+
+-- Append-only history of the lot's counts, one row per change, times in UTC
+CREATE TABLE OCCUPANCY_HISTORY (
+    ID BIGINT PRIMARY KEY AUTO_INCREMENT,
+    RECORDED_AT DATETIME(3) NOT NULL,
+    CYCLE_ID BIGINT NOT NULL,
+    PARKSPOTS INT NOT NULL,
+    HANDICAPSPOTS INT NOT NULL,
+    TOTALSPOTS INT,
+    TOTALHANDICAPSPOTS INT,
+    INDEX IDX_OCCUPANCY_HISTORY_TIME (RECORDED_AT)
+);
+
+-- Append-only log of every spot turning occupied or free, times in UTC
+CREATE TABLE SPOT_EVENTS (
+    ID BIGINT PRIMARY KEY AUTO_INCREMENT,
+    RECORDED_AT DATETIME(3) NOT NULL,
+    CAMERA VARCHAR(64) NOT NULL,
+    SPOT_ID INT NOT NULL,
+    HANDICAP BOOLEAN NOT NULL,
+    OCCUPIED BOOLEAN NOT NULL,
+    INDEX IDX_SPOT_EVENTS_TIME (RECORDED_AT),
+    INDEX IDX_SPOT_EVENTS_SPOT (CAMERA, SPOT_ID, RECORDED_AT)
+);
@@ -1,15 +1,26 @@
 """
 Flask server module
 """
+import hashlib
+import hmac
+import json
 import logging
+import math
 import os
-from flask import Flask, jsonify, request, render_template
+import tempfile
+import threading
+import time
+import cv2
+from flask import Flask, Request, Response, g, jsonify, request, render_template, send_from_directory, url_for
 from flask_cors import CORS
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.utils import secure_filename
 
 try:
     from database import (
         fetch_available_free_spots,
         fetch_available_handicap_spots,
+        fetch_lot_snapshot,
         save_token,
         save_total_spots,
         save_total_handicap_spots,
@@ -17,11 +28,348 @@ try:
     )
 except ImportError:
     print("Module 'database' not found. Please ensure it is in the same directory or installed.")
+try:
+    from metrics import CONTENT_TYPE, REGISTRY, Gauge, Histogram
+except ImportError:
+    from backend.metrics import CONTENT_TYPE, REGISTRY, Gauge, Histogram
 
 logging.basicConfig(level=logging.INFO)
+
+# Uploaded setup images are stored once, named by the SHA-256 of their content
+UPLOAD_DIRECTORY = os.getenv('UPLOAD_DIRECTORY', '../source')
+UPLOAD_MAX_BYTES = int(os.getenv('UPLOAD_MAX_BYTES', str(25 * 1024 * 1024)))
+UPLOAD_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.webp'}
+# Longest side of the downscaled copy the setup page shows instead of the full image
+PREVIEW_SIZE = 1280
+
+
+class HashingUpload:
+    """
+    This class is the file an uploaded file is streamed into while the request is parsed.
+    Chunks go to a temporary file next to the stored uploads and are hashed on the way,
+    and the upload is stopped as soon as it grows past the size limit.
+    """
+
+    def __init__(self, directory=None, max_bytes=None):
+        directory = UPLOAD_DIRECTORY if directory is None else directory
+        os.makedirs(directory, exist_ok=True)
+        descriptor, self.path = tempfile.mkstemp(dir=directory, prefix='.upload-')
+        self.file = os.fdopen(descriptor, 'w+b')
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.max_bytes = UPLOAD_MAX_BYTES if max_bytes is None else max_bytes
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def write(self, data):
+        """
+        Hash and write one chunk of the upload.
+        """
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            # Parsing stops here, so the request never gets to close this file
+            self.close()
+            raise RequestEntityTooLarge(f"Uploads are limited to {self.max_bytes} bytes")
+        self.digest.update(data)
+        return self.file.write(data)
+
+    def store(self, extension):
+        """
+        Move the upload to its content addressed path unless that file already exists.
+        Returns the path and whether the file was new.
+        """
+        self.file.close()
+        path = os.path.join(os.path.dirname(self.path), self.digest.hexdigest() + extension)
+        if os.path.exists(path):
+            return path, False
+        os.replace(self.path, path)
+        self.path = None
+        return path, True
+
+    def close(self):
+        """
+        Close the upload and remove it unless it was stored.
+        """
+        self.file.close()
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+            self.path = None
+
+
+class UploadRequest(Request):
+    """
+    Request that streams uploaded files through HashingUpload.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None,
+                         content_length=None):
+        return HashingUpload()
+
+
+def write_preview(path, size=PREVIEW_SIZE):
+    """
+    Write a downscaled JPEG copy of an uploaded image next to it.
+    Returns the preview's path, or None if the upload is not a readable image.
+    """
+    # Decoding at half resolution is much faster for the large setup photos
+    image = cv2.imread(path, cv2.IMREAD_REDUCED_COLOR_2)
+    if image is None:
+        return None
+    scale = size / max(image.shape[:2])
+    if scale < 1:
+        image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    preview_path = os.path.splitext(path)[0] + '_preview.jpg'
+    cv2.imwrite(preview_path, image, [cv2.IMWRITE_JPEG_QUALITY, 85])
+    return preview_path
+
+
 app = Flask(__name__ , template_folder='Website/')
+app.request_class = UploadRequest
+# Room for the form fields next to the image
+app.config['MAX_CONTENT_LENGTH'] = UPLOAD_MAX_BYTES + 64 * 1024
 CORS(app)
 
+REQUEST_SECONDS = Histogram(
+    'parkspotter_http_request_seconds', 'Time to answer a request, until the response headers.',
+    ['endpoint', 'method', 'status'])
+
+
+@app.before_request
+def start_request_timer():
+    """
+    Remember when the request started.
+    """
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request_time(response):
+    """
+    Record the time of the request under its route, so URLs with parameters share one series.
+    """
+    start = g.pop('request_start', None)
+    if start is not None:
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint,
+                                method=request.method, status=response.status_code)
+    return response
+
+# Seconds a value read from the database is served from memory. The detector
+# invalidates the cache when it writes new counts, so this only bounds staleness
+# when it cannot reach the server.
+CACHE_TTL = float(os.getenv('CACHE_TTL', '15'))
+# Shared secret the detector sends to /cache/invalidate. Without one only clients on
+# this host may invalidate, so set it when the server sits behind a proxy on this host
+CACHE_INVALIDATE_TOKEN = os.getenv('CACHE_INVALIDATE_TOKEN')
+LOOPBACK_ADDRESSES = {'127.0.0.1', '::1'}
+# While clients are subscribed the status is also re-read every STATUS_POLL_INTERVAL
+# seconds, so workers the detector did not notify still push changes
+STATUS_POLL_INTERVAL = float(os.getenv('STATUS_POLL_INTERVAL', '5'))
+# Seconds between keep-alive comments on idle event streams
+EVENTS_KEEPALIVE = float(os.getenv('EVENTS_KEEPALIVE', '20'))
+# Longest wait of a long-poll request
+LONG_POLL_TIMEOUT = float(os.getenv('LONG_POLL_TIMEOUT', '25'))
+
+
+class ReadCache:
+    """
+    This class is a thread-safe read-through cache whose entries expire after a TTL.
+    Concurrent misses of the same key wait for a single database read.
+    """
+
+    def __init__(self, ttl=CACHE_TTL):
+        self.ttl = ttl
+        self.entries = {}
+        self.key_locks = {}
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        """
+        Return the fresh entry of a key and count the hit, or None.
+        """
+        entry = self.entries.get(key)
+        if entry is None or entry[1] <= time.monotonic():
+            return None
+        with self.lock:
+            self.hits += 1
+        return entry
+
+    def get(self, key, loader, cacheable=lambda value: True):
+        """
+        Return the cached value of a key, loading and caching it on a miss.
+        Values for which cacheable returns False are returned but not cached.
+        """
+        entry = self.lookup(key)
+        if entry is not None:
+            return entry[0]
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            # Another request may have loaded it while we waited
+            entry = self.lookup(key)
+            if entry is not None:
+                return entry[0]
+            with self.lock:
+                self.misses += 1
+                generation = self.generation
+            value = loader()
+            with self.lock:
+                # Drop the value if the cache was invalidated during the read
+                if cacheable(value) and generation == self.generation:
+                    self.entries[key] = (value, time.monotonic() + self.ttl)
+            return value
+
+    def invalidate(self):
+        """
+        Drop every cached value.
+        """
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+    def stats(self):
+        """
+        Return the hit and miss counters of the cache.
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'entries': len(self.entries),
+                'ttl': self.ttl,
+            }
+
+
+def valid_count(value):
+    """
+    Check that a value read from the database is a usable spot count.
+    """
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+
+READ_CACHE = ReadCache()
+# Latest per-spot occupancy of every camera, as sent by the detector
+SPOT_STATES = {'cycle_id': None, 'cameras': None}
+MAX_SPOT_STATES = 10000  # Spots accepted over all cameras
+
+
+def build_status():
+    """
+    Read the lot snapshot and render the /status body and its ETag.
+    Returns None if the database could not be read.
+    """
+    snapshot = fetch_lot_snapshot()
+    if snapshot is None or not valid_count(snapshot.free_spots) \
+            or not valid_count(snapshot.free_handicap_spots):
+        return None
+    status = {
+        'free_spots': snapshot.free_spots,
+        'free_handicap_spots': snapshot.free_handicap_spots,
+        'total_spots': snapshot.total_spots,
+        'total_handicap_spots': snapshot.total_handicap_spots,
+        'cycle_id': snapshot.cycle_id,
+        'updated_at': snapshot.updated_at.isoformat() if snapshot.updated_at else None,
+    }
+    if SPOT_STATES['cameras'] is not None:
+        status['spots'] = SPOT_STATES['cameras']
+    body = json.dumps(status, sort_keys=True)
+    # The cycle id changes with every detector write, the digest covers totals
+    # edited through /save_spots and occupancy changes within a cycle
+    digest = hashlib.sha1(body.encode('utf-8')).hexdigest()[:12]
+    return body, f"{snapshot.cycle_id}-{digest}"
+
+
+class Broker:
+    """
+    This class hands the latest lot status to every waiting client.
+    Each published change moves the cursor on, and subscribers wait
+    until the cursor differs from the one they have seen.
+    """
+
+    def __init__(self, poll_interval=STATUS_POLL_INTERVAL):
+        self.condition = threading.Condition()
+        self.cursor = 0
+        self.body = None
+        self.etag = None
+        self.subscribers = 0
+        self.poll_interval = poll_interval
+        self.watcher = None
+
+    def publish(self, body, etag):
+        """
+        Publish a status body, returns False if it is the one already published.
+        """
+        with self.condition:
+            if etag == self.etag:
+                return False
+            self.cursor += 1
+            self.body, self.etag = body, etag
+            self.condition.notify_all()
+            return True
+
+    def wait(self, cursor, timeout):
+        """
+        Wait until the cursor moves past the given one or the timeout passes.
+        Returns the current cursor and status body.
+        """
+        with self.condition:
+            self.subscribers += 1
+            try:
+                self.condition.wait_for(lambda: self.body is not None and self.cursor != cursor, timeout)
+                return self.cursor, self.body
+            finally:
+                self.subscribers -= 1
+
+    def watch(self):
+        """
+        Start re-reading the status in the background, once.
+        """
+        with self.condition:
+            if self.watcher is None:
+                self.watcher = threading.Thread(target=self.run, daemon=True)
+                self.watcher.start()
+
+    def run(self):
+        """
+        Publish the status every poll interval while anyone is subscribed.
+        """
+        while True:
+            if self.subscribers or self.body is None:
+                publish_status()
+            time.sleep(self.poll_interval)
+
+
+def publish_status():
+    """
+    Publish the current status to the broker if it changed.
+    """
+    status = READ_CACHE.get('status', build_status, lambda value: value is not None)
+    if status is not None:
+        BROKER.publish(*status)
+
+
+def parse_cursor(value):
+    """
+    Parse a client's cursor, None if it sent none.
+    """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+BROKER = Broker()
+Gauge('parkspotter_read_cache_entries', 'Values held by the read cache.',
+      function=lambda: len(READ_CACHE.entries))
+Gauge('parkspotter_status_subscribers', 'Clients waiting for a status change.',
+      function=lambda: BROKER.subscribers)
+
 @app.route('/')
 def index():
     """
@@ -52,8 +400,8 @@ def get_free_spots():
     This function fetches the number of available parking spots and returns it as a JSON response.
     """
     try:
-        free_spots = fetch_available_free_spots()
-        if not isinstance(free_spots, int) or free_spots < 0:
+        free_spots = READ_CACHE.get('free_spots', fetch_available_free_spots, valid_count)
+        if not valid_count(free_spots):
             raise ValueError("Invalid number of free spots")
         return jsonify({'free_spots': free_spots}), 200
     except ValueError as e:
@@ -66,14 +414,140 @@ def get_free_handicap_spots():
     Fetches the number of available handicap parking spots and returns it as a JSON response.
     """
     try:
-        free_handicap_spots = fetch_available_handicap_spots()
-        if not isinstance(free_handicap_spots, int) or free_handicap_spots < 0:
+        free_handicap_spots = READ_CACHE.get(
+            'free_handicap_spots', fetch_available_handicap_spots, valid_count)
+        if not valid_count(free_handicap_spots):
             raise ValueError("Invalid number of free handicap spots")
         return jsonify({'free_handicap_spots': free_handicap_spots}), 200
     except ValueError as e:
         logging.exception("Error fetching free handicap spots: %s", str(e))
         return jsonify({'error': str(e)}), 500
 
+@app.route('/status', methods=['GET'])
+def get_status():
+    """
+    Returns all counters of the lot, the per-spot occupancy when the detector
+    has sent it and the time of the last update.
+    Supports conditional requests with If-None-Match.
+    """
+    status = READ_CACHE.get('status', build_status, lambda value: value is not None)
+    if status is None:
+        logging.error("Error fetching the parking lot status")
+        return jsonify({'error': 'Parking lot status is not available'}), 500
+    body, etag = status
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    # Clients keep the body but revalidate it on every poll
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+def valid_spot_states(cameras):
+    """
+    Check that per-spot states are what the detector sends: camera names mapping to
+    lists of {'id', 'handicap', 'occupied'}, with the ids numbering the spots in order.
+    """
+    if not isinstance(cameras, dict):
+        return False
+    count = 0
+    for name, spots in cameras.items():
+        if not isinstance(name, str) or not name or not isinstance(spots, list):
+            return False
+        count += len(spots)
+        if count > MAX_SPOT_STATES:
+            return False
+        for spot_id, spot in enumerate(spots):
+            if not isinstance(spot, dict) or set(spot) != {'id', 'handicap', 'occupied'}:
+                return False
+            if not valid_count(spot['id']) or spot['id'] != spot_id:
+                return False
+            if not isinstance(spot['handicap'], bool) or not isinstance(spot['occupied'], bool):
+                return False
+    return True
+
+def invalidation_allowed():
+    """
+    Check that the request carries the invalidation token, or without a
+    configured token that it comes from this host.
+    """
+    if CACHE_INVALIDATE_TOKEN:
+        return hmac.compare_digest(request.headers.get('X-Invalidate-Token', '').encode('utf-8'),
+                                   CACHE_INVALIDATE_TOKEN.encode('utf-8'))
+    return request.remote_addr in LOOPBACK_ADDRESSES
+
+@app.route('/cache/invalidate', methods=['POST'])
+def invalidate_cache():
+    """
+    Drop the cached counts, called by the detector after it saved new ones.
+    """
+    if not invalidation_allowed():
+        return jsonify({'error': 'Invalid token'}), 403
+    payload = request.get_json(silent=True) or {}
+    if not isinstance(payload, dict):
+        return jsonify({'error': 'Invalid payload'}), 400
+    if payload.get('spots') is not None:
+        cycle_id = payload.get('cycle_id')
+        if not valid_spot_states(payload['spots']) or not (cycle_id is None or valid_count(cycle_id)):
+            return jsonify({'error': 'Invalid spot states'}), 400
+        SPOT_STATES.update(cycle_id=cycle_id, cameras=payload['spots'])
+    READ_CACHE.invalidate()
+    publish_status()
+    return jsonify({'status': 'success'}), 200
+
+@app.route('/events', methods=['GET'])
+def stream_events():
+    """
+    Streams the lot status as Server-Sent Events, one event per change.
+    A reconnecting client resumes from its Last-Event-ID.
+    """
+    cursor = parse_cursor(request.headers.get('Last-Event-ID') or request.args.get('cursor'))
+    BROKER.watch()
+
+    def events(cursor):
+        while True:
+            new_cursor, body = BROKER.wait(cursor, EVENTS_KEEPALIVE)
+            if new_cursor == cursor or body is None:
+                yield ": keep-alive\n\n"
+                continue
+            cursor = new_cursor
+            yield f"id: {cursor}\nevent: status\ndata: {body}\n\n"
+
+    return Response(events(cursor), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/status/poll', methods=['GET'])
+def poll_status():
+    """
+    Long-polls the lot status: answers as soon as the status differs from the
+    client's cursor, or with 204 No Content when nothing changed within the timeout.
+    """
+    cursor = parse_cursor(request.args.get('cursor'))
+    try:
+        timeout = float(request.args.get('timeout', LONG_POLL_TIMEOUT))
+    except ValueError:
+        timeout = None
+    if timeout is None or not math.isfinite(timeout) or timeout < 0:
+        return jsonify({'error': 'Invalid timeout'}), 400
+    timeout = min(timeout, LONG_POLL_TIMEOUT)
+    BROKER.watch()
+    new_cursor, body = BROKER.wait(cursor, timeout)
+    if new_cursor == cursor or body is None:
+        return '', 204
+    return jsonify({'cursor': new_cursor, 'status': json.loads(body)}), 200
+
+@app.route('/cache/stats', methods=['GET'])
+def get_cache_stats():
+    """
+    Returns the hit and miss counters of the read cache.
+    """
+    return jsonify(READ_CACHE.stats()), 200
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Returns the metrics in the Prometheus text format, summed over the workers under gunicorn.
+    """
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
 @app.route('/save_spots', methods=['PUT'])
 def save_spots():
     """
@@ -85,23 +559,53 @@ def save_spots():
         image = request.files.get('image')
         if not image:
             return jsonify({'error': 'Missing image in request'}), 400
+        extension = os.path.splitext(secure_filename(image.filename or ''))[1].lower()
+        if extension not in UPLOAD_EXTENSIONS:
+            return jsonify({'error': 'Unsupported image type'}), 400
 
-        directory = '../source'
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-        image_path = os.path.join(directory, image.filename)
-        image.save(image_path)
+        image_path, created = image.stream.store(extension)
+        preview_path = os.path.splitext(image_path)[0] + '_preview.jpg'
+        if created or not os.path.exists(preview_path):
+            preview_path = write_preview(image_path)
+            if preview_path is None:
+                # Only drop the image if this request stored it, an earlier upload may still use it
+                if created:
+                    os.remove(image_path)
+                return jsonify({'error': 'The image could not be read'}), 400
+        else:
+            logging.info("Image %s was already uploaded", image_path)
 
         save_image(image_path)
         logging.info("Received data: parking=%s, acc_park=%s", parking, acc_park)
 
         save_total_spots(parking)
         save_total_handicap_spots(acc_park)
+        READ_CACHE.invalidate()
+        publish_status()
 
-        return jsonify({'status': 'success'}), 200
+        return jsonify({
+            'status': 'success',
+            'preview': url_for('get_preview', name=os.path.basename(preview_path)),
+        }), 200
     except (ValueError, FileNotFoundError) as e:
         logging.exception("Error saving parking spots: %s", str(e))
         return jsonify({'error': 'An error occurred while saving parking spots'}), 500
 
+@app.route('/previews/<name>', methods=['GET'])
+def get_preview(name):
+    """
+    Serves the downscaled copy of an uploaded image.
+    """
+    if not name.endswith('_preview.jpg'):
+        return jsonify({'error': 'Not found'}), 404
+    return send_from_directory(os.path.abspath(UPLOAD_DIRECTORY), name, max_age=86400)
+
+@app.errorhandler(RequestEntityTooLarge)
+def upload_too_large(e):
+    """
+    Answers oversized uploads with a JSON error.
+    """
+    return jsonify({'error': e.description}), 413
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8000)
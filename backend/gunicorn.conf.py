@@ -0,0 +1,57 @@
+"""
+Gunicorn configuration for serving the Flask app in production:
+    gunicorn -c backend/gunicorn.conf.py flaskserver:app
+A single gevent worker process serves up to SERVER_MAX_CONNECTIONS
+connections as greenlets over its pooled database connections, so slow
+clients and idle /events streams do not tie up threads. The workers share
+their metrics through METRICS_DIR, so any worker answering /metrics reports
+the numbers of all of them.
+"""
+import glob
+import os
+import tempfile
+
+# The pure Python MySQL driver yields to other greenlets while waiting on the server
+os.environ.setdefault('DB_USE_PURE', 'true')
+
+chdir = os.path.dirname(os.path.abspath(__file__))
+bind = f"{os.getenv('SERVER_HOST', '0.0.0.0')}:{os.getenv('SERVER_PORT', '8000')}"
+worker_class = 'gevent'
+# The read cache, the per-spot states and the status broker of flaskserver.py live in
+# the worker process, and the detector's /cache/invalidate reaches only one worker.
+# With more workers the others serve stale spot states and ETags and their /events and
+# /status/poll clients miss changes, so keep one unless the app is only read.
+workers = int(os.getenv('SERVER_WORKERS', '1'))
+worker_connections = int(os.getenv('SERVER_MAX_CONNECTIONS', '10000'))
+backlog = 2048
+# Event streams stay open, so only requests that stop the worker's heartbeat time out
+timeout = 60
+graceful_timeout = 30
+keepalive = 75
+# Recycle workers now and then to bound memory growth
+max_requests = 100000
+max_requests_jitter = 10000
+accesslog = None
+errorlog = '-'
+loglevel = os.getenv('SERVER_LOG_LEVEL', 'info')
+# Metric snapshots of the workers and the archive of exited ones, cleared when gunicorn starts
+METRICS_DIR = os.getenv('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'parkspotter-metrics'))
+
+
+def on_starting(server):
+    """
+    Warn about more than one worker and drop the metric snapshots of a previous run.
+    """
+    if workers > 1:
+        server.log.warning("Serving with %s workers: the detector updates only one of them, the others "
+                           "never get the spot states and see new counts only after CACHE_TTL", workers)
+    for path in glob.glob(os.path.join(METRICS_DIR, '*.json')):
+        os.remove(path)
+
+
+def post_fork(server, worker):  # pylint: disable=unused-argument
+    """
+    Share the metrics of a new worker with the others.
+    """
+    import metrics  # pylint: disable=import-outside-toplevel
+    metrics.REGISTRY.share(METRICS_DIR)
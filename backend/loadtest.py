@@ -0,0 +1,203 @@
+"""
+This module load tests the Flask server against a stand-in database, so the
+serving modes can be compared without MySQL. It starts the server in a
+subprocess, keeps a fixed number of concurrent keep-alive clients busy for a
+while and reports the requests per second and latency percentiles.
+Run it from the project root, for example:
+    python backend/loadtest.py --server gevent --path /status --concurrency 200
+    python backend/loadtest.py --server dev --path /free_spots --cache-ttl 0
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_COMMANDS = {
+    'dev': [sys.executable, os.path.join(BACKEND_DIR, 'loadtest.py'), 'serve'],
+    'gevent': [sys.executable, os.path.join(BACKEND_DIR, 'loadtest.py'), 'serve', '--gevent'],
+    'gunicorn': [sys.executable, '-m', 'gunicorn', '-c', os.path.join(BACKEND_DIR, 'gunicorn.conf.py'),
+                 'loadtest:create_app()'],
+}
+
+
+class StandInDatabase:
+    """
+    This class answers the server's database reads from memory after a fixed
+    latency, holding one of a bounded number of connections meanwhile like the pool.
+    """
+
+    def __init__(self, latency, pool_size):
+        import threading  # pylint: disable=import-outside-toplevel
+        from database import LotSnapshot  # pylint: disable=import-outside-toplevel
+        self.latency = latency
+        self.connections = threading.BoundedSemaphore(pool_size)
+        self.snapshot = LotSnapshot(12, 2, 40, 4, '', 1, None)
+        self.queries = 0
+
+    def query(self, value):
+        """
+        Wait for a connection and the query latency, then return the value.
+        """
+        with self.connections:
+            self.queries += 1
+            time.sleep(self.latency)
+            return value
+
+    def fetch_available_free_spots(self):
+        """
+        Stand in for database.fetch_available_free_spots.
+        """
+        return self.query(self.snapshot.free_spots)
+
+    def fetch_available_handicap_spots(self):
+        """
+        Stand in for database.fetch_available_handicap_spots.
+        """
+        return self.query(self.snapshot.free_handicap_spots)
+
+    def fetch_lot_snapshot(self):
+        """
+        Stand in for database.fetch_lot_snapshot.
+        """
+        return self.query(self.snapshot)
+
+
+def create_app():
+    """
+    Import the Flask app with its database reads replaced by the stand-in.
+    """
+    import flaskserver  # pylint: disable=import-outside-toplevel
+    standin = StandInDatabase(float(os.getenv('LOADTEST_DB_LATENCY', '0.002')),
+                              int(os.getenv('DB_POOL_SIZE', '5')))
+    for name in ('fetch_available_free_spots', 'fetch_available_handicap_spots', 'fetch_lot_snapshot'):
+        setattr(flaskserver, name, getattr(standin, name))
+    return flaskserver.app
+
+
+def serve(args):
+    """
+    Serve the stand-in app with the development server or gevent.
+    """
+    if args.gevent:
+        from gevent import monkey  # pylint: disable=import-outside-toplevel
+        monkey.patch_all()
+    sys.path.insert(0, BACKEND_DIR)
+    app = create_app()
+    port = int(os.getenv('SERVER_PORT', '8000'))
+    if args.gevent:
+        from gevent.pool import Pool  # pylint: disable=import-outside-toplevel
+        from gevent.pywsgi import WSGIServer  # pylint: disable=import-outside-toplevel
+        WSGIServer(('127.0.0.1', port), app, spawn=Pool(10000), log=None).serve_forever()
+    else:
+        app.run(host='127.0.0.1', port=port, threaded=True)
+
+
+def wait_until_up(port, timeout=30):
+    """
+    Wait until the server accepts connections.
+    """
+    import socket  # pylint: disable=import-outside-toplevel
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise TimeoutError(f"Server did not start on port {port}")
+
+
+def run_clients(port, path, concurrency, duration):
+    """
+    Keep concurrency keep-alive clients requesting the path for duration seconds.
+    Returns the latencies of the successful requests in milliseconds and the error count.
+    """
+    from gevent import monkey  # pylint: disable=import-outside-toplevel
+    monkey.patch_all()
+    import gevent  # pylint: disable=import-outside-toplevel
+    import http.client  # pylint: disable=import-outside-toplevel
+
+    latencies, errors = [], [0]
+    deadline = time.monotonic() + duration
+
+    def client():
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            try:
+                connection.request('GET', path)
+                response = connection.getresponse()
+                response.read()
+                if response.status == 200:
+                    latencies.append((time.perf_counter() - start) * 1000)
+                else:
+                    errors[0] += 1
+            except (OSError, http.client.HTTPException):
+                errors[0] += 1
+                connection.close()
+                connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        connection.close()
+
+    gevent.joinall([gevent.spawn(client) for _ in range(concurrency)])
+    return latencies, errors[0]
+
+
+def load_test(args):
+    """
+    Start the server, run the clients against it and print the results.
+    """
+    import numpy as np  # pylint: disable=import-outside-toplevel
+    env = dict(os.environ, SERVER_PORT=str(args.port), CACHE_TTL=str(args.cache_ttl),
+               LOADTEST_DB_LATENCY=str(args.db_latency / 1000), DB_POOL_SIZE=str(args.pool_size),
+               SERVER_WORKERS=str(args.workers), SERVER_HOST='127.0.0.1',
+               SERVER_LOG_LEVEL='warning', PYTHONPATH=BACKEND_DIR)
+    server = subprocess.Popen(SERVER_COMMANDS[args.server], env=env, cwd=BACKEND_DIR,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_until_up(args.port)
+        run_clients(args.port, args.path, args.concurrency, 1)  # Warm up
+        latencies, errors = run_clients(args.port, args.path, args.concurrency, args.duration)
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+    print(f"{'server':>9} {'path':>12} {'clients':>8} {'requests':>9} {'errors':>7} "
+          f"{'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    if not latencies:
+        print(f"{args.server:>9} {args.path:>12} {args.concurrency:>8} {0:>9} {errors:>7}")
+        return
+    print(f"{args.server:>9} {args.path:>12} {args.concurrency:>8} {len(latencies):>9} {errors:>7} "
+          f"{len(latencies) / args.duration:>8.0f} {np.percentile(latencies, 50):>8.1f} "
+          f"{np.percentile(latencies, 99):>8.1f} {np.max(latencies):>8.1f}")
+
+
+def main():
+    """
+    Parse the command line and run the load test or the stand-in server.
+    """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+
+    stand_in = subparsers.add_parser('serve', help='serve the app with the stand-in database')
+    stand_in.add_argument('--gevent', action='store_true')
+    stand_in.set_defaults(run=serve)
+
+    parser.add_argument('--server', default='gevent', choices=list(SERVER_COMMANDS))
+    parser.add_argument('--path', default='/status')
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=10, help='seconds')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, default=1, help='gunicorn worker processes')
+    parser.add_argument('--db-latency', type=float, default=2, help='stand-in query latency in ms')
+    parser.add_argument('--pool-size', type=int, default=5)
+    parser.add_argument('--cache-ttl', type=float, default=15, help='0 sends every read to the database')
+    parser.set_defaults(run=load_test)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
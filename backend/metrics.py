@@ -0,0 +1,496 @@
+"""
+This module records counters and latency histograms in process and renders them in
+the Prometheus text format. Recording takes a lock and a few arithmetic operations,
+so it is cheap enough to leave on in production. The Flask server serves the metrics
+on /metrics and the detector on a small HTTP server of its own, see start_http_server.
+Processes serving one port, such as the gunicorn workers, share their numbers through
+a directory of snapshots, see Registry.share.
+"""
+import atexit
+import bisect
+import glob
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Upper bounds in seconds, from a fast database query to a slow inference batch
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0)
+# Snapshot holding the counters and histograms of the exited processes of a shared directory
+ARCHIVE_NAME = 'exited.json'
+
+
+class Registry:
+    """
+    This class holds the metrics of a process and renders them.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+        self.directory = None
+        self.snapshot_path = None
+        self.pid = None
+
+    def register(self, metric):
+        """
+        Add a metric and return it. A module imported under two names, such as
+        database and backend.database, creates its metrics twice, so registering
+        a name again returns the metric already registered. Registering it again
+        with another type, labels or buckets raises ValueError.
+        """
+        with self.lock:
+            existing = self.metrics.setdefault(metric.name, metric)
+        if existing is not metric and (type(existing) is not type(metric)
+                                       or existing.labelnames != metric.labelnames
+                                       or getattr(existing, 'buckets', None) != getattr(metric, 'buckets', None)):
+            raise ValueError(f"Metric {metric.name} is already registered differently")
+        return existing
+
+    def share(self, directory, interval=1.0, name=None):
+        """
+        Aggregate the metrics with the other processes sharing directory. Every process
+        writes a snapshot of its values there every interval seconds, and render() sums
+        the snapshots of all of them, so any process can answer a scrape. The counters
+        and histograms of exited processes are folded into one archive so they do not go
+        back, and their gauges are dropped; clear the directory when the whole group starts.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.pid = os.getpid()
+        self.snapshot_path = os.path.join(directory, f"{name or self.pid}.json")
+        with self.directory_lock():
+            # Left behind by an exited process that had the same pid
+            snapshot = read_snapshot(self.snapshot_path) if os.path.exists(self.snapshot_path) else None
+            if snapshot is not None:
+                self.archive([(self.snapshot_path, snapshot)])
+            self.write_snapshot()
+        if interval:
+            threading.Thread(target=self.sync, args=(interval,), name='metrics-sync', daemon=True).start()
+        atexit.register(self.flush)
+
+    def sync(self, interval):
+        """
+        Write a snapshot every interval seconds.
+        """
+        while True:
+            time.sleep(interval)
+            self.flush()
+
+    def flush(self):
+        """
+        Write a snapshot, logging instead of raising when the directory cannot be written.
+        """
+        try:
+            self.write_snapshot()
+        except OSError as e:
+            logging.warning("Could not write the metrics snapshot %s: %s", self.snapshot_path, e)
+
+    def write_snapshot(self):
+        """
+        Replace the snapshot file of this process with the current values.
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        write_snapshot(self.snapshot_path, self.pid, metrics)
+
+    @contextmanager
+    def directory_lock(self):
+        """
+        Hold an exclusive lock on the shared directory, so that only one process at a
+        time archives the snapshots of exited processes. Without fcntl, as on Windows
+        where gunicorn does not run, nothing is locked.
+        """
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.directory, '.lock'), 'a') as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+    def archive(self, snapshots):
+        """
+        Add the counters and histograms of the given (path, snapshot) pairs to the archive
+        of exited processes and remove their files. Call it holding the directory lock.
+        """
+        archive_path = os.path.join(self.directory, ARCHIVE_NAME)
+        archived = read_snapshot(archive_path) if os.path.exists(archive_path) else None
+        metrics = merge_snapshots([archived] + [snapshot for _, snapshot in snapshots], gauges=False)
+        write_snapshot(archive_path, None, metrics)
+        for path, _ in snapshots:
+            os.remove(path)
+
+    def collect(self):
+        """
+        Return the metrics of this process, or when shared the metrics summed over
+        the snapshots of every running process and the archive of the exited ones.
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        if self.directory is None:
+            return metrics
+        self.write_snapshot()
+        with self.directory_lock():
+            snapshots = {}
+            exited = []
+            for path in sorted(glob.glob(os.path.join(self.directory, '*.json'))):
+                snapshot = snapshots[path] = read_snapshot(path)
+                if snapshot is not None and snapshot['pid'] is not None and not process_alive(snapshot['pid']):
+                    exited.append((path, snapshot))
+            if exited:
+                self.archive(exited)
+                for path, _ in exited:
+                    del snapshots[path]
+                snapshots[os.path.join(self.directory, ARCHIVE_NAME)] = read_snapshot(
+                    os.path.join(self.directory, ARCHIVE_NAME))
+        return merge_snapshots(snapshots.values())
+
+    def render(self):
+        """
+        Return every metric in the Prometheus text exposition format.
+        """
+        lines = []
+        for metric in self.collect():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for suffix, labels, value in metric.samples():
+                lines.append(f"{metric.name}{suffix}{format_labels(labels)} {format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def format_labels(labels):
+    """
+    Return labels as {name="value",...}, or nothing without labels.
+    """
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label_value(value)}"' for name, value in labels) + '}'
+
+
+def escape_label_value(value):
+    """
+    Escape backslashes, double quotes and newlines of a label value.
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    """
+    Return a sample value the way Prometheus writes it.
+    """
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    """
+    This class is the base of the metric types, keeping one value per label combination.
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        if registry is not None:
+            existing = registry.register(self)
+            # Record into the registered metric, so both copies show in one series
+            self.values, self.lock = existing.values, existing.lock
+
+    def key(self, labels):
+        """
+        Return the label values in label name order. Missing or extra labels raise ValueError.
+        """
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} takes the labels {self.labelnames}, got {tuple(labels)}")
+        try:
+            return tuple(str(labels[name]) for name in self.labelnames)
+        except KeyError as e:
+            raise ValueError(f"{self.name} takes the labels {self.labelnames}, got {tuple(labels)}") from e
+
+    def labeled(self, key):
+        """
+        Return the (name, value) label pairs of a key.
+        """
+        return tuple(zip(self.labelnames, key))
+
+    def current_values(self):
+        """
+        Return a copy of the value of every label combination.
+        """
+        with self.lock:
+            return dict(self.values)
+
+    def add_values(self, values):
+        """
+        Add the values of another process to the values of the same labels.
+        """
+        with self.lock:
+            for key, value in values.items():
+                self.values[key] = self.values.get(key, 0) + value
+
+    def samples(self):
+        """
+        Yield the (suffix, labels, value) samples of the metric.
+        """
+        for key, value in sorted(self.current_values().items()):
+            yield '', self.labeled(key), value
+
+
+class Counter(Metric):
+    """
+    This class counts events, such as frames or errors.
+    """
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """
+        Add amount to the counter of the given labels.
+        """
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        """
+        Return the count of the given labels.
+        """
+        return self.values.get(self.key(labels), 0)
+
+
+class Gauge(Metric):
+    """
+    This class holds a value that goes up and down. With a function the value is
+    read from it whenever the metrics are rendered. Shared gauges are summed over the processes.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY, function=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.function = function
+
+    def set(self, value, **labels):
+        """
+        Set the value of the given labels.
+        """
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def current_values(self):
+        if self.function is None:
+            return super().current_values()
+        try:
+            return {(): self.function()}
+        except Exception:  # pylint: disable=broad-except
+            # A failing callback must not break the whole page
+            logging.exception("Error reading metric %s", self.name)
+            return {}
+
+
+class Histogram(Metric):
+    """
+    This class counts observations, such as latencies in seconds, into cumulative buckets.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value, **labels):
+        """
+        Add one observation of the given labels.
+        """
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # Per bucket counts, the last one past the largest bound, then the sum
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observe the seconds spent in the with block, or in every call of the
+        function it decorates.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        """
+        Return the number of observations of the given labels.
+        """
+        counts = self.values.get(self.key(labels))
+        return sum(counts[:-1]) if counts else 0
+
+    def current_values(self):
+        with self.lock:
+            return {key: list(counts) for key, counts in self.values.items()}
+
+    def add_values(self, values):
+        with self.lock:
+            for key, counts in values.items():
+                total = self.values.setdefault(key, [0] * (len(self.buckets) + 1) + [0.0])
+                for index, count in enumerate(counts):
+                    total[index] += count
+
+    def samples(self):
+        for key, counts in sorted(self.current_values().items()):
+            labels = self.labeled(key)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield '_bucket', labels + (('le', format_value(bound)),), cumulative
+            yield '_sum', labels, counts[-1]
+            yield '_count', labels, cumulative
+
+
+METRIC_TYPES = {metric.kind: metric for metric in (Counter, Gauge, Histogram)}
+
+
+def process_alive(pid):
+    """
+    Return whether a process with the given pid is running.
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Running under another user
+        return True
+    return True
+
+
+def read_snapshot(path):
+    """
+    Return the snapshot in path as {'pid': ..., 'metrics': [...]}, or None when it
+    cannot be read.
+    """
+    try:
+        with open(path, encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        logging.warning("Could not read the metrics snapshot %s", path)
+        return None
+
+
+def write_snapshot(path, pid, metrics):
+    """
+    Atomically replace the snapshot in path with the values of metrics, written by pid,
+    or None for the archive of exited processes.
+    """
+    snapshot = {'pid': pid, 'metrics': [{
+        'name': metric.name,
+        'documentation': metric.documentation,
+        'kind': metric.kind,
+        'labelnames': metric.labelnames,
+        'buckets': getattr(metric, 'buckets', None),
+        'values': [[key, value] for key, value in metric.current_values().items()],
+    } for metric in metrics]}
+    descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.snapshot-')
+    try:
+        with os.fdopen(descriptor, 'w', encoding='utf-8') as file:
+            json.dump(snapshot, file)
+        os.replace(temporary, path)
+    except BaseException:
+        os.remove(temporary)
+        raise
+
+
+def merge_snapshots(snapshots, gauges=True):
+    """
+    Return new metrics, not registered anywhere, holding the sum of the snapshots.
+    Snapshots that could not be read are None and skipped, and with gauges False
+    so are the gauges.
+    """
+    merged = {}
+    for snapshot in snapshots:
+        if snapshot is None:
+            continue
+        for entry in snapshot['metrics']:
+            if entry['kind'] == 'gauge' and not gauges:
+                continue
+            metric = merged.get(entry['name'])
+            if metric is None:
+                options = {'buckets': entry['buckets']} if entry['kind'] == 'histogram' else {}
+                metric = merged[entry['name']] = METRIC_TYPES[entry['kind']](
+                    entry['name'], entry['documentation'], entry['labelnames'], registry=None, **options)
+            elif getattr(metric, 'buckets', None) != (tuple(entry['buckets']) if entry['buckets'] else None):
+                # Written by a process running other code, cannot be added up
+                continue
+            metric.add_values({tuple(key): value for key, value in entry['values']})
+    return list(merged.values())
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    This class serves the registry of its server on /metrics.
+    """
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """
+        Answer a scrape.
+        """
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """
+        Leave scrapes out of the log.
+        """
+
+
+def start_http_server(port, host='0.0.0.0', registry=REGISTRY):
+    """
+    Serve the metrics on http://host:port/metrics from a daemon thread.
+    Returns the server, whose shutdown() stops it.
+    """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    server.registry = registry
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logging.info("Serving metrics on %s:%s", host, server.server_address[1])
+    return server
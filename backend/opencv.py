@@ -10,9 +10,14 @@ import cv2
 import numpy as np
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from backend.database import fetch_image
+from backend.spotlayout import FLAG_HANDICAP, layout_polygons, load_layout, save_layout, simplify_polygon
 
 logging.basicConfig(level=logging.INFO)
 
+LAYOUT_PATH = os.getenv('LAYOUT_PATH', './backend/carSpots2.layout')
+# Spots drawn before the binary layout are still loaded from the old pickle file
+LEGACY_LAYOUT_PATH = "./backend/carSpots2.pkl"
+
 class ImageEditor:
     """
     This class provides functionalities to edit images using OpenCV.
@@ -49,10 +54,19 @@ class ImageEditor:
 
     def load_points(self):
         """
-        Load points from a pickle file.
+        Load points from the layout file, or from the old pickle file if there is none yet.
         """
         try:
-            with open("./backend/carSpots2.pkl", "rb") as file_in:
+            layout = load_layout(LAYOUT_PATH)
+            return [([tuple(point) for point in polygon.tolist()], bool(flags & FLAG_HANDICAP))
+                    for polygon, flags in zip(layout_polygons(layout), layout.flags)]
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            print(f"Error loading points: {e}")
+            return []
+        try:
+            with open(LEGACY_LAYOUT_PATH, "rb") as file_in:
                 try:
                     return pickle.load(file_in)
                 except EOFError:
@@ -85,17 +99,18 @@ class ImageEditor:
             self.is_drawing = False
             cv2.polylines(self.image, [np.array(self.current_points)], True, color, 2)
             cv2.imshow("image", self.image)
-            self.saved_points.append((list(self.current_points), self.is_handicap))
+            # Keep the corners of the stroke instead of every mouse move
+            simplified = [tuple(point) for point in simplify_polygon(self.current_points).tolist()]
+            self.saved_points.append((simplified, self.is_handicap))
 
     def save_points(self):
         """
-        Save points to a pickle file.
+        Save points to the layout file.
         """
         try:
-            with open("./backend/carSpots2.pkl", "wb") as file_out:
-                pickle.dump(self.saved_points, file_out)
-        except pickle.PickleError as pickle_error:
-            print(f"Error saving points: {pickle_error}")
+            save_layout(LAYOUT_PATH, self.saved_points)
+        except OSError as os_error:
+            print(f"Error saving points: {os_error}")
 
     def run(self):
         """
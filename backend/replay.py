@@ -0,0 +1,309 @@
+"""
+This module replays a recorded video or a set of still images through the detection
+pipeline, without a camera or a network. Frames go through the same Camera, change gate,
+inference server and CountPublisher as in streamyolo.main, either at full speed or paced
+at a simulated interval. The per frame stage timings (decode, roi, inference,
+postprocess, db), throughput and occupancy are written as JSON or CSV.
+Run it from the project root, for example:
+    python backend/replay.py backend/source --output replay.json
+    python backend/replay.py recording.mp4 --every 25 --interval 1 --output replay.csv
+"""
+import argparse
+import csv
+import glob
+import json
+import logging
+import os
+import time
+from datetime import datetime, timezone
+import cv2
+import numpy as np
+import streamyolo
+from database import LotSnapshot
+from streamyolo import (
+    DETECTION_MODE,
+    DETECTION_TILES,
+    HISTORY_ENABLED,
+    INFERENCE_BACKEND,
+    LAYOUT_PATH,
+    MODEL_RUNTIME,
+    MODEL_VARIANT,
+    Camera,
+    CountPublisher,
+    HistoryWriter,
+    InferenceServer,
+    ProcessInferenceServer,
+    load_model,
+    model_artifact,
+    timed,
+)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+STAGES = ('decode', 'roi', 'inference', 'postprocess', 'db')
+
+
+class ReplayDatabase:
+    """
+    This class keeps the parking lot row and the history in memory in place of MySQL.
+    The lot totals follow the layout of the replayed camera.
+    """
+
+    def __init__(self, camera):
+        self.camera = camera
+        self.free_counts = (None, None)
+        self.cycle_id = 0
+        self.updated_at = None
+        self.history_rows = 0
+        self.spot_event_rows = 0
+
+    def fetch_lot_snapshot(self):
+        """
+        Stand in for database.fetch_lot_snapshot.
+        """
+        is_handicap = self.camera.layout['is_handicap']
+        return LotSnapshot(*self.free_counts, int((~is_handicap).sum()), int(is_handicap.sum()),
+                           '', self.cycle_id, self.updated_at)
+
+    def save_free_counts(self, free_spots, free_handicap_spots):
+        """
+        Stand in for database.save_free_counts.
+        """
+        self.free_counts = (free_spots, free_handicap_spots)
+        self.cycle_id += 1
+        self.updated_at = datetime.now(timezone.utc)
+        return self.cycle_id
+
+    def save_occupancy_history(self, rows):
+        """
+        Stand in for database.save_occupancy_history.
+        """
+        self.history_rows += len(rows)
+        return True
+
+    def save_spot_events(self, rows):
+        """
+        Stand in for database.save_spot_events.
+        """
+        self.spot_event_rows += len(rows)
+        return True
+
+
+def use_replay_database(camera):
+    """
+    Replace the database writes and the server notification of streamyolo with memory.
+    """
+    database = ReplayDatabase(camera)
+    for name in ('fetch_lot_snapshot', 'save_free_counts', 'save_occupancy_history', 'save_spot_events'):
+        setattr(streamyolo, name, getattr(database, name))
+    streamyolo.notify_counts_changed = lambda cycle_id, spots=None: None
+    return database
+
+
+def read_frames(source, every=1, limit=None):
+    """
+    Yield (name, frame, decode milliseconds) for every image of a directory or glob
+    pattern, or for every nth frame of a video file.
+    """
+    if os.path.isdir(source):
+        paths = sorted(path for path in glob.glob(os.path.join(source, '*'))
+                       if path.lower().endswith(IMAGE_EXTENSIONS))
+    elif glob.has_magic(source):
+        paths = sorted(glob.glob(source))
+    else:
+        paths = None
+
+    count = 0
+    if paths is not None:
+        if not paths:
+            raise FileNotFoundError(f"No images found at {source}")
+        for path in paths[::every]:
+            if limit is not None and count >= limit:
+                return
+            start = time.perf_counter()
+            frame = cv2.imread(path)
+            decode_ms = (time.perf_counter() - start) * 1000
+            if frame is None:
+                logging.warning("Could not read %s, skipping it", path)
+                continue
+            count += 1
+            yield os.path.basename(path), frame, decode_ms
+        return
+
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        raise FileNotFoundError(f"Could not open video {source}")
+    try:
+        index = 0
+        while limit is None or count < limit:
+            # Skipped frames are only grabbed, like FrameGrabber does between cycles
+            if index % every:
+                if not capture.grab():
+                    return
+                index += 1
+                continue
+            start = time.perf_counter()
+            ok, frame = capture.read()
+            decode_ms = (time.perf_counter() - start) * 1000
+            if not ok:
+                return
+            count += 1
+            yield f"frame{index}", frame, decode_ms
+            index += 1
+    finally:
+        capture.release()
+
+
+def start_inference_server(model_path, backend):
+    """
+    Start the inference server streamyolo.main would use for the model.
+    """
+    if backend == 'process':
+        return ProcessInferenceServer(model_path).start()
+    return InferenceServer([load_model(model_path)]).start()
+
+
+def replay(args):
+    """
+    Run every frame through the pipeline and return the per frame records.
+    """
+    camera = Camera('replay', args.source, args.layout, args.interval, args.mode, args.tiles,
+                    model=model_artifact(args.variant, args.runtime))
+    database = use_replay_database(camera) if args.database == 'memory' else None
+    history = HistoryWriter() if HISTORY_ENABLED and not args.no_history else None
+    publisher = CountPublisher([camera], history)
+    server = start_inference_server(camera.model, args.backend)
+
+    records = []
+    try:
+        for index, (name, frame, decode_ms) in enumerate(read_frames(args.source, args.every, args.limit)):
+            cycle_start = time.perf_counter()
+            timings = {'decode': decode_ms}
+            inferred = camera.gate.inferred
+            changed_spots = camera.process(frame, server.infer, timings)
+            with timed(timings, 'db'):
+                publisher(camera, changed_spots)
+            states = camera.tracker.states
+            records.append({
+                'frame': index,
+                'source': name,
+                'warmup': index < args.warmup,
+                'width': frame.shape[1],
+                'height': frame.shape[0],
+                **{f"{stage}_ms": round(timings.get(stage, 0.0), 3) for stage in STAGES},
+                'total_ms': round(sum(timings.get(stage, 0.0) for stage in STAGES), 3),
+                'inferred_spots': camera.gate.inferred - inferred,
+                'spots': len(states),
+                'occupied': camera.occupied[0],
+                'occupied_handicap': camera.occupied[1],
+                'changed_spots': len(changed_spots),
+                'occupancy': ''.join('1' if occupied else '0' for occupied in states),
+            })
+            if args.interval:
+                time.sleep(max(0, args.interval - (time.perf_counter() - cycle_start)))
+    finally:
+        server.stop()
+
+    flush_ms = None
+    if history is not None:
+        start = time.perf_counter()
+        history.flush()
+        flush_ms = (time.perf_counter() - start) * 1000
+    return records, summarize(records, camera, database, flush_ms)
+
+
+def summarize(records, camera, database, flush_ms):
+    """
+    Return the throughput and the latency distribution of every stage, leaving out warm up frames.
+    """
+    measured = [record for record in records if not record['warmup']]
+    summary = {
+        'frames': len(records),
+        'measured_frames': len(measured),
+        'skip_ratio': round(camera.gate.skip_ratio, 3),
+        'history_flush_ms': None if flush_ms is None else round(flush_ms, 3),
+    }
+    if database is not None:
+        summary.update(saved_cycles=database.cycle_id, free_counts=list(database.free_counts),
+                       history_rows=database.history_rows, spot_event_rows=database.spot_event_rows)
+    if not measured:
+        return summary
+    totals = np.array([record['total_ms'] for record in measured])
+    summary['frames_per_second'] = round(1000 * len(measured) / totals.sum(), 3) if totals.sum() else None
+    for stage in STAGES + ('total',):
+        values = np.array([record[f"{stage}_ms"] for record in measured])
+        summary[stage] = {
+            'mean_ms': round(float(values.mean()), 3),
+            'p50_ms': round(float(np.percentile(values, 50)), 3),
+            'p95_ms': round(float(np.percentile(values, 95)), 3),
+            'max_ms': round(float(values.max()), 3),
+        }
+    return summary
+
+
+def write_output(path, records, summary):
+    """
+    Write the summary and the frames to a JSON file, or the frames to a CSV file.
+    """
+    if path.lower().endswith('.csv'):
+        with open(path, 'w', newline='', encoding='utf-8') as file:
+            writer = csv.DictWriter(file, fieldnames=list(records[0]) if records else ['frame'])
+            writer.writeheader()
+            writer.writerows(records)
+    else:
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump({'summary': summary, 'frames': records}, file, indent=2)
+
+
+def print_summary(summary):
+    """
+    Print the stage latencies and the throughput.
+    """
+    print(f"{'stage':>12} {'mean ms':>9} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8}")
+    for stage in STAGES + ('total',):
+        if stage in summary:
+            row = summary[stage]
+            print(f"{stage:>12} {row['mean_ms']:>9.2f} {row['p50_ms']:>8.2f} "
+                  f"{row['p95_ms']:>8.2f} {row['max_ms']:>8.2f}")
+    print(f"{summary['measured_frames']} of {summary['frames']} frames measured, "
+          f"{summary.get('frames_per_second')} frames/s, skip ratio {summary['skip_ratio']}")
+    if 'saved_cycles' in summary:
+        print(f"{summary['saved_cycles']} count changes saved, free spots now {summary['free_counts']}")
+
+
+def main():
+    """
+    Parse the command line and replay the source.
+    """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('source', help='video file, image directory or glob pattern')
+    parser.add_argument('--layout', default=LAYOUT_PATH)
+    parser.add_argument('--variant', default=MODEL_VARIANT, choices=['n', 's', 'm', 'l', 'x'])
+    parser.add_argument('--runtime', default=MODEL_RUNTIME)
+    parser.add_argument('--backend', default=INFERENCE_BACKEND, choices=['thread', 'process'])
+    parser.add_argument('--mode', default=DETECTION_MODE, choices=['roi', 'full'])
+    parser.add_argument('--tiles', default=DETECTION_TILES)
+    parser.add_argument('--interval', type=float, default=0,
+                        help='simulated seconds between cycles, 0 replays at full speed')
+    parser.add_argument('--every', type=int, default=1, help='use every nth frame or image')
+    parser.add_argument('--limit', type=int, help='stop after this many frames')
+    parser.add_argument('--warmup', type=int, default=1, help='frames left out of the summary')
+    parser.add_argument('--database', default='memory', choices=['memory', 'mysql'],
+                        help='memory keeps the counts in memory, mysql writes them like the detector')
+    parser.add_argument('--no-history', action='store_true', help='do not record occupancy history')
+    parser.add_argument('--output', help='.json for the summary and frames, .csv for the frames')
+    parser.add_argument('--verbose', action='store_true', help='keep the per cycle log')
+    args = parser.parse_args()
+    if args.every < 1:
+        parser.error('--every must be at least 1')
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+        logging.getLogger('ultralytics').setLevel(logging.WARNING)
+
+    records, summary = replay(args)
+    if args.output:
+        write_output(args.output, records, summary)
+    print_summary(summary)
+
+
+if __name__ == "__main__":
+    main()
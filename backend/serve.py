@@ -0,0 +1,38 @@
+"""
+This module serves the Flask app with gevent instead of the development server.
+Every connection is a greenlet, so thousands of idle /events and /status/poll
+clients cost little memory and no threads. Run it in place of flaskserver.py:
+    python backend/serve.py
+"""
+# Sockets and locks must be cooperative before anything else imports them
+from gevent import monkey
+monkey.patch_all()
+
+# pylint: disable=wrong-import-position
+import os
+import logging
+
+os.environ.setdefault('DB_USE_PURE', 'true')
+
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+from flaskserver import app
+
+SERVER_HOST = os.getenv('SERVER_HOST', '0.0.0.0')
+SERVER_PORT = int(os.getenv('SERVER_PORT', '8000'))
+# Connections served at once, further clients wait in the listen backlog
+SERVER_MAX_CONNECTIONS = int(os.getenv('SERVER_MAX_CONNECTIONS', '10000'))
+
+
+def main():
+    """
+    Serve the app until interrupted.
+    """
+    server = WSGIServer((SERVER_HOST, SERVER_PORT), app, spawn=Pool(SERVER_MAX_CONNECTIONS))
+    logging.info("Serving on %s:%s with up to %s connections",
+                 SERVER_HOST, SERVER_PORT, SERVER_MAX_CONNECTIONS)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+This module reads and writes the annotated parking spots in a compact binary layout.
+Freehand spots are simplified to a few vertices, and the file is one flat int32 array
+that is read in a single call on load:
+    header    4 values: magic, format version, spot count, vertex count
+    spots     spot count rows of (spot id, flags, first vertex, vertex count)
+    vertices  vertex count rows of (x, y)
+Convert an old pickle layout with:
+    python backend/spotlayout.py convert backend/carSpots2.pkl backend/carSpots2.layout
+"""
+import argparse
+import os
+import pickle
+import tempfile
+from collections import namedtuple
+import cv2
+import numpy as np
+
+LAYOUT_MAGIC = 0x594C5350  # "PSLY" read as a little-endian int32
+LAYOUT_VERSION = 1
+HEADER_SIZE = 4
+FLAG_HANDICAP = 1
+# Polygons are simplified with Douglas-Peucker to within SIMPLIFY_EPSILON of their
+# perimeter, coarsening until they have at most MAX_SPOT_VERTICES vertices
+SIMPLIFY_EPSILON = 0.005
+MAX_SPOT_VERTICES = 16
+
+# Spot ids, flags and (first vertex, vertex count) of every spot, and all vertices.
+# The arrays are views of one array holding the whole file.
+SpotLayout = namedtuple('SpotLayout', ['ids', 'flags', 'spans', 'vertices'])
+
+
+def simplify_polygon(points, epsilon=SIMPLIFY_EPSILON, max_vertices=MAX_SPOT_VERTICES):
+    """
+    Simplify a polygon to at most max_vertices vertices.
+    Returns the vertices as an (N, 2) int32 array.
+    """
+    contour = np.asarray(points, dtype=np.int32).reshape(-1, 1, 2)
+    if len(contour) <= 3:
+        return contour.reshape(-1, 2)
+    tolerance = max(epsilon * cv2.arcLength(contour, True), 0.5)
+    simplified = cv2.approxPolyDP(contour, tolerance, True)
+    while len(simplified) > max_vertices:
+        tolerance *= 1.5
+        simplified = cv2.approxPolyDP(contour, tolerance, True)
+    if len(simplified) < 3:
+        # A degenerate stroke, keep the area it covered
+        simplified = cv2.boxPoints(cv2.minAreaRect(contour)).astype(np.int32)
+    return simplified.reshape(-1, 2)
+
+
+def save_layout(path, spots, simplify=True):
+    """
+    Write (points, is_handicap) spots to a binary layout file.
+    The file is replaced atomically, so readers never see a partial layout.
+    """
+    polygons = [simplify_polygon(points) if simplify else np.asarray(points, dtype=np.int32).reshape(-1, 2)
+                for points, _ in spots]
+    lengths = np.array([len(polygon) for polygon in polygons], dtype=np.int32)
+    table = np.zeros((len(spots), 4), dtype=np.int32)
+    table[:, 0] = np.arange(len(spots))
+    table[:, 1] = [FLAG_HANDICAP if is_handicap else 0 for _, is_handicap in spots]
+    table[:, 2] = np.concatenate([[0], np.cumsum(lengths)[:-1]]) if len(spots) else []
+    table[:, 3] = lengths
+    header = np.array([LAYOUT_MAGIC, LAYOUT_VERSION, len(spots), int(lengths.sum())], dtype='<i4')
+    vertices = np.concatenate(polygons) if polygons else np.zeros((0, 2), dtype=np.int32)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    descriptor, temporary = tempfile.mkstemp(dir=directory, prefix='.layout-')
+    try:
+        with os.fdopen(descriptor, 'wb') as file:
+            for array in (header, table, vertices):
+                file.write(array.astype('<i4').tobytes())
+        os.chmod(temporary, 0o644)
+        os.replace(temporary, path)
+    except BaseException:
+        os.remove(temporary)
+        raise
+
+
+def load_layout(path):
+    """
+    Read a binary layout file. Raises ValueError if it is not a layout file.
+    The file is read whole and closed rather than memory-mapped, since Windows
+    cannot replace a mapped file and save_layout replaces it while the detector runs.
+    """
+    data = np.fromfile(path, dtype='<i4')
+    if len(data) < HEADER_SIZE:
+        raise ValueError(f"{path} is too short to be a layout file")
+    magic, version, spot_count, vertex_count = (int(value) for value in data[:HEADER_SIZE])
+    if magic != LAYOUT_MAGIC:
+        raise ValueError(f"{path} is not a layout file")
+    if version != LAYOUT_VERSION:
+        raise ValueError(f"{path} has layout format version {version}, expected {LAYOUT_VERSION}")
+    if len(data) != HEADER_SIZE + 4 * spot_count + 2 * vertex_count:
+        raise ValueError(f"{path} is truncated")
+    table = data[HEADER_SIZE:HEADER_SIZE + 4 * spot_count].reshape(spot_count, 4)
+    vertices = data[HEADER_SIZE + 4 * spot_count:].reshape(vertex_count, 2)
+    return SpotLayout(table[:, 0], table[:, 1], table[:, 2:4], vertices)
+
+
+def layout_polygons(layout):
+    """
+    Return the vertices of every spot of a layout as views of its vertex array.
+    """
+    return [np.asarray(layout.vertices[start:start + count]) for start, count in layout.spans]
+
+
+def read_pickle_spots(path):
+    """
+    Read the (points, is_handicap) spots of an old pickle layout.
+    """
+    with open(path, "rb") as file:
+        return [(points, bool(is_handicap)) for points, is_handicap in pickle.load(file)]
+
+
+def main():
+    """
+    Convert pickle layouts or describe a layout file.
+    """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    convert = subparsers.add_parser('convert', help='convert a pickle layout to a binary layout')
+    convert.add_argument('source')
+    convert.add_argument('target')
+    info = subparsers.add_parser('info', help='describe a binary layout')
+    info.add_argument('path')
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        spots = read_pickle_spots(args.source)
+        save_layout(args.target, spots)
+        print(f"Wrote {len(spots)} spots with {sum(len(points) for points, _ in spots)} vertices "
+              f"as {len(load_layout(args.target).vertices)} vertices to {args.target}")
+    else:
+        layout = load_layout(args.path)
+        for spot_id, flags, (start, count) in zip(layout.ids, layout.flags, layout.spans):
+            kind = 'handicap' if flags & FLAG_HANDICAP else 'normal'
+            print(f"spot {spot_id}: {kind}, {count} vertices from {start}")
+
+
+if __name__ == "__main__":
+    main()
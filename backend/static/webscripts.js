@@ -23,6 +23,8 @@ function sendData() {
       // Storing parking data in sessionStorage for future use
       sessionStorage.setItem('parking', parking);
       sessionStorage.setItem('accPark', accPark);
+      // Storing the downscaled copy of the image to show on the next page
+      sessionStorage.setItem('preview', data.preview || '');
       // Redirecting user to the draw.html page after successful submission
       window.location.href = './static/draw.html';
     })
@@ -38,11 +40,18 @@ function showAmounts() {
     // Retrieving parking data from sessionStorage
     const parking = sessionStorage.getItem('parking');
     const accPark = sessionStorage.getItem('accPark');
+    const preview = sessionStorage.getItem('preview');
     // Displaying the parking amounts in the HTML document
     document.getElementById('park').innerHTML =
       'New regular parkingspots: ' + parking;
     document.getElementById('acc').innerHTML =
       'New accessible parkingspots: ' + accPark;
+    // Displaying the saved image
+    if (preview) {
+      const image = document.getElementById('preview');
+      image.src = preview;
+      image.hidden = false;
+    }
   });
 }
 
@@ -10,19 +10,36 @@ import os
 import time
 import logging
 import pickle
+import hashlib
+import json
+import queue
+import itertools
+import multiprocessing
+from multiprocessing import shared_memory
 import threading
+from collections import namedtuple
+from concurrent.futures import Future
+from contextlib import contextmanager
+from datetime import datetime, timezone
 import cv2
 import numpy as np
+import requests
 from ultralytics import YOLO
 from dotenv import load_dotenv
 from database import (
-    fetch_available_free_spots,
-    save_available_free_spots,
-    fetch_available_handicap_spots,
-    save_available_handicap_spots,
-    fetch_total_handicap_spots,
-    fetch_total_spots,
+    fetch_lot_snapshot,
+    save_free_counts,
+    save_occupancy_history,
+    save_spot_events,
 )
+try:
+    from spotlayout import FLAG_HANDICAP, layout_polygons, load_layout, read_pickle_spots, simplify_polygon
+except ImportError:
+    from backend.spotlayout import FLAG_HANDICAP, layout_polygons, load_layout, read_pickle_spots, simplify_polygon
+try:
+    from metrics import Counter, Histogram, start_http_server
+except ImportError:
+    from backend.metrics import Counter, Histogram, start_http_server
 
 sys.path.insert(0, './backend')
 
@@ -31,24 +48,130 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 
 VEHICLE_CLASSES = {2, 3, 7}  # Car, motorcycle, truck
+CONFIDENCE_THRESHOLD = 0.25
+TILE_SIZE = 640  # Largest square model input a region is letterboxed into
+# Model input sizes a spot crop can be resized to: each crop goes to the smallest size
+# its longest side fits without downscaling (or TILE_SIZE) and is upscaled at most
+# ROI_MAX_UPSCALE times. A crop that stays smaller after the cap is padded into the
+# smallest size it fits, not upscaled. Crops of the same input size are batched together.
+ROI_INPUT_SIZES = tuple(sorted(int(size) for size in os.getenv('ROI_INPUT_SIZES', '160,320,640').split(',')))
+ROI_MAX_UPSCALE = float(os.getenv('ROI_MAX_UPSCALE', '4'))
+MAX_BATCH_SIZE = int(os.getenv('MAX_BATCH_SIZE', '16'))
+# "roi" runs the model on every spot's crop, "full" runs it once on the whole frame
+# split into a DETECTION_TILES grid (e.g. "2x2") of windows overlapping by TILE_OVERLAP
+DETECTION_MODE = os.getenv('DETECTION_MODE', 'roi')
+DETECTION_TILES = os.getenv('DETECTION_TILES', '1x1')
+TILE_OVERLAP = float(os.getenv('TILE_OVERLAP', '0.2'))
+# Boxes covering at least OVERLAP_THRESHOLD of the smaller one are the same vehicle;
+# with CLASS_AWARE_SUPPRESSION only boxes of the same class suppress each other
+OVERLAP_THRESHOLD = 0.80
+CLASS_AWARE_SUPPRESSION = os.getenv('CLASS_AWARE_SUPPRESSION', 'false').lower() == 'true'
+SUPPRESSION_BLOCK_SIZE = 1024
+# The spot id label map is stored at 1/LABEL_MAP_DOWNSCALE of the frame resolution
+LABEL_MAP_DOWNSCALE = int(os.getenv('LABEL_MAP_DOWNSCALE', '2'))
+# Binary spot layout written by the annotation tool, see spotlayout.py.
+# An old pickle layout is still read and simplified on load.
+LAYOUT_PATH = os.getenv('LAYOUT_PATH', './backend/carSpots2.layout')
+# Seconds between checks of the layout files for changes, which are swapped in without a restart
+LAYOUT_POLL_INTERVAL = float(os.getenv('LAYOUT_POLL_INTERVAL', '2'))
+# A spot is re-inferred when the mean absolute difference of its grayscale thumbnail
+# exceeds CHANGE_THRESHOLD (0-255); every FULL_REFRESH_CYCLES cycles all spots are inferred
+CHANGE_THRESHOLD = float(os.getenv('CHANGE_THRESHOLD', '6'))
+FULL_REFRESH_CYCLES = int(os.getenv('FULL_REFRESH_CYCLES', '10'))
+THUMBNAIL_SIZE = 16
+# Spot occupancy is smoothed with an EWMA of weight SMOOTHING_ALPHA per observation; a spot
+# turns occupied above OCCUPIED_THRESHOLD and free again below FREE_THRESHOLD
+SMOOTHING_ALPHA = float(os.getenv('SMOOTHING_ALPHA', '0.5'))
+OCCUPIED_THRESHOLD = 0.7
+FREE_THRESHOLD = 0.3
+FRAME_INTERVAL = int(os.getenv('FRAME_INTERVAL', '30'))  # Seconds between detection cycles
+RECONNECT_DELAY = 5  # Initial wait before reopening a dropped stream, doubled up to a minute
+# YOLOv8 size (n, s, m, l or x) and runtime: "auto" loads the first exported artifact
+# found in MODEL_DIR in RUNTIME_ARTIFACTS order, falling back to the PyTorch weights
+MODEL_VARIANT = os.getenv('MODEL_VARIANT', 'l')
+MODEL_RUNTIME = os.getenv('MODEL_RUNTIME', 'auto')
+MODEL_DIR = os.getenv('MODEL_DIR', '.')
+RUNTIME_ARTIFACTS = {
+    'openvino': '{name}_openvino_model',
+    'onnx': '{name}.onnx',
+    'torchscript': '{name}.torchscript',
+    'pytorch': '{name}.pt',
+}
+# Optional JSON file listing the cameras to run; without it SECURE_URL is the only camera
+CAMERAS_CONFIG = os.getenv('CAMERAS_CONFIG')
+# "thread" serves the model from worker threads of this process, "process" from
+# INFERENCE_WORKERS separate processes fed through a shared memory ring of tiles
+INFERENCE_BACKEND = os.getenv('INFERENCE_BACKEND', 'thread')
+# Number of inference workers, each holding its own copy of the model
+INFERENCE_WORKERS = int(os.getenv('INFERENCE_WORKERS', '1'))
+# Seconds a camera waits for the inference processes before giving up on a frame
+INFERENCE_TIMEOUT = float(os.getenv('INFERENCE_TIMEOUT', '120'))
+WORKER_CHECK_INTERVAL = 1  # Seconds between checks that the inference processes are alive
+# Endpoint of the Flask server told about new counts so it drops its cached ones,
+# e.g. http://localhost:8000/cache/invalidate, with its CACHE_INVALIDATE_TOKEN
+CACHE_INVALIDATE_URL = os.getenv('CACHE_INVALIDATE_URL')
+CACHE_INVALIDATE_TOKEN = os.getenv('CACHE_INVALIDATE_TOKEN')
+# Occupancy history rows are buffered in memory and written every HISTORY_BATCH_SIZE
+# rows or HISTORY_FLUSH_INTERVAL seconds; past HISTORY_MAX_ROWS the oldest are dropped
+HISTORY_ENABLED = os.getenv('HISTORY_ENABLED', 'true').lower() == 'true'
+HISTORY_BATCH_SIZE = int(os.getenv('HISTORY_BATCH_SIZE', '500'))
+HISTORY_FLUSH_INTERVAL = float(os.getenv('HISTORY_FLUSH_INTERVAL', '60'))
+HISTORY_MAX_ROWS = 100000
+# Port of the HTTP server the detector serves its metrics on at /metrics, 0 turns it off
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108') or 0)
 MODEL = None
 CAPTURE = None
+STOP_EVENT = threading.Event()
 NORMAL_POINTS_NP = None
 HANDICAP_POINTS_NP = None
+# Compiled form of the spot layout, rebuilt when the layout file or frame size changes.
+# version is bumped on every rebuild so per-spot state can tell when spot ids moved.
+LAYOUT_CACHE = {
+    'path': LAYOUT_PATH, 'signature': None, 'frame_shape': None, 'version': 0,
+    'normal_points': None, 'handicap_points': None, 'normal': [], 'handicap': [],
+    'labels': None, 'is_handicap': np.zeros(0, dtype=bool),
+}
+
+STAGE_SECONDS = Histogram(
+    'parkspotter_detector_stage_seconds', 'Time spent in each stage of a detection cycle.',
+    ['camera', 'stage'])
+INFERENCE_BATCH_SECONDS = Histogram(
+    'parkspotter_inference_batch_seconds', 'Time of one model call on a batch of tiles of one input size.',
+    ['size'])
+FRAMES = Counter(
+    'parkspotter_frames_total', 'Frames of the streams, decoded for a cycle or grabbed and skipped.',
+    ['camera', 'outcome'])
+STREAM_RECONNECTS = Counter(
+    'parkspotter_stream_reconnects_total', 'Attempts to reopen a video stream.', ['camera'])
+SPOT_INFERENCES = Counter(
+    'parkspotter_spot_inferences_total', 'Spots run through the model or skipped by the change gate.',
+    ['camera', 'outcome'])
+DETECTIONS = Counter(
+    'parkspotter_detections_total', 'Vehicles detected in the parking spots.', ['camera'])
+CYCLE_ERRORS = Counter(
+    'parkspotter_cycle_errors_total', 'Detection cycles that failed.', ['camera'])
+
+# Precomputed crop of a single spot: bounding rect (x, y, w, h) clipped to the frame,
+# binary mask of the rect's size, resize factor and resize interpolation
+CompiledSpot = namedtuple('CompiledSpot', ['rect', 'mask', 'scale', 'interpolation'])
 
 def load_resources():
     """
-    Load the model, video feed, and pickle file.
+    Load the model, video feed, and spot layout.
     """
-    global MODEL, CAPTURE, NORMAL_POINTS_NP, HANDICAP_POINTS_NP
-    global NORMAL_ANNOTATED_CENTROIDS, NORMAL_CENTROID_TO_POINTS
-    global HANDICAP_ANNOTATED_CENTROIDS, HANDICAP_CENTROID_TO_POINTS
+    global MODEL, CAPTURE
 
-    try:
-        MODEL = YOLO("yolov8l.pt")
-    except IOError as e:
-        logging.error("Error loading model: %s", e)
-        os._exit(1)
+    # The process backend loads the model in its own workers
+    if INFERENCE_BACKEND != 'process':
+        try:
+            MODEL = load_model()
+        except IOError as e:
+            logging.error("Error loading model: %s", e)
+            os._exit(1)
+
+    # Camera definitions open their own streams and layouts
+    if CAMERAS_CONFIG:
+        return
 
     try:
         video_path = os.getenv('SECURE_URL')
@@ -59,32 +182,182 @@ def load_resources():
         logging.error("Error opening video file: %s", e)
         os._exit(1)
 
-    # Load points only if they haven't been loaded yet
-    if NORMAL_POINTS_NP is None or HANDICAP_POINTS_NP is None:
-        try:
-            with open("./backend/carSpots2.pkl", "rb") as file:
-                POINTS = pickle.load(file)
-                for point_group, is_handicap in POINTS:
-                    if is_handicap:
-                        if HANDICAP_POINTS_NP is None:
-                            HANDICAP_POINTS_NP = []
-                        HANDICAP_POINTS_NP.append(np.array(point_group))
-                    else:
-                        if NORMAL_POINTS_NP is None:
-                            NORMAL_POINTS_NP = []
-                        NORMAL_POINTS_NP.append(np.array(point_group))
-        except (FileNotFoundError, pickle.PickleError) as e:
-            logging.error("Error loading points: %s", e)
-
-    # Create numpy arrays and calculate centroids for normal and handicap spots (if loaded)
-    if NORMAL_POINTS_NP is not None:
-        NORMAL_POINTS_NP[:] = [np.array(point_group) for point_group in NORMAL_POINTS_NP]
-        NORMAL_ANNOTATED_CENTROIDS = calculate_centroids(NORMAL_POINTS_NP)
-        NORMAL_CENTROID_TO_POINTS = dict(zip(NORMAL_ANNOTATED_CENTROIDS, NORMAL_POINTS_NP))
-    if HANDICAP_POINTS_NP is not None:
-        HANDICAP_POINTS_NP[:] = [np.array(point_group) for point_group in HANDICAP_POINTS_NP]
-        HANDICAP_ANNOTATED_CENTROIDS = calculate_centroids(HANDICAP_POINTS_NP)
-        HANDICAP_CENTROID_TO_POINTS = dict(zip(HANDICAP_ANNOTATED_CENTROIDS, HANDICAP_POINTS_NP))
+    frame_shape = (int(CAPTURE.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                   int(CAPTURE.get(cv2.CAP_PROP_FRAME_WIDTH)))
+    refresh_layout(frame_shape if all(frame_shape) else None)
+
+def model_artifact(variant=MODEL_VARIANT, runtime=MODEL_RUNTIME, model_dir=MODEL_DIR):
+    """
+    Return the path of the model weights to load for a variant and runtime.
+    """
+    name = f"yolov8{variant}"
+    if runtime != 'auto':
+        return os.path.join(model_dir, RUNTIME_ARTIFACTS[runtime].format(name=name))
+    for artifact in RUNTIME_ARTIFACTS.values():
+        path = os.path.join(model_dir, artifact.format(name=name))
+        if os.path.exists(path):
+            return path
+    # Missing PyTorch weights are downloaded by ultralytics
+    return os.path.join(model_dir, RUNTIME_ARTIFACTS['pytorch'].format(name=name))
+
+def load_model(path=None):
+    """
+    Load a detection model from PyTorch weights or an exported ONNX, OpenVINO or TorchScript artifact.
+    All of them return the same ultralytics results.
+    """
+    path = model_artifact() if path is None else path
+    logging.info("Loading model %s", path)
+    return YOLO(path, task='detect')
+
+def layout_signature(path, cached=None):
+    """
+    Return the modification time and content hash of the layout file,
+    or None if the file does not exist. The hash is reused while the mtime matches cached.
+    """
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    if cached is not None and cached[0] == mtime:
+        return cached
+    with open(path, "rb") as file:
+        return mtime, hashlib.sha1(file.read()).hexdigest()
+
+def new_layout(path):
+    """
+    Return an empty layout cache for the given layout file, filled in by refresh_layout.
+    """
+    layout = dict(LAYOUT_CACHE)
+    layout.update(path=path, signature=None, frame_shape=None, version=0,
+                  normal_points=None, handicap_points=None)
+    return layout
+
+def read_points(path=LAYOUT_PATH):
+    """
+    Read the annotated spots from the layout file.
+    Returns the normal and the handicap polygons as lists of numpy arrays.
+    """
+    normal_points, handicap_points = [], []
+    try:
+        if path.endswith('.pkl'):
+            spots = [(simplify_polygon(points), is_handicap) for points, is_handicap in read_pickle_spots(path)]
+        else:
+            layout = load_layout(path)
+            spots = zip(layout_polygons(layout), layout.flags & FLAG_HANDICAP)
+        for polygon, is_handicap in spots:
+            if is_handicap:
+                handicap_points.append(polygon)
+            else:
+                normal_points.append(polygon)
+    except (FileNotFoundError, EOFError, ValueError, pickle.PickleError) as e:
+        logging.error("Error loading points: %s", e)
+    return normal_points, handicap_points
+
+def roi_input_size(length, sizes=ROI_INPUT_SIZES):
+    """
+    Return the smallest model input size that fits a region side of the given length,
+    or the largest size if none does.
+    """
+    for size in sizes:
+        if length <= size:
+            return size
+    return sizes[-1]
+
+def compile_spots(points_np, frame_shape, sizes=ROI_INPUT_SIZES, max_upscale=ROI_MAX_UPSCALE):
+    """
+    Precompute the crop rectangle, cropped mask, scale and interpolation of every spot.
+    The scale resizes the crop's longest side to its model input size.
+    """
+    frame_height, frame_width = frame_shape[:2]
+    compiled = []
+    for points in points_np:
+        x, y, w, h = cv2.boundingRect(points)
+        x0, y0 = min(max(x, 0), frame_width - 1), min(max(y, 0), frame_height - 1)
+        x1, y1 = min(x + w, frame_width), min(y + h, frame_height)
+        w, h = max(x1 - x0, 1), max(y1 - y0, 1)
+        mask = np.zeros((h, w), dtype=np.uint8)
+        cv2.drawContours(mask, [points], -1, (255), thickness=cv2.FILLED, offset=(-x0, -y0))
+        scale = min(roi_input_size(max(w, h), sizes) / max(w, h), max_upscale)
+        interpolation = cv2.INTER_LINEAR if scale >= 1 else cv2.INTER_AREA
+        compiled.append(CompiledSpot((x0, y0, w, h), mask, scale, interpolation))
+    return compiled
+
+def set_default_points(normal_points, handicap_points):
+    """
+    Make the given spots the module's default camera spots.
+    """
+    global NORMAL_POINTS_NP, HANDICAP_POINTS_NP
+    global NORMAL_ANNOTATED_CENTROIDS, NORMAL_CENTROID_TO_POINTS
+    global HANDICAP_ANNOTATED_CENTROIDS, HANDICAP_CENTROID_TO_POINTS
+    NORMAL_POINTS_NP, HANDICAP_POINTS_NP = normal_points, handicap_points
+    NORMAL_ANNOTATED_CENTROIDS = calculate_centroids(NORMAL_POINTS_NP)
+    NORMAL_CENTROID_TO_POINTS = dict(zip(NORMAL_ANNOTATED_CENTROIDS, NORMAL_POINTS_NP))
+    HANDICAP_ANNOTATED_CENTROIDS = calculate_centroids(HANDICAP_POINTS_NP)
+    HANDICAP_CENTROID_TO_POINTS = dict(zip(HANDICAP_ANNOTATED_CENTROIDS, HANDICAP_POINTS_NP))
+
+def refresh_layout(frame_shape=None, layout=None, reload=True):
+    """
+    Reload the spot layout if its file changed and recompile it for the given frame shape.
+    Without a layout the module's default camera layout is refreshed.
+    Without reload the file is only read if the layout was never loaded.
+    """
+    layout = LAYOUT_CACHE if layout is None else layout
+
+    cached_signature = layout['signature']
+    if reload or layout['normal_points'] is None:
+        signature = layout_signature(layout['path'], cached_signature)
+    else:
+        signature = cached_signature
+    changed = (layout['normal_points'] is None
+               or (signature and signature[1]) != (cached_signature and cached_signature[1]))
+    if changed:
+        normal_points, handicap_points = read_points(layout['path'])
+        layout['normal_points'], layout['handicap_points'] = normal_points, handicap_points
+        logging.info("Loaded %s normal and %s handicap spots from %s",
+                     len(normal_points), len(handicap_points), layout['path'])
+        if layout is LAYOUT_CACHE:
+            set_default_points(normal_points, handicap_points)
+    layout['signature'] = signature
+
+    if frame_shape is not None and (changed or layout['frame_shape'] != tuple(frame_shape[:2])):
+        normal_points, handicap_points = layout['normal_points'], layout['handicap_points']
+        layout['frame_shape'] = tuple(frame_shape[:2])
+        layout['normal'] = compile_spots(normal_points, frame_shape)
+        layout['handicap'] = compile_spots(handicap_points, frame_shape)
+        layout['labels'] = build_label_map(
+            normal_points, handicap_points, frame_shape, LABEL_MAP_DOWNSCALE)
+        layout['is_handicap'] = np.array(
+            [False] * len(normal_points) + [True] * len(handicap_points), dtype=bool)
+        layout['version'] += 1
+
+def build_label_map(normal_points, handicap_points, frame_shape, downscale=1):
+    """
+    Rasterize all spots into one image holding the spot id of every pixel, or -1 outside spots.
+    Normal spots get ids 0..n-1 and handicap spots n..n+m-1.
+    Where spots overlap the normal spot wins.
+    """
+    height = -(-frame_shape[0] // downscale)
+    width = -(-frame_shape[1] // downscale)
+    spot_count = len(normal_points) + len(handicap_points)
+    dtype = np.int16 if spot_count < np.iinfo(np.int16).max else np.int32
+    labels = np.full((height, width), -1, dtype=dtype)
+    spots = list(enumerate(normal_points))
+    spots = [(len(normal_points) + i, points) for i, points in enumerate(handicap_points)] + spots
+    for spot_id, points in spots:
+        scaled = (np.asarray(points).reshape(-1, 2) / downscale).astype(np.int32)
+        cv2.fillPoly(labels, [scaled], int(spot_id))
+    return labels
+
+def lookup_spots(centroids, labels, downscale=1):
+    """
+    Resolve an (N, 2) array of frame coordinates to spot ids, -1 for points outside every spot.
+    """
+    centroids = np.asarray(centroids, dtype=int).reshape(-1, 2) // downscale
+    x, y = centroids[:, 0], centroids[:, 1]
+    inside = (x >= 0) & (y >= 0) & (x < labels.shape[1]) & (y < labels.shape[0])
+    spot_ids = np.full(len(centroids), -1, dtype=int)
+    spot_ids[inside] = labels[y[inside], x[inside]]
+    return spot_ids
 
 def calculate_centroids(points_np):
     """
@@ -132,7 +405,46 @@ def boxes_overlap(box1, box2):
 
     # Calculate the overlap ratio
     overlap_ratio = intersection_area / min(area_box1, area_box2)
-    return overlap_ratio >= 0.80
+    return overlap_ratio >= OVERLAP_THRESHOLD
+
+def overlap_matrix(boxes_a, boxes_b):
+    """
+    Compute the intersection over the smaller box's area for every pair of boxes.
+    Returns an (N, M) array, the vectorized form of the ratio in boxes_overlap.
+    """
+    boxes_a = np.asarray(boxes_a, dtype=np.float32).reshape(-1, 4)
+    boxes_b = np.asarray(boxes_b, dtype=np.float32).reshape(-1, 4)
+    x_left = np.maximum(boxes_a[:, None, 0], boxes_b[None, :, 0])
+    y_top = np.maximum(boxes_a[:, None, 1], boxes_b[None, :, 1])
+    x_right = np.minimum(boxes_a[:, None, 2], boxes_b[None, :, 2])
+    y_bottom = np.minimum(boxes_a[:, None, 3], boxes_b[None, :, 3])
+    intersection_area = np.clip(x_right - x_left, 0, None) * np.clip(y_bottom - y_top, 0, None)
+
+    area_a = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 3] - boxes_a[:, 1])
+    area_b = (boxes_b[:, 2] - boxes_b[:, 0]) * (boxes_b[:, 3] - boxes_b[:, 1])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return intersection_area / np.minimum(area_a[:, None], area_b[None, :])
+
+def suppress_duplicates(boxes, class_ids=None, threshold=OVERLAP_THRESHOLD,
+                        block_size=SUPPRESSION_BLOCK_SIZE):
+    """
+    Drop boxes that overlap an earlier kept box, like checking each box with
+    boxes_overlap against the boxes kept so far.
+    Pass class_ids to only suppress boxes of the same class.
+    The overlap matrix is computed block by block to bound memory.
+    Returns a boolean mask of the boxes to keep.
+    """
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+    keep = np.zeros(len(boxes), dtype=bool)
+    for start in range(0, len(boxes), block_size):
+        end = min(start + block_size, len(boxes))
+        duplicates = overlap_matrix(boxes[start:end], boxes[:end]) >= threshold
+        if class_ids is not None:
+            class_ids = np.asarray(class_ids)
+            duplicates &= class_ids[start:end, None] == class_ids[None, :end]
+        for i in range(start, end):
+            keep[i] = not np.any(duplicates[i - start, :i] & keep[:i])
+    return keep
 
 def box_in_regions(box, normal_regions, handicap_regions):
     """
@@ -148,100 +460,1168 @@ def box_in_regions(box, normal_regions, handicap_regions):
         return True
     return False
 
+def box_centroids(boxes):
+    """
+    Return the integer centroids of an (N, 4) array of xyxy boxes.
+    """
+    boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+    return np.stack([(boxes[:, 0] + boxes[:, 2]) / 2, (boxes[:, 1] + boxes[:, 3]) / 2],
+                    axis=1).astype(int)
+
+def frame_windows(frame_shape, grid=(1, 1), overlap=TILE_OVERLAP):
+    """
+    Split the frame into a grid of (x, y, w, h) windows that overlap their neighbours.
+    """
+    frame_height, frame_width = frame_shape[:2]
+    rows, cols = grid
+    window_w = int(np.ceil(frame_width / (cols - (cols - 1) * overlap)))
+    window_h = int(np.ceil(frame_height / (rows - (rows - 1) * overlap)))
+    windows = []
+    for row in range(rows):
+        for col in range(cols):
+            x = min(int(round(col * window_w * (1 - overlap))), frame_width - window_w)
+            y = min(int(round(row * window_h * (1 - overlap))), frame_height - window_h)
+            windows.append((max(x, 0), max(y, 0), min(window_w, frame_width), min(window_h, frame_height)))
+    return windows
+
+def parse_grid(grid):
+    """
+    Parse a grid specification such as "2x3" into (rows, cols).
+    """
+    rows, cols = (int(value) for value in grid.lower().split('x'))
+    return rows, cols
 
-def get_regions_of_interest(frame, points_np):
+def full_frame_regions(frame, grid=(1, 1), overlap=TILE_OVERLAP):
     """
-    This function extracts the regions of interest from the frame based on the provided points.
+    Split the frame into overlapping windows to run the model on.
+    Returns the windows and their scales and offsets like get_regions_of_interest.
+    """
+    regions, scales_and_offsets = [], []
+    for x, y, w, h in frame_windows(frame.shape, grid, overlap):
+        regions.append(frame[y:y+h, x:x+w])
+        scales_and_offsets.append((1, (x, y)))
+    return regions, scales_and_offsets
+
+def get_regions_of_interest(frame, compiled_spots):
+    """
+    This function extracts the regions of interest from the frame based on the compiled spots.
     """
     regions_of_interest = []
     scales_and_offsets = []
-    for points in points_np:
-        mask = np.zeros(frame.shape[:2], dtype=np.uint8)
-        cv2.drawContours(mask, [points], -1, (255), thickness=cv2.FILLED)
-        roi = cv2.bitwise_and(frame, frame, mask=mask)
-        x, y, w, h = cv2.boundingRect(points)
-        scale = 2*max(frame.shape[0] // h, frame.shape[1] // w)
-        offset = (x, y)
-        roi = cv2.resize(roi[y:y+h, x:x+w], None, fx=scale, fy=scale)
+    for spot in compiled_spots:
+        x, y, w, h = spot.rect
+        crop = frame[y:y+h, x:x+w]
+        roi = cv2.bitwise_and(crop, crop, mask=spot.mask)
+        roi = cv2.resize(roi, None, fx=spot.scale, fy=spot.scale, interpolation=spot.interpolation)
         regions_of_interest.append(roi)
-        scales_and_offsets.append((scale, offset))
+        scales_and_offsets.append((spot.scale, (x, y)))
     return regions_of_interest, scales_and_offsets
 
+def letterbox(image, size=TILE_SIZE, upscale=True):
+    """
+    Resize an image to fit inside a square tile while keeping its aspect ratio.
+    Without upscale an image smaller than the tile is only padded.
+    Returns the tile, the resize ratio and the (x, y) padding added to the image.
+    """
+    height, width = image.shape[:2]
+    ratio = min(size / height, size / width, np.inf if upscale else 1)
+    new_width = max(1, round(width * ratio))
+    new_height = max(1, round(height * ratio))
+    interpolation = cv2.INTER_AREA if ratio < 1 else cv2.INTER_LINEAR
+    resized = cv2.resize(image, (new_width, new_height), interpolation=interpolation)
+    pad_x = (size - new_width) // 2
+    pad_y = (size - new_height) // 2
+    tile = np.full((size, size, 3), 114, dtype=np.uint8)
+    tile[pad_y:pad_y + new_height, pad_x:pad_x + new_width] = resized
+    return tile, ratio, (pad_x, pad_y)
+
+def result_arrays(result):
+    """
+    Return the boxes, class ids and confidences of one model result as numpy arrays.
+    """
+    return (result.boxes.xyxy.cpu().numpy().reshape(-1, 4),
+            result.boxes.cls.cpu().numpy().reshape(-1),
+            result.boxes.conf.cpu().numpy().reshape(-1))
+
+def map_detections(xyxy, cls, conf, placement):
+    """
+    Keep the confident vehicle detections of one tile and map them back to frame coordinates.
+    placement is the (ratio, padding, scale, offset) the region was tiled with.
+    """
+    ratio, padding, scale, offset = placement
+    keep = np.isin(cls, list(VEHICLE_CLASSES)) & (conf >= CONFIDENCE_THRESHOLD)
+    # Undo the letterbox, then the region upscale, then the crop offset
+    xyxy = (xyxy[keep] - np.array([padding[0], padding[1], padding[0], padding[1]])) / ratio
+    xyxy = xyxy / scale + np.array([offset[0], offset[1], offset[0], offset[1]])
+    return xyxy, cls[keep], conf[keep]
+
+def merge_detections(per_region):
+    """
+    Concatenate the (boxes, class ids, confidences) of every region
+    into the arrays returned by run_batched_inference.
+    """
+    if not per_region:
+        return np.empty((0, 4)), np.empty(0), np.empty(0), np.empty(0, dtype=int)
+    return (np.concatenate([boxes for boxes, _, _ in per_region]).reshape(-1, 4),
+            np.concatenate([cls for _, cls, _ in per_region]),
+            np.concatenate([conf for _, _, conf in per_region]),
+            np.concatenate([np.full(len(boxes), i) for i, (boxes, _, _) in enumerate(per_region)]))
+
+def group_by_input_size(regions, sizes=ROI_INPUT_SIZES):
+    """
+    Group the indices of the regions by the model input size they are letterboxed into.
+    """
+    groups = {}
+    for index, region in enumerate(regions):
+        groups.setdefault(roi_input_size(max(region.shape[:2]), sizes), []).append(index)
+    return groups
+
+def run_batched_inference(model, regions, scales_and_offsets, batch_size=MAX_BATCH_SIZE,
+                          sizes=ROI_INPUT_SIZES):
+    """
+    Run the model on all regions of interest in bounded-size batches of one input size.
+    Returns the vehicle boxes mapped back to frame coordinates,
+    their class ids and confidences, and the index of the region each came from.
+    """
+    per_region = [None] * len(regions)
+    for size, indices in group_by_input_size(regions, sizes).items():
+        for start in range(0, len(indices), batch_size):
+            batch = indices[start:start + batch_size]
+            tiles, placements = [], []
+            for index in batch:
+                scale, offset = scales_and_offsets[index]
+                # Regions come scaled by compile_spots, a second upscale would defeat ROI_MAX_UPSCALE
+                tile, ratio, padding = letterbox(regions[index], size, upscale=False)
+                tiles.append(tile)
+                placements.append((ratio, padding, scale, offset))
+
+            with INFERENCE_BATCH_SECONDS.time(size=size):
+                results = model(tiles, imgsz=size)
+            for index, result, placement in zip(batch, results, placements):
+                per_region[index] = map_detections(*result_arrays(result), placement)
+    return merge_detections(per_region)
+
+def spot_thumbnail(frame, spot, size=THUMBNAIL_SIZE):
+    """
+    Return a small grayscale thumbnail of a compiled spot's masked crop.
+    """
+    x, y, w, h = spot.rect
+    crop = frame[y:y+h, x:x+w]
+    gray = cv2.cvtColor(cv2.bitwise_and(crop, crop, mask=spot.mask), cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, (size, size), interpolation=cv2.INTER_AREA).astype(np.int16)
+
+class ChangeGate:
+    """
+    This class remembers what every spot looked like when it was last inferred
+    and the detections found in it, so unchanged spots can skip inference.
+    """
+
+    def __init__(self, threshold=CHANGE_THRESHOLD, refresh_cycles=FULL_REFRESH_CYCLES):
+        self.threshold = threshold
+        self.refresh_cycles = refresh_cycles
+        self.inferred = 0
+        self.skipped = 0
+        self.layout_version = None
+        self.reset()
+
+    def reset(self):
+        """
+        Forget all spots, for example after the layout changed.
+        """
+        self.cycle = 0
+        self.thumbnails = {}
+        self.detections = {}
+        self.pending = {}
+
+    @property
+    def skip_ratio(self):
+        """
+        Share of spot inferences skipped since start.
+        """
+        total = self.inferred + self.skipped
+        return self.skipped / total if total else 0.0
+
+    def select(self, frame, spots, all_or_nothing=False):
+        """
+        Return the indices of the spots that changed and have to be inferred again.
+        With all_or_nothing every spot is returned as soon as one of them changed.
+        """
+        forced = self.refresh_cycles <= 1 or self.cycle % self.refresh_cycles == 0
+        self.cycle += 1
+        thumbnails = [spot_thumbnail(frame, spot) for spot in spots]
+        changed = [
+            i for i, thumbnail in enumerate(thumbnails)
+            if forced or i not in self.thumbnails
+            or np.mean(np.abs(thumbnail - self.thumbnails[i])) > self.threshold
+        ]
+        if all_or_nothing and changed:
+            changed = list(range(len(spots)))
+        self.pending = {i: thumbnails[i] for i in changed}
+        self.inferred += len(changed)
+        self.skipped += len(spots) - len(changed)
+        return changed
+
+    def update(self, indices, detections):
+        """
+        Store the detections of the inferred spots. detections is the output of
+        run_batched_inference over the spots in indices, in the same order.
+        Returns the boxes and class ids of all spots, cached ones included.
+        """
+        boxes, class_ids, _, region_ids = detections
+        for position, i in enumerate(indices):
+            found = region_ids == position
+            self.detections[i] = (boxes[found], class_ids[found])
+            self.thumbnails[i] = self.pending.pop(i)
+        if not self.detections:
+            return np.empty((0, 4)), np.empty(0)
+        cached = [self.detections[i] for i in sorted(self.detections)]
+        return (np.concatenate([spot_boxes for spot_boxes, _ in cached]),
+                np.concatenate([spot_classes for _, spot_classes in cached]))
+
+CHANGE_GATE = ChangeGate()
+
+@contextmanager
+def timed(timings, stage):
+    """
+    Add the milliseconds spent in the with block to timings[stage], if timings is a dict.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + (time.perf_counter() - start) * 1000
+
+def count_vehicles(frame, mode=DETECTION_MODE, tiles=DETECTION_TILES,
+                   layout=None, gate=None, infer=None, timings=None):
+    """
+    Detect the vehicles parked in the annotated spots of a frame.
+    Only spots that changed since they were last inferred go through the model.
+    The layout, change gate and inference function default to the module's single camera;
+    infer takes regions and their scales and offsets and returns run_batched_inference output.
+    With a timings dict the milliseconds spent in the "roi", "inference" and
+    "postprocess" stages are added to it.
+    Returns the number of cars in normal and in handicap spots,
+    and the occupancy of every spot in label map order.
+    """
+    layout = LAYOUT_CACHE if layout is None else layout
+    gate = CHANGE_GATE if gate is None else gate
+    if infer is None:
+        def infer(regions, scales_and_offsets):
+            return run_batched_inference(MODEL, regions, scales_and_offsets)
+
+    with timed(timings, 'roi'):
+        # A changed layout file is picked up by LayoutWatcher, here it is only compiled for the frame
+        refresh_layout(frame.shape, layout, reload=False)
+        if gate.layout_version != layout['version']:
+            gate.reset()
+            gate.layout_version = layout['version']
+        spots = layout['normal'] + layout['handicap']
+        changed = gate.select(frame, spots, all_or_nothing=mode == 'full')
+        if mode == 'full':
+            regions = full_frame_regions(frame, parse_grid(tiles)) if changed else None
+        else:
+            regions = get_regions_of_interest(frame, [spots[i] for i in changed])
+
+    with timed(timings, 'inference'):
+        if mode == 'full':
+            # One pass covers every spot, so its detections are all stored under the first spot
+            detections = (np.empty((0, 4)), np.empty(0), np.empty(0), np.empty(0, dtype=int))
+            if regions is not None:
+                boxes, class_ids, confidences, _ = infer(*regions)
+                detections = (boxes, class_ids, confidences, np.zeros(len(boxes), dtype=int))
+        else:
+            detections = infer(*regions)
+
+    with timed(timings, 'postprocess'):
+        boxes, class_ids = gate.update(changed, detections)
+        logging.info("Inferred %s of %s spots, skip ratio %.2f",
+                     len(changed), len(spots), gate.skip_ratio)
+
+        labels, is_handicap = layout['labels'], layout['is_handicap']
+        spot_ids = lookup_spots(box_centroids(boxes), labels, LABEL_MAP_DOWNSCALE)
+
+        in_spot = spot_ids >= 0
+        keep = suppress_duplicates(
+            boxes[in_spot], class_ids[in_spot] if CLASS_AWARE_SUPPRESSION else None)
+        spot_ids = spot_ids[in_spot][keep]
+
+        occupancy = np.zeros(len(is_handicap), dtype=bool)
+        occupancy[spot_ids] = True
+        total_handicap_cars = int(is_handicap[spot_ids].sum())
+        total_normal_cars = len(spot_ids) - total_handicap_cars
+
+    return total_normal_cars, total_handicap_cars, occupancy
+
+class OccupancyTracker:
+    """
+    This class smooths the per-frame occupancy of every spot over time.
+    Each spot keeps an exponentially weighted confidence of being occupied and
+    only switches state when the confidence crosses the hysteresis thresholds,
+    so a single missed or spurious detection does not flip it.
+    """
+
+    def __init__(self, alpha=SMOOTHING_ALPHA, occupied_threshold=OCCUPIED_THRESHOLD,
+                 free_threshold=FREE_THRESHOLD):
+        self.alpha = alpha
+        self.occupied_threshold = occupied_threshold
+        self.free_threshold = free_threshold
+        self.confidence = None
+        self.states = None
+
+    def update(self, occupancy):
+        """
+        Add one frame's occupancy and return the indices of the spots that changed state.
+        """
+        occupancy = np.asarray(occupancy, dtype=bool)
+        if self.confidence is None or len(self.confidence) != len(occupancy):
+            # First frame or a new layout: trust the observation as it is
+            self.confidence = occupancy.astype(float)
+            self.states = occupancy.copy()
+            return np.arange(len(occupancy))
+
+        self.confidence = (1 - self.alpha) * self.confidence + self.alpha * occupancy
+        previous = self.states.copy()
+        self.states[self.confidence >= self.occupied_threshold] = True
+        self.states[self.confidence <= self.free_threshold] = False
+        return np.flatnonzero(self.states != previous)
+
+class FrameGrabber:
+    """
+    This class keeps a video stream drained in a background thread.
+    Frames are only grabbed, not decoded, until read() asks for the latest one,
+    and the stream is reopened whenever it drops.
+    """
+
+    def __init__(self, source, capture=None, reconnect_delay=RECONNECT_DELAY, name='default'):
+        self.source = source
+        self.capture = capture
+        self.reconnect_delay = reconnect_delay
+        self.name = name
+        self.has_frame = False
+        self.grabbed = 0  # Frames grabbed since the last read
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        """
+        Start grabbing frames in the background.
+        """
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop the background thread and release the stream.
+        """
+        self.stop_event.set()
+        if self.thread.is_alive():
+            self.thread.join(timeout=5)
+        with self.lock:
+            if self.capture is not None:
+                self.capture.release()
+
+    def reconnect(self):
+        """
+        Reopen the stream, backing off while it stays unavailable.
+        """
+        delay = self.reconnect_delay
+        while not self.stop_event.is_set():
+            STREAM_RECONNECTS.inc(camera=self.name)
+            capture = cv2.VideoCapture(self.source)
+            with self.lock:
+                previous, self.capture = self.capture, capture
+                self.has_frame = False
+            if previous is not None:
+                previous.release()
+            if capture.isOpened():
+                logging.info("Video stream opened")
+                return
+            logging.warning("Could not open video stream, retrying in %s s", delay)
+            self.stop_event.wait(delay)
+            delay = min(delay * 2, 60)
+
+    def run(self):
+        """
+        Grab frames as the stream delivers them, without decoding them.
+        """
+        while not self.stop_event.is_set():
+            if self.capture is None or not self.capture.isOpened():
+                self.reconnect()
+                continue
+            with self.lock:
+                grabbed = self.capture.grab()
+                self.has_frame = self.has_frame or grabbed
+                self.grabbed += grabbed
+            if not grabbed:
+                logging.warning("Video stream dropped, reconnecting")
+                self.reconnect()
+
+    def read(self):
+        """
+        Decode and return the most recently grabbed frame, or None if there is none yet.
+        """
+        with self.lock:
+            if not self.has_frame:
+                return None
+            ret, frame = self.capture.retrieve()
+            grabbed, self.grabbed = self.grabbed, 0
+        # Every frame grabbed since the last read but this one was never decoded
+        FRAMES.inc(max(grabbed - 1, 0), camera=self.name, outcome='skipped')
+        FRAMES.inc(camera=self.name, outcome='decoded' if ret else 'failed')
+        return frame if ret else None
+
+class InferenceServer:
+    """
+    This class shares the model between cameras through a request queue.
+    Each worker thread owns one model and merges queued requests into common batches,
+    so model memory grows with the number of workers, not with the number of cameras.
+    """
+
+    def __init__(self, models, batch_size=MAX_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.requests = queue.Queue()
+        self.threads = [
+            threading.Thread(target=self.run, args=(model,), daemon=True) for model in models
+        ]
+
+    def start(self):
+        """
+        Start the worker threads.
+        """
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop the worker threads once the queued requests are served.
+        """
+        for _ in self.threads:
+            self.requests.put(None)
+        for thread in self.threads:
+            thread.join(timeout=30)
+
+    def infer(self, regions, scales_and_offsets):
+        """
+        Queue regions for inference and wait for the result of run_batched_inference.
+        """
+        if not regions:
+            return np.empty((0, 4)), np.empty(0), np.empty(0), np.empty(0, dtype=int)
+        future = Future()
+        self.requests.put((regions, scales_and_offsets, future))
+        return future.result()
+
+    def next_batch(self):
+        """
+        Take the next request from the queue along with any others that fit in the batch.
+        Returns None when the server is stopping.
+        """
+        request = self.requests.get()
+        if request is None:
+            return None
+        batch = [request]
+        size = len(request[0])
+        while size < self.batch_size:
+            try:
+                request = self.requests.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                # Leave the stop signal for the next round
+                self.requests.put(None)
+                break
+            batch.append(request)
+            size += len(request[0])
+        return batch
+
+    def run(self, model):
+        """
+        Serve queued requests with the given model until stopped.
+        """
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            regions = [region for request in batch for region in request[0]]
+            scales_and_offsets = [item for request in batch for item in request[1]]
+            try:
+                boxes, class_ids, confidences, region_ids = run_batched_inference(
+                    model, regions, scales_and_offsets, self.batch_size)
+            except Exception as e:  # pylint: disable=broad-except
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            # Hand every request the detections of its own regions
+            start = 0
+            for request_regions, _, future in batch:
+                end = start + len(request_regions)
+                found = (region_ids >= start) & (region_ids < end)
+                future.set_result((boxes[found], class_ids[found],
+                                   confidences[found], region_ids[found] - start))
+                start = end
+
+class SharedTileRing:
+    """
+    This class is a ring of fixed-size tile slots in shared memory.
+    The detector letterboxes regions straight into free slots and inference
+    processes read them in place, so frames are never pickled between processes.
+    """
+
+    def __init__(self, slots, tile_size=TILE_SIZE, name=None):
+        self.slots = slots
+        self.tile_size = tile_size
+        self.owner = name is None
+        size = slots * tile_size * tile_size * 3
+        self.memory = shared_memory.SharedMemory(name=name, create=self.owner, size=size)
+        self.tiles = np.ndarray((slots, tile_size, tile_size, 3), dtype=np.uint8,
+                                buffer=self.memory.buf)
+        self.free = list(range(slots))
+        self.condition = threading.Condition()
+
+    @property
+    def name(self):
+        """
+        Name other processes attach to the ring with.
+        """
+        return self.memory.name
+
+    def acquire(self, count, timeout=None):
+        """
+        Reserve count free slots, waiting for other requests to release theirs if needed.
+        The slots are taken all at once, so concurrent requests never each hold part
+        of what they need and wait on each other forever.
+        Raises TimeoutError if they did not come free within timeout seconds.
+        """
+        if count > self.slots:
+            raise ValueError(f"Cannot reserve {count} slots of a ring of {self.slots}")
+        with self.condition:
+            if not self.condition.wait_for(lambda: len(self.free) >= count, timeout):
+                raise TimeoutError(f"No {count} free tile slots within {timeout} s")
+            slots, self.free[:count] = self.free[:count], []
+        return slots
+
+    def release(self, slots):
+        """
+        Return slots to the ring.
+        """
+        with self.condition:
+            self.free.extend(slots)
+            self.condition.notify_all()
+
+    def close(self):
+        """
+        Detach from the shared memory, removing it if this process created it.
+        """
+        self.tiles = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+def inference_worker(model_path, ring_name, slots, tile_size, jobs, results):
+    """
+    Entry point of an inference process: run the model on the ring slots named
+    by each job and send back the raw detections of every tile.
+    """
+    ring = SharedTileRing(slots, tile_size, name=ring_name)
+    model = load_model(model_path)
+    try:
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            job_id, job_slots, size = job
+            try:
+                predictions = model([ring.tiles[slot][:size, :size] for slot in job_slots], imgsz=size)
+                results.put((job_id, [result_arrays(result) for result in predictions]))
+            except Exception as e:  # pylint: disable=broad-except
+                results.put((job_id, e))
+    finally:
+        ring.close()
+
+class ProcessInferenceServer:
+    """
+    This class serves the model from separate processes so that inference does
+    not compete with frame and region preparation for the GIL.
+    It offers the same infer() as InferenceServer.
+    """
+
+    def __init__(self, model_path=None, workers=INFERENCE_WORKERS,
+                 batch_size=MAX_BATCH_SIZE, slots=None, timeout=INFERENCE_TIMEOUT):
+        context = multiprocessing.get_context('spawn')
+        self.ring = SharedTileRing(slots or max(workers, 1) * batch_size * 2)
+        # A batch never needs more slots than the ring holds
+        self.batch_size = min(batch_size, self.ring.slots)
+        self.timeout = timeout
+        self.jobs = context.Queue()
+        self.results = context.Queue()
+        self.job_ids = itertools.count()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.processes = [
+            context.Process(
+                target=inference_worker,
+                args=(model_artifact() if model_path is None else model_path, self.ring.name, self.ring.slots, self.ring.tile_size,
+                      self.jobs, self.results),
+                daemon=True)
+            for _ in range(workers)
+        ]
+        self.exited = set()  # Inference processes already found dead
+        self.stopping = False
+        self.collector = threading.Thread(target=self.collect, daemon=True)
+
+    def start(self):
+        """
+        Start the inference processes and the result collector.
+        """
+        for process in self.processes:
+            process.start()
+        self.collector.start()
+        return self
+
+    def stop(self):
+        """
+        Stop the inference processes and free the shared memory.
+        """
+        self.stopping = True
+        for _ in self.processes:
+            self.jobs.put(None)
+        for process in self.processes:
+            process.join(timeout=30)
+        self.results.put(None)
+        self.collector.join(timeout=5)
+        self.ring.close()
+
+    def submit(self, regions, scales_and_offsets, size=TILE_SIZE):
+        """
+        Letterbox up to one batch of regions into the top left corner of ring slots
+        and queue them. Returns a future for their detections.
+        """
+        size = min(size, self.ring.tile_size)
+        slots = self.ring.acquire(len(regions), self.timeout)
+        placements = []
+        for slot, region, (scale, offset) in zip(slots, regions, scales_and_offsets):
+            tile, ratio, padding = letterbox(region, size, upscale=False)
+            self.ring.tiles[slot][:size, :size] = tile
+            placements.append((ratio, padding, scale, offset))
+        future = Future()
+        with self.lock:
+            job_id = next(self.job_ids)
+            self.pending[job_id] = (future, slots, placements, size, time.perf_counter())
+        self.jobs.put((job_id, slots, size))
+        return future
+
+    def infer(self, regions, scales_and_offsets):
+        """
+        Run the model on the regions in the inference processes and wait for the
+        same output as run_batched_inference.
+        Raises RuntimeError if no inference process is running and TimeoutError
+        if the detections do not come back within the timeout.
+        """
+        if self.processes and not any(process.is_alive() for process in self.processes):
+            raise RuntimeError("No inference process is running")
+        batches = []
+        for size, indices in group_by_input_size(regions).items():
+            for start in range(0, len(indices), self.batch_size):
+                batch = indices[start:start + self.batch_size]
+                batches.append((batch, self.submit([regions[index] for index in batch],
+                                                   [scales_and_offsets[index] for index in batch],
+                                                   size)))
+        per_region = [None] * len(regions)
+        for batch, future in batches:
+            for index, detections in zip(batch, future.result(timeout=self.timeout)):
+                per_region[index] = detections
+        return merge_detections(per_region)
+
+    def collect(self):
+        """
+        Map the raw detections coming back from the processes and resolve their futures.
+        """
+        while True:
+            try:
+                message = self.results.get(timeout=WORKER_CHECK_INTERVAL)
+            except queue.Empty:
+                self.check_workers()
+                continue
+            if message is None:
+                return
+            job_id, outcome = message
+            with self.lock:
+                entry = self.pending.pop(job_id, None)
+            if entry is None:
+                # Already failed by check_workers
+                continue
+            future, slots, placements, size, submitted = entry
+            # The round trip through the queues, which is what a camera waits for
+            INFERENCE_BATCH_SECONDS.observe(time.perf_counter() - submitted, size=size)
+            self.ring.release(slots)
+            if isinstance(outcome, Exception):
+                future.set_exception(outcome)
+            else:
+                future.set_result([
+                    map_detections(xyxy, cls, conf, placement)
+                    for (xyxy, cls, conf), placement in zip(outcome, placements)
+                ])
+
+    def check_workers(self):
+        """
+        Fail every pending request once an inference process has died, as the jobs
+        it took will never come back, and free their slots.
+        Returns True if a process was found dead.
+        """
+        exited = [process for process in self.processes
+                  if process.exitcode is not None and process not in self.exited]
+        if not exited or self.stopping:
+            return False
+        for process in exited:
+            self.exited.add(process)
+            logging.error("Inference process %s exited with code %s", process.pid, process.exitcode)
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for future, slots, *_ in pending.values():
+            self.ring.release(slots)
+            future.set_exception(RuntimeError("An inference process exited"))
+        return True
+
+class Camera:
+    """
+    This class holds the stream, spot layout and per-spot state of one camera.
+    """
+
+    def __init__(self, name, source, layout_path=LAYOUT_PATH, interval=FRAME_INTERVAL,
+                 mode=DETECTION_MODE, tiles=DETECTION_TILES, capture=None, layout=None,
+                 model=None):
+        self.name = name
+        self.model = model_artifact() if model is None else model
+        self.interval = interval
+        self.mode = mode
+        self.tiles = tiles
+        self.grabber = FrameGrabber(source, capture, name=name)
+        self.layout = new_layout(layout_path) if layout is None else layout
+        self.pending_layout = None  # Compiled by LayoutWatcher, swapped in before the next cycle
+        self.layout_lock = threading.Lock()
+        self.gate = ChangeGate()
+        self.tracker = OccupancyTracker()
+        self.cycles = 0
+        self.occupied = (0, 0)  # Smoothed number of occupied normal and handicap spots
+
+    def stage_layout(self):
+        """
+        Read and compile the layout again if its file changed, without touching
+        the layout in use. Returns True if a new layout was staged for swap_layout.
+        """
+        with self.layout_lock:
+            current = self.pending_layout or self.layout
+        cached_signature = current['signature']
+        signature = layout_signature(current['path'], cached_signature)
+        if signature is None or current['normal_points'] is None or signature == cached_signature:
+            return False
+        if cached_signature is not None and signature[1] == cached_signature[1]:
+            # Touched but not changed
+            current['signature'] = signature
+            return False
+        layout = new_layout(current['path'])
+        layout['version'] = current['version']
+        refresh_layout(current['frame_shape'], layout)
+        with self.layout_lock:
+            self.pending_layout = layout
+        logging.info("Staged a new layout for camera %s", self.name)
+        return True
+
+    def swap_layout(self):
+        """
+        Swap in the layout staged by stage_layout, if any.
+        The layout is replaced in place, so other references to it see the whole new layout.
+        """
+        with self.layout_lock:
+            layout, self.pending_layout = self.pending_layout, None
+            if layout is None:
+                return False
+            self.layout.update(layout)
+        if self.layout is LAYOUT_CACHE:
+            set_default_points(layout['normal_points'], layout['handicap_points'])
+        # Spot ids may have moved, so the smoothed states start over
+        self.tracker = OccupancyTracker()
+        logging.info("Camera %s switched to a layout of %s spots",
+                     self.name, len(layout['is_handicap']))
+        return True
+
+    def process(self, frame, infer, timings=None):
+        """
+        Detect the vehicles in a frame and update the smoothed spot states.
+        With a timings dict the milliseconds spent per stage are added to it.
+        Returns the indices of the spots that changed state.
+        """
+        self.swap_layout()
+        inferred, skipped = self.gate.inferred, self.gate.skipped
+        normal_cars, handicap_cars, occupancy = count_vehicles(
+            frame, self.mode, self.tiles, self.layout, self.gate, infer, timings)
+        SPOT_INFERENCES.inc(self.gate.inferred - inferred, camera=self.name, outcome='inferred')
+        SPOT_INFERENCES.inc(self.gate.skipped - skipped, camera=self.name, outcome='skipped')
+        DETECTIONS.inc(normal_cars + handicap_cars, camera=self.name)
+        with timed(timings, 'postprocess'):
+            changed_spots = self.tracker.update(occupancy)
+            is_handicap = self.layout['is_handicap']
+            self.occupied = (int((self.tracker.states & ~is_handicap).sum()),
+                             int((self.tracker.states & is_handicap).sum()))
+        self.cycles += 1
+        return changed_spots
+
+    def run(self, infer, on_update, stop_event):
+        """
+        Process a frame every interval until stop_event is set,
+        calling on_update(camera, changed_spots) after each one.
+        The time of every stage of a cycle is recorded in STAGE_SECONDS.
+        """
+        self.grabber.start()
+        try:
+            while not stop_event.is_set():
+                cycle_start = time.time()
+                timings = {}
+                with timed(timings, 'grab'):
+                    frame = self.grabber.read()
+                if frame is None:
+                    stop_event.wait(1)
+                    continue
+                try:
+                    changed_spots = self.process(frame, infer, timings)
+                except Exception:  # pylint: disable=broad-except
+                    # One bad frame must not stop the camera
+                    CYCLE_ERRORS.inc(camera=self.name)
+                    logging.exception("Error processing frame from camera %s", self.name)
+                else:
+                    with timed(timings, 'db'):
+                        on_update(self, changed_spots)
+                    for stage, milliseconds in timings.items():
+                        STAGE_SECONDS.observe(milliseconds / 1000, camera=self.name, stage=stage)
+                stop_event.wait(max(0, self.interval - (time.time() - cycle_start)))
+        finally:
+            self.grabber.stop()
+
+def load_cameras(path):
+    """
+    Load the camera definitions from a JSON file holding a list of objects with
+    "name", "url", "layout" and optionally "interval", "mode", "tiles", and
+    "variant" and "runtime" of the model to use.
+    Environment variables in the url, such as ${SECURE_URL}, are expanded.
+    """
+    with open(path, "r", encoding="utf-8") as file:
+        definitions = json.load(file)
+    return [
+        Camera(
+            definition.get('name', f"camera{i}"),
+            os.path.expandvars(definition['url']),
+            definition.get('layout', LAYOUT_PATH),
+            int(definition.get('interval', FRAME_INTERVAL)),
+            definition.get('mode', DETECTION_MODE),
+            definition.get('tiles', DETECTION_TILES),
+            model=model_artifact(definition.get('variant', MODEL_VARIANT),
+                                 definition.get('runtime', MODEL_RUNTIME)),
+        )
+        for i, definition in enumerate(definitions)
+    ]
+
+class LayoutWatcher:
+    """
+    This class polls the layout files of the cameras in a background thread and
+    compiles changed layouts there, so re-annotated spots take effect between two
+    detection cycles without reloading the model or reopening the streams.
+    """
+
+    def __init__(self, cameras, interval=LAYOUT_POLL_INTERVAL):
+        self.cameras = cameras
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='layout', daemon=True)
+
+    def check(self):
+        """
+        Stage the new layout of every camera whose layout file changed.
+        Returns the number of layouts staged.
+        """
+        staged = 0
+        for camera in self.cameras:
+            try:
+                staged += camera.stage_layout()
+            except Exception:  # pylint: disable=broad-except
+                # The camera keeps its current layout
+                logging.exception("Error reloading the layout of camera %s", camera.name)
+        return staged
+
+    def run(self):
+        """
+        Check the layout files every interval until stopped.
+        """
+        while not self.stop_event.wait(self.interval):
+            self.check()
+
+    def start(self):
+        """
+        Start watching in the background.
+        """
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop watching.
+        """
+        self.stop_event.set()
+        if self.thread.is_alive():
+            self.thread.join(timeout=5)
+
+class HistoryWriter:
+    """
+    This class buffers occupancy history rows in memory and writes them to the
+    database in batches from a background thread, so detection never waits on it.
+    Rows that could not be written are kept for the next flush.
+    """
+
+    def __init__(self, batch_size=HISTORY_BATCH_SIZE, flush_interval=HISTORY_FLUSH_INTERVAL,
+                 max_rows=HISTORY_MAX_ROWS):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_rows = max_rows
+        self.buffers = {save_occupancy_history: [], save_spot_events: []}
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run, name='history', daemon=True)
+
+    def pending(self):
+        """
+        Return the number of buffered rows.
+        """
+        return sum(len(rows) for rows in self.buffers.values())
+
+    def add(self, save, rows, requeue=False):
+        """
+        Buffer rows for the given database save function.
+        Requeued rows go in front of the rows buffered since they were taken.
+        """
+        with self.condition:
+            buffer = self.buffers[save]
+            if requeue:
+                buffer[:0] = rows
+            else:
+                buffer.extend(rows)
+            if len(buffer) > self.max_rows:
+                self.dropped += len(buffer) - self.max_rows
+                del buffer[:len(buffer) - self.max_rows]
+            if self.pending() >= self.batch_size:
+                self.condition.notify()
+
+    def add_counts(self, cycle_id, free_counts, total_counts, recorded_at=None):
+        """
+        Buffer one change of the lot's free counts.
+        """
+        recorded_at = recorded_at or datetime.now(timezone.utc).replace(tzinfo=None)
+        self.add(save_occupancy_history, [(recorded_at, cycle_id, *free_counts, *total_counts)])
+
+    def add_spot_events(self, camera_name, spot_ids, is_handicap, states, recorded_at=None):
+        """
+        Buffer the new state of every spot of a camera that changed state.
+        """
+        recorded_at = recorded_at or datetime.now(timezone.utc).replace(tzinfo=None)
+        self.add(save_spot_events, [
+            (recorded_at, camera_name, int(spot_id), bool(is_handicap[spot_id]), bool(states[spot_id]))
+            for spot_id in spot_ids
+        ])
+
+    def flush(self):
+        """
+        Write every buffered row, putting back the rows of failed writes.
+        Returns False if any write failed.
+        """
+        with self.condition:
+            batches = {save: rows for save, rows in self.buffers.items() if rows}
+            for save in batches:
+                self.buffers[save] = []
+        written = True
+        for save, rows in batches.items():
+            if not save(rows):
+                logging.warning("Could not write %s history rows, retrying later", len(rows))
+                self.add(save, rows, requeue=True)
+                written = False
+        return written
+
+    def run(self):
+        """
+        Flush whenever a batch is full or the flush interval passed, until stopped.
+        """
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.stopped or self.pending() >= self.batch_size,
+                                        self.flush_interval)
+                stopped = self.stopped
+            written = self.flush()
+            if stopped:
+                return
+            if not written:
+                # Give the database a flush interval to come back before retrying
+                with self.condition:
+                    self.condition.wait_for(lambda: self.stopped, self.flush_interval)
+
+    def start(self):
+        """
+        Start the background writer.
+        """
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Write the remaining rows and stop the background writer.
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.thread.join(timeout=30)
+
+def notify_counts_changed(cycle_id, spots=None, url=CACHE_INVALIDATE_URL):
+    """
+    Tell the Flask server in the background that new counts were saved,
+    optionally with the per-spot occupancy of every camera.
+    """
+    if not url:
+        return None
+
+    def post():
+        try:
+            headers = {'X-Invalidate-Token': CACHE_INVALIDATE_TOKEN} if CACHE_INVALIDATE_TOKEN else {}
+            requests.post(url, json={'cycle_id': cycle_id, 'spots': spots}, headers=headers, timeout=2)
+        except requests.RequestException as e:
+            logging.warning("Could not invalidate the server cache at %s: %s", url, e)
+
+    thread = threading.Thread(target=post, daemon=True)
+    thread.start()
+    return thread
+
+class CountPublisher:
+    """
+    This class sums the smoothed counts of all cameras of the lot
+    and writes the free spots to the database when they change.
+    With a history writer every change is also appended to the history.
+    """
+
+    def __init__(self, cameras, history=None):
+        self.cameras = cameras
+        self.history = history
+        self.lock = threading.Lock()
+        self.last_free_counts = None
+        self.last_cycle_id = None
+
+    def __call__(self, camera, changed_spots):
+        logging.info("Camera %s spots that changed state: %s", camera.name, changed_spots.tolist())
+        if self.history is not None and len(changed_spots):
+            self.history.add_spot_events(camera.name, changed_spots, camera.layout['is_handicap'],
+                                         camera.tracker.states)
+        with self.lock:
+            # Wait until every camera has seen the lot once
+            if any(other.cycles == 0 for other in self.cameras):
+                return
+            total_normal_cars = sum(other.occupied[0] for other in self.cameras)
+            total_handicap_cars = sum(other.occupied[1] for other in self.cameras)
+
+            snapshot = fetch_lot_snapshot()
+            if snapshot is None:
+                logging.warning("Could not read the parking lot totals, skipping the update")
+                return
+            free_counts = (snapshot.total_spots - total_normal_cars,
+                           snapshot.total_handicap_spots - total_handicap_cars)
+
+            # Only write when the smoothed numbers actually changed
+            if free_counts == self.last_free_counts:
+                # Cars can swap spots without changing the counts
+                if len(changed_spots):
+                    notify_counts_changed(self.last_cycle_id, self.spot_states())
+                return
+            cycle_id = save_free_counts(*free_counts)
+            if cycle_id is None:
+                return
+            self.last_free_counts = free_counts
+            self.last_cycle_id = cycle_id
+            notify_counts_changed(cycle_id, self.spot_states())
+            if self.history is not None:
+                self.history.add_counts(cycle_id, free_counts,
+                                        (snapshot.total_spots, snapshot.total_handicap_spots))
+
+            logging.info("Total normal parking spots: %s", snapshot.total_spots)
+            logging.info("Total handicap parking spots: %s", snapshot.total_handicap_spots)
+            logging.info("Available normal parking spots: %s", free_counts[0])
+            logging.info("Available handicap parking spots: %s", free_counts[1])
+            logging.info("Saved detection cycle %s", cycle_id)
+
+    def spot_states(self):
+        """
+        Return the smoothed occupancy of every spot of every camera.
+        """
+        return {
+            camera.name: [
+                {'id': spot_id, 'handicap': bool(handicap), 'occupied': bool(occupied)}
+                for spot_id, (handicap, occupied) in enumerate(
+                    zip(camera.layout['is_handicap'], camera.tracker.states))
+            ]
+            for camera in self.cameras if camera.tracker.states is not None
+        }
+
 def main():
     """
     Main function for the program to run.
+    Runs every camera in its own thread, all sharing the inference workers.
     """
-    frame_interval = 30
-    last_frame_time = time.time()
-
-    while CAPTURE.isOpened():
-        ret, frame = CAPTURE.read()
-        if not ret:
-            break
-        if time.time() - last_frame_time >= frame_interval:
-            last_frame_time = time.time()
-
-            # Get the regions of interest
-            normal_regions, normal_scales_and_offsets = get_regions_of_interest(frame, NORMAL_POINTS_NP)
-            handicap_regions, handicap_scales_and_offsets = get_regions_of_interest(frame, HANDICAP_POINTS_NP)
-
-            total_normal_cars = 0
-            total_handicap_cars = 0
-            detected_boxes = []
-
-            # Draw polylines on the frame based on the points
-            #draw_polygons(frame, NORMAL_POINTS_NP, (0, 255, 0))
-            #draw_polygons(frame, HANDICAP_POINTS_NP, (255, 0, 0))
-            # Process each region of interest
-            for i, (region, (scale, offset)) in enumerate(zip(normal_regions + handicap_regions, normal_scales_and_offsets + handicap_scales_and_offsets)):
-                results = MODEL(region)
-                #normalwindow = f"Processed Region {i+1}"
-                #cv2.namedWindow(normalwindow, cv2.WINDOW_NORMAL)
-
-                # Display the processed region
-                #cv2.imshow(normalwindow, region)
-
-                for result in results:
-                    for detection in result.boxes:
-                        class_id = detection.cls.item()
-                        conf = detection.conf.item()
-                        #logging.info(f"Confidence score for detected vehicle: {conf}")
-                        if class_id in VEHICLE_CLASSES and conf >= 0.25:
-                            box = detection.xyxy[0].cpu().numpy()
-                            box = box / scale + np.array([offset[0], offset[1], offset[0], offset[1]])
-                            if not any(boxes_overlap(box, other_box) for other_box in detected_boxes):
-                                in_normal_region = box_in_regions(box, NORMAL_POINTS_NP, [])
-                                in_handicap_region = box_in_regions(box, [], HANDICAP_POINTS_NP)
-                                if in_normal_region or in_handicap_region:
-                                    detected_boxes.append(box)
-                                    if in_normal_region:
-                                        total_normal_cars += 1
-                                    elif in_handicap_region:
-                                        total_handicap_cars += 1
-
-            total_normal_spots = fetch_total_spots()
-            total_handicap_spots = fetch_total_handicap_spots()
-            free_normal_spots = total_normal_spots - total_normal_cars
-            free_handicap_spots = total_handicap_spots - total_handicap_cars
-
-            save_available_free_spots(free_normal_spots)
-            save_available_handicap_spots(free_handicap_spots)
-
-            available_normal_spots = fetch_available_free_spots()
-            available_handicap_spots = fetch_available_handicap_spots()
-
-            logging.info("Total normal parking spots: %s", total_normal_spots)
-            logging.info("Total handicap parking spots: %s", total_handicap_spots)
-            logging.info("Available normal parking spots: %s", available_normal_spots)
-            logging.info("Available handicap parking spots: %s", available_handicap_spots)
-            #reframe = cv2.resize(frame, (1920, 1080))
-            #results = MODEL(reframe, show=True)
-
-
-        if cv2.waitKey(1) & 0xFF == ord('q'):
-            break
-    cv2.destroyAllWindows()
-    CAPTURE.release()
+    if CAMERAS_CONFIG:
+        cameras = load_cameras(CAMERAS_CONFIG)
+    else:
+        cameras = [Camera('default', os.getenv('SECURE_URL'), capture=CAPTURE, layout=LAYOUT_CACHE)]
+    # Cameras using the same model share its inference server
+    servers = {}
+    for model_path in dict.fromkeys(camera.model for camera in cameras):
+        if INFERENCE_BACKEND == 'process':
+            servers[model_path] = ProcessInferenceServer(model_path).start()
+        else:
+            reuse = MODEL is not None and model_path == model_artifact()
+            models = [MODEL if reuse else load_model(model_path)]
+            models += [load_model(model_path) for _ in range(INFERENCE_WORKERS - 1)]
+            servers[model_path] = InferenceServer(models).start()
+    history = HistoryWriter().start() if HISTORY_ENABLED else None
+    watcher = LayoutWatcher(cameras).start()
+    metrics_server = None
+    if METRICS_PORT:
+        try:
+            metrics_server = start_http_server(METRICS_PORT)
+        except OSError as e:
+            # Detection goes on without metrics
+            logging.error("Could not serve metrics on port %s: %s", METRICS_PORT, e)
+    publisher = CountPublisher(cameras, history)
+
+    threads = [
+        threading.Thread(target=camera.run,
+                         args=(servers[camera.model].infer, publisher, STOP_EVENT),
+                         name=camera.name, daemon=True)
+        for camera in cameras
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(timeout=1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        STOP_EVENT.set()
+        watcher.stop()
+        for thread in threads:
+            thread.join(timeout=10)
+        for server in servers.values():
+            server.stop()
+        if history is not None:
+            history.stop()
+        if metrics_server is not None:
+            metrics_server.shutdown()
 
 if __name__ == "__main__":
     # Load resources in a separate thread
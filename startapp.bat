@@ -11,8 +11,8 @@ git pull origin main
 :: Install required python packages
 python -m pip install -r ./backend/requirements.txt
 
-:: Run the Flask server in the background
-pm2 start ./backend/flaskserver.py --name flaskserver --interpreter python
+:: Run the Flask server in the background with gevent, gunicorn does not run on Windows
+pm2 start ./backend/serve.py --name flaskserver --interpreter python
 
 :: Run the Flask server in the background
 pm2 start ./backend/streamyolo.py --name parkspotter --interpreter python
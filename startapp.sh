@@ -17,8 +17,8 @@ git pull origin main
 # Install required python packages
 pip install -r ./backend/requirements.txt
 
-# Run the Flask server with PM2
-pm2 start ./backend/flaskserver.py --name=flaskserver --interpreter python3
+# Run the Flask server with a gunicorn gevent worker under PM2, see backend/gunicorn.conf.py
+pm2 start "python3 -m gunicorn -c ./backend/gunicorn.conf.py flaskserver:app" --name=flaskserver
 
 # Run the other script with PM2
 pm2 start ./backend/streamyolo.py --name=parkspotter --interpreter python3
@@ -0,0 +1,180 @@
+"""
+This module contains benchmarks of the detection hot paths on synthetic parking lots
+of 10, 100 and 1000 spots and on 720p, 1080p and 4K frames.
+Run them from the project root, see tests/benchmarks/pytest.ini:
+    python -m pytest tests/benchmarks
+"""
+
+from datetime import datetime, timezone
+import numpy as np
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+# pylint: disable=wrong-import-position
+import database
+import streamyolo
+from benchmark import loop_suppression, random_boxes
+from conftest import FakeModel, SPOT_COUNTS, synthetic_lot
+
+
+def synthetic_lot_1080p(count):
+    """
+    Return a synthetic lot of count spots laid out over a 1080p frame.
+    """
+    return synthetic_lot(count, (1080, 1920))
+
+
+def spot_boxes(normal, handicap):
+    """
+    Return one car sized box centred on every spot.
+    """
+    boxes = []
+    for polygon in normal + handicap:
+        x0, y0 = polygon.min(axis=0)
+        x1, y1 = polygon.max(axis=0)
+        boxes.append([x0 + (x1 - x0) * 0.2, y0 + (y1 - y0) * 0.2,
+                      x1 - (x1 - x0) * 0.2, y1 - (y1 - y0) * 0.2])
+    return np.array(boxes, dtype=float)
+
+
+def compiled_layout(normal, handicap, frame_shape):
+    """
+    Compile a layout held in memory, like refresh_layout does for a layout file.
+    """
+    layout = streamyolo.new_layout('synthetic')
+    layout.update(normal_points=normal, handicap_points=handicap, signature=(0, 'synthetic'))
+    streamyolo.refresh_layout(frame_shape, layout, reload=False)
+    return layout
+
+
+@pytest.mark.benchmark(group='get_regions_of_interest')
+def test_get_regions_of_interest(benchmark, frame, lot):
+    """
+    This method times cropping, masking and resizing every spot of a frame.
+    """
+    normal, handicap = lot
+    spots = streamyolo.compile_spots(normal + handicap, frame.shape)
+
+    regions, _ = benchmark(streamyolo.get_regions_of_interest, frame, spots)
+
+    assert len(regions) == len(spots)
+
+
+@pytest.mark.benchmark(group='count_vehicles')
+def test_count_vehicles(benchmark, frame, lot):
+    """
+    This method times a whole detection cycle over every spot with a fake model.
+    """
+    normal, handicap = lot
+    layout = compiled_layout(normal, handicap, frame.shape)
+    gate = streamyolo.ChangeGate(refresh_cycles=1)  # Infer every spot on every call
+    model = FakeModel()
+
+    def infer(regions, scales_and_offsets):
+        return streamyolo.run_batched_inference(model, regions, scales_and_offsets)
+
+    normal_cars, handicap_cars, _ = benchmark(
+        streamyolo.count_vehicles, frame, 'roi', '1x1', layout, gate, infer)
+
+    assert normal_cars + handicap_cars == len(normal) + len(handicap)
+
+
+@pytest.mark.parametrize('count', SPOT_COUNTS, ids=lambda count: f"{count}spots")
+@pytest.mark.benchmark(group='calculate_centroids')
+def test_calculate_centroids(benchmark, count):
+    """
+    This method times calculating the centroid of every spot.
+    """
+    normal, handicap = synthetic_lot_1080p(count)
+
+    centroids = benchmark(streamyolo.calculate_centroids, normal + handicap)
+
+    assert len(centroids) == count
+
+
+@pytest.mark.parametrize('count', SPOT_COUNTS, ids=lambda count: f"{count}spots")
+@pytest.mark.benchmark(group='box_in_regions')
+def test_box_in_regions(benchmark, count):
+    """
+    This method times testing one box per spot against every spot polygon, box by box.
+    """
+    normal, handicap = synthetic_lot_1080p(count)
+    boxes = spot_boxes(normal, handicap)
+
+    inside = benchmark(lambda: [streamyolo.box_in_regions(box, normal, handicap) for box in boxes])
+
+    assert all(inside)
+
+
+@pytest.mark.parametrize('count', SPOT_COUNTS, ids=lambda count: f"{count}spots")
+@pytest.mark.benchmark(group='box_in_regions')
+def test_lookup_spots(benchmark, count):
+    """
+    This method times looking up the spot of one box per spot in the label map.
+    """
+    normal, handicap = synthetic_lot_1080p(count)
+    boxes = spot_boxes(normal, handicap)
+    labels = streamyolo.build_label_map(normal, handicap, (1080, 1920), streamyolo.LABEL_MAP_DOWNSCALE)
+
+    spot_ids = benchmark(lambda: streamyolo.lookup_spots(
+        streamyolo.box_centroids(boxes), labels, streamyolo.LABEL_MAP_DOWNSCALE))
+
+    assert (spot_ids >= 0).all()
+
+
+@pytest.mark.parametrize('count', SPOT_COUNTS, ids=lambda count: f"{count}spots")
+@pytest.mark.benchmark(group='duplicate_suppression')
+def test_loop_suppression(benchmark, count):
+    """
+    This method times the original pairwise duplicate suppression loop.
+    """
+    boxes = random_boxes(count)
+
+    kept = benchmark(loop_suppression, boxes)
+
+    assert len(kept) == int(streamyolo.suppress_duplicates(boxes).sum())
+
+
+@pytest.mark.parametrize('count', SPOT_COUNTS, ids=lambda count: f"{count}spots")
+@pytest.mark.benchmark(group='duplicate_suppression')
+def test_suppress_duplicates(benchmark, count):
+    """
+    This method times the vectorized duplicate suppression.
+    """
+    boxes = random_boxes(count)
+
+    benchmark(streamyolo.suppress_duplicates, boxes)
+
+
+@pytest.mark.benchmark(group='database')
+def test_fetch_lot_snapshot(benchmark, memory_database):
+    """
+    This method times reading the lot snapshot through the connection pool wrapper.
+    """
+    snapshot = benchmark(database.fetch_lot_snapshot)
+
+    assert snapshot.total_spots == memory_database.tables['lot'][2]
+
+
+@pytest.mark.benchmark(group='database')
+def test_save_free_counts(benchmark, memory_database):
+    """
+    This method times writing the free counts of a cycle through the connection pool wrapper.
+    """
+    cycle_id = benchmark(database.save_free_counts, 12, 2)
+
+    assert cycle_id == memory_database.tables['lot'][5]
+
+
+@pytest.mark.parametrize('count', SPOT_COUNTS, ids=lambda count: f"{count}spots")
+@pytest.mark.benchmark(group='database')
+def test_save_spot_events(benchmark, memory_database, count):
+    """
+    This method times writing one state change per spot through the batch insert wrapper.
+    """
+    recorded_at = datetime.now(timezone.utc)
+    rows = [(recorded_at, 'default', spot_id, False, spot_id % 2 == 0) for spot_id in range(count)]
+
+    assert benchmark(database.save_spot_events, rows)
+
@@ -0,0 +1,236 @@
+"""
+This module contains the fixtures of the detection benchmarks: synthetic parking lots
+and frames, a fake model and an in-memory stand-in for the MySQL connection pool.
+"""
+
+import glob
+import os
+import platform
+import sys
+import numpy as np
+import pytest
+
+BACKEND_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'backend'))
+sys.path.insert(0, BACKEND_DIR)
+
+# pylint: disable=wrong-import-position
+import database
+
+SPOT_COUNTS = (10, 100, 1000)
+FRAME_SHAPES = {'720p': (720, 1280), '1080p': (1080, 1920), '4k': (2160, 3840)}
+HANDICAP_EVERY = 10  # Every tenth synthetic spot is a handicap spot
+
+
+def pytest_configure(config):
+    """
+    Compare only with baselines saved on the same kind of machine. Without one there
+    is nothing to compare with, so the comparison of pytest.ini is left out.
+    """
+    storage = config.getoption('benchmark_storage', None)
+    if not storage or not config.getoption('benchmark_compare', None):
+        return
+    # The directory name pytest-benchmark saves the runs of this machine under
+    machine_id = '-'.join([platform.system(), platform.python_implementation(),
+                           '.'.join(platform.python_version_tuple()[:2]), platform.architecture()[0]])
+    if not glob.glob(os.path.join(storage.replace('file://', ''), machine_id, '*.json')):
+        config.option.benchmark_compare = False
+        config.option.benchmark_compare_fail = None
+        config.issue_config_time_warning(pytest.PytestWarning(
+            f"No benchmark baseline for {machine_id} in {storage}, save one with --benchmark-save=baseline"),
+            stacklevel=2)
+
+
+def synthetic_lot(count, frame_shape):
+    """
+    Lay out count slanted parking spots in rows over the frame.
+    Returns the normal and the handicap polygons as lists of int32 arrays.
+    """
+    height, width = frame_shape
+    columns = int(np.ceil(np.sqrt(count * width / height)))
+    rows = int(np.ceil(count / columns))
+    cell_width, cell_height = width / columns, height / rows
+    normal, handicap = [], []
+    for i in range(count):
+        x, y = (i % columns) * cell_width, (i // columns) * cell_height
+        slant = cell_width * 0.15
+        polygon = np.array([
+            [x + slant, y + cell_height * 0.1],
+            [x + cell_width * 0.9, y + cell_height * 0.1],
+            [x + cell_width * 0.9 - slant, y + cell_height * 0.9],
+            [x, y + cell_height * 0.9],
+        ], dtype=np.int32)
+        (handicap if i % HANDICAP_EVERY == 0 else normal).append(polygon)
+    return normal, handicap
+
+
+def synthetic_frame(frame_shape, seed=0):
+    """
+    Return a frame of random pixels.
+    """
+    return np.random.default_rng(seed).integers(0, 256, (*frame_shape, 3), dtype=np.uint8)
+
+
+class FakeTensor:
+    """
+    This class stands in for a torch tensor holding a numpy array.
+    """
+
+    def __init__(self, array):
+        self.array = array
+
+    def cpu(self):
+        """
+        Return the tensor itself.
+        """
+        return self
+
+    def numpy(self):
+        """
+        Return the array.
+        """
+        return self.array
+
+
+class FakeModel:
+    """
+    This class stands in for the YOLO model. It finds one car in the middle of every tile,
+    so the timings cover everything around the model but not the model itself.
+    """
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, tiles, imgsz=640, **kwargs):
+        self.calls += 1
+        results = []
+        for tile in tiles:
+            height, width = tile.shape[:2]
+            result = type('Result', (), {})()
+            result.boxes = type('Boxes', (), {})()
+            result.boxes.xyxy = FakeTensor(np.array([[width * 0.25, height * 0.25,
+                                                      width * 0.75, height * 0.75]]))
+            result.boxes.cls = FakeTensor(np.array([2.0]))
+            result.boxes.conf = FakeTensor(np.array([0.9]))
+            results.append(result)
+        return results
+
+
+class MemoryCursor:
+    """
+    This class stands in for a MySQL cursor on the parking lot row.
+    """
+
+    def __init__(self, tables):
+        self.tables = tables
+        self.result = None
+        self.lastrowid = None
+
+    def execute(self, query, params=()):
+        """
+        Answer the lot snapshot query and apply the free counts update.
+        """
+        lot = self.tables['lot']
+        if query.startswith('SELECT'):
+            self.result = tuple(lot)
+        elif query.startswith('UPDATE'):
+            lot[0], lot[1] = params[0], params[1]
+            lot[5] += 1
+            self.lastrowid = lot[5]
+
+    def executemany(self, query, rows):
+        """
+        Count the rows inserted into the table named in an INSERT query.
+        """
+        table = query.split()[2]
+        self.tables[table] = self.tables.get(table, 0) + len(rows)
+
+    def fetchone(self):
+        """
+        Return the result of the last query.
+        """
+        return self.result
+
+
+class MemoryConnection:
+    """
+    This class stands in for a pooled MySQL connection.
+    """
+
+    def __init__(self, tables):
+        self.tables = tables
+
+    def cursor(self):
+        """
+        Return a new cursor.
+        """
+        return MemoryCursor(self.tables)
+
+    def ping(self, **kwargs):
+        """
+        Pretend the connection is alive.
+        """
+
+    def commit(self):
+        """
+        Nothing to commit in memory.
+        """
+
+    def rollback(self):
+        """
+        Nothing to roll back in memory.
+        """
+
+    def close(self):
+        """
+        Nothing to return to a pool in memory.
+        """
+
+
+class MemoryPool:
+    """
+    This class stands in for the MySQL connection pool, sharing one set of tables.
+    """
+
+    def __init__(self):
+        self.tables = {'lot': [40, 4, 40, 4, '', 0, None]}
+
+    def get_connection(self):
+        """
+        Return a connection to the in-memory tables.
+        """
+        return MemoryConnection(self.tables)
+
+
+@pytest.fixture
+def memory_database(monkeypatch):
+    """
+    Point the database module at an in-memory pool and return the pool.
+    """
+    pool = MemoryPool()
+    monkeypatch.setattr(database, 'POOL', pool)
+    monkeypatch.setattr(database, 'LAST_CHECKOUT', {})
+    return pool
+
+
+@pytest.fixture(params=SPOT_COUNTS, ids=lambda count: f"{count}spots")
+def spot_count(request):
+    """
+    Number of spots in the synthetic lot.
+    """
+    return request.param
+
+
+@pytest.fixture(params=list(FRAME_SHAPES), ids=str)
+def frame(request):
+    """
+    A synthetic frame of every benchmarked resolution.
+    """
+    return synthetic_frame(FRAME_SHAPES[request.param])
+
+
+@pytest.fixture
+def lot(spot_count, frame):
+    """
+    The normal and handicap polygons of a synthetic lot laid out over the frame.
+    """
+    return synthetic_lot(spot_count, frame.shape[:2])
@@ -10,7 +10,9 @@ import mysql.connector
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 # required functions from backend.database
+from backend import database
 from backend.database import (
+    connect_to_db,
     fetch_available_free_spots,
     fetch_available_handicap_spots,
     save_available_free_spots,
@@ -20,7 +22,13 @@ from backend.database import (
     fetch_image,
     save_image,
     fetch_total_spots,
-    save_total_spots
+    save_total_spots,
+    fetch_lot_snapshot,
+    save_free_counts,
+    save_occupancy_history,
+    save_spot_events,
+    fetch_occupancy_history,
+    LotSnapshot
 )
 
 class TestDatabase(unittest.TestCase):
@@ -274,6 +282,206 @@ class TestDatabase(unittest.TestCase):
         mock_cursor.execute.assert_called_once_with(query, (10, 1))
         mock_cnx.commit.assert_called_once()
         mock_cnx.close.assert_called_once()
+    def test_fetch_lot_snapshot(self):
+        """
+        Test case for fetch_lot_snapshot reading every counter in one query.
+        """
+        mock_cursor = MagicMock()
+        mock_cursor.fetchone.return_value = (3, 1, 10, 2, "lot.jpg", 42, None)
+        mock_cnx = MagicMock()
+        mock_cnx.cursor.return_value = mock_cursor
+
+        with unittest.mock.patch('backend.database.connect_to_db', return_value=mock_cnx):
+            result = fetch_lot_snapshot()
+
+        self.assertEqual(result, LotSnapshot(3, 1, 10, 2, "lot.jpg", 42, None))
+        self.assertEqual(result.total_spots, 10)
+        mock_cursor.execute.assert_called_once()
+        mock_cnx.close.assert_called_once()
+
+    def test_fetch_lot_snapshot_with_no_result(self):
+        """
+        Test case for fetch_lot_snapshot when the lot row is missing.
+        """
+        mock_cursor = MagicMock()
+        mock_cursor.fetchone.return_value = None
+        mock_cnx = MagicMock()
+        mock_cnx.cursor.return_value = mock_cursor
+
+        with unittest.mock.patch('backend.database.connect_to_db', return_value=mock_cnx):
+            result = fetch_lot_snapshot()
+
+        self.assertIsNone(result)
+        mock_cnx.close.assert_called_once()
+
+    def test_save_free_counts(self):
+        """
+        Test case for save_free_counts writing both counts in one statement.
+        """
+        mock_cursor = MagicMock()
+        mock_cursor.lastrowid = 43
+        mock_cnx = MagicMock()
+        mock_cnx.cursor.return_value = mock_cursor
+
+        with unittest.mock.patch('backend.database.connect_to_db', return_value=mock_cnx):
+            result = save_free_counts(3, 1)
+
+        self.assertEqual(result, 43)
+        mock_cursor.execute.assert_called_once()
+        self.assertEqual(mock_cursor.execute.call_args.args[1], (3, 1, 1))
+        mock_cnx.commit.assert_called_once()
+        mock_cnx.close.assert_called_once()
+
+    def test_save_free_counts_with_error(self):
+        """
+        Test case for save_free_counts rolling back when the update fails.
+        """
+        mock_cursor = MagicMock()
+        mock_cursor.execute.side_effect = mysql.connector.Error("Lock wait timeout")
+        mock_cnx = MagicMock()
+        mock_cnx.cursor.return_value = mock_cursor
+
+        with unittest.mock.patch('backend.database.connect_to_db', return_value=mock_cnx):
+            result = save_free_counts(3, 1)
+
+        self.assertIsNone(result)
+        mock_cnx.rollback.assert_called_once()
+        mock_cnx.commit.assert_not_called()
+        mock_cnx.close.assert_called_once()
+    def test_save_occupancy_history(self):
+        """
+        Test case for save_occupancy_history inserting all rows with one executemany.
+        """
+        mock_cursor = MagicMock()
+        mock_cnx = MagicMock()
+        mock_cnx.cursor.return_value = mock_cursor
+        rows = [("t1", 1, 5, 1, 10, 2), ("t2", 2, 4, 1, 10, 2)]
+
+        with unittest.mock.patch('backend.database.connect_to_db', return_value=mock_cnx):
+            result = save_occupancy_history(rows)
+
+        self.assertTrue(result)
+        mock_cursor.executemany.assert_called_once()
+        self.assertEqual(mock_cursor.executemany.call_args.args[1], rows)
+        mock_cnx.commit.assert_called_once()
+        mock_cnx.close.assert_called_once()
+
+    def test_save_spot_events_with_error(self):
+        """
+        Test case for save_spot_events rolling back when the insert fails.
+        """
+        mock_cursor = MagicMock()
+        mock_cursor.executemany.side_effect = mysql.connector.Error("Table doesn't exist")
+        mock_cnx = MagicMock()
+        mock_cnx.cursor.return_value = mock_cursor
+
+        with unittest.mock.patch('backend.database.connect_to_db', return_value=mock_cnx):
+            result = save_spot_events([("t1", "north", 0, False, True)])
+
+        self.assertFalse(result)
+        mock_cnx.rollback.assert_called_once()
+        mock_cnx.close.assert_called_once()
+
+    def test_save_occupancy_history_without_rows(self):
+        """
+        Test case for save_occupancy_history not connecting when there is nothing to write.
+        """
+        with unittest.mock.patch('backend.database.connect_to_db') as mock_connect:
+            self.assertTrue(save_occupancy_history([]))
+
+        mock_connect.assert_not_called()
+
+    def test_fetch_occupancy_history(self):
+        """
+        Test case for fetch_occupancy_history reading a time range.
+        """
+        mock_cursor = MagicMock()
+        mock_cursor.fetchall.return_value = [("t1", 1, 5, 1, 10, 2)]
+        mock_cnx = MagicMock()
+        mock_cnx.cursor.return_value = mock_cursor
+
+        with unittest.mock.patch('backend.database.connect_to_db', return_value=mock_cnx):
+            result = fetch_occupancy_history("start", "end")
+
+        self.assertEqual(result, [("t1", 1, 5, 1, 10, 2)])
+        self.assertEqual(mock_cursor.execute.call_args.args[1], ("start", "end"))
+        mock_cnx.close.assert_called_once()
+
+class TestConnectionPool(unittest.TestCase):
+    """
+    This class contains unit tests for the pooled connections of the database module.
+    """
+
+    def setUp(self):
+        database.POOL = None
+        database.LAST_CHECKOUT.clear()
+        patcher = unittest.mock.patch('backend.database.pooling.MySQLConnectionPool')
+        self.mock_pool_class = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(setattr, database, 'POOL', None)
+        self.mock_pool = self.mock_pool_class.return_value
+
+    def test_connect_to_db_reuses_pool(self):
+        """
+        Test case for connect_to_db creating the pool once and pinging only idle connections.
+        """
+        mock_cnx = MagicMock()
+        self.mock_pool.get_connection.return_value = mock_cnx
+
+        self.assertIs(connect_to_db(), mock_cnx)
+        self.assertIs(connect_to_db(), mock_cnx)
+        with unittest.mock.patch('backend.database.DB_PING_INTERVAL', -1):
+            self.assertIs(connect_to_db(), mock_cnx)
+
+        self.mock_pool_class.assert_called_once()
+        self.assertEqual(mock_cnx.ping.call_count, 2)
+        self.assertTrue(mock_cnx.ping.call_args.kwargs['reconnect'])
+
+    def test_connect_to_db_failed_health_check(self):
+        """
+        Test case for connect_to_db when a connection cannot be reconnected.
+        """
+        mock_cnx = MagicMock()
+        mock_cnx.ping.side_effect = mysql.connector.InterfaceError("gone away")
+        self.mock_pool.get_connection.return_value = mock_cnx
+
+        self.assertIsNone(connect_to_db())
+        mock_cnx.close.assert_called_once()
+
+    def test_connect_to_db_waits_for_free_connection(self):
+        """
+        Test case for connect_to_db when the pool is exhausted for a moment.
+        """
+        mock_cnx = MagicMock()
+        self.mock_pool.get_connection.side_effect = [
+            mysql.connector.pooling.PoolError("exhausted"), mock_cnx]
+
+        with unittest.mock.patch('backend.database.time.sleep') as mock_sleep:
+            self.assertIs(connect_to_db(), mock_cnx)
+
+        mock_sleep.assert_called_once()
+
+    def test_connect_to_db_unreachable(self):
+        """
+        Test case for connect_to_db when the pool cannot be created.
+        """
+        self.mock_pool_class.side_effect = mysql.connector.Error("Can't connect")
+
+        self.assertIsNone(connect_to_db())
+        self.assertIsNone(database.POOL)
+
+    def test_get_pool_driver_choice(self):
+        """
+        Test case for get_pool leaving the driver to mysql.connector unless DB_USE_PURE is set.
+        """
+        with unittest.mock.patch('backend.database.DB_USE_PURE', None):
+            database.get_pool()
+        self.assertNotIn('use_pure', self.mock_pool_class.call_args.kwargs)
+
+        database.POOL = None
+        with unittest.mock.patch('backend.database.DB_USE_PURE', 'true'):
+            database.get_pool()
+        self.assertTrue(self.mock_pool_class.call_args.kwargs['use_pure'])
 
 if __name__ == '__main__':
     unittest.main()
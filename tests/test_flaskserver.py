@@ -2,14 +2,24 @@
 Module for testing the Flask server.
 """
 
+import datetime
+import hashlib
+import io
 import os
 import sys
+import tempfile
+import threading
 import unittest
+import unittest.mock
 from unittest.mock import patch
+import cv2
+import numpy as np
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from backend.flaskserver import app
+from backend import flaskserver
+from backend.flaskserver import app, Broker, READ_CACHE, ReadCache, SPOT_STATES
+from backend.database import LotSnapshot
 
 class FlaskServerTestCase(unittest.TestCase):
     """
@@ -21,6 +31,10 @@ class FlaskServerTestCase(unittest.TestCase):
         Set up the test case.
         """
         self.app = app.test_client()
+        READ_CACHE.invalidate()
+        patcher = patch('backend.flaskserver.fetch_lot_snapshot', create=True, return_value=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
     def test_get_free_spots_negative(self):
         """
@@ -110,5 +124,299 @@ class FlaskServerTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 400)
         self.assertEqual(response.get_json(), {'error': 'Token is missing'})
 
+    def test_get_free_spots_cached(self):
+        """
+        Test that repeated polls of free spots are served from the cache.
+        """
+        with patch('backend.flaskserver.fetch_available_free_spots', create=True,
+                   return_value=5) as mock_fetch:
+            hits = READ_CACHE.stats()['hits']
+            for _ in range(3):
+                response = self.app.get('/free_spots')
+                self.assertEqual(response.get_json(), {'free_spots': 5})
+
+        mock_fetch.assert_called_once()
+        self.assertEqual(READ_CACHE.stats()['hits'] - hits, 2)
+
+    def test_get_free_spots_invalid_not_cached(self):
+        """
+        Test that an invalid count is not kept in the cache.
+        """
+        with patch('backend.flaskserver.fetch_available_free_spots', create=True,
+                   return_value=-1) as mock_fetch:
+            self.app.get('/free_spots')
+            self.app.get('/free_spots')
+
+        self.assertEqual(mock_fetch.call_count, 2)
+
+    def test_invalidate_cache(self):
+        """
+        Test that invalidating the cache makes the next poll read the database.
+        """
+        with patch('backend.flaskserver.fetch_available_handicap_spots', create=True,
+                   side_effect=[1, 0]):
+            self.assertEqual(self.app.get('/free_handicap_spots').get_json(),
+                             {'free_handicap_spots': 1})
+            response = self.app.post('/cache/invalidate', json={'cycle_id': 2})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(self.app.get('/free_handicap_spots').get_json(),
+                             {'free_handicap_spots': 0})
+
+    def test_invalidate_cache_with_wrong_token(self):
+        """
+        Test that invalidation is refused without the configured token.
+        """
+        with patch('backend.flaskserver.CACHE_INVALIDATE_TOKEN', 'secret'):
+            response = self.app.post('/cache/invalidate')
+            self.assertEqual(response.status_code, 403)
+            response = self.app.post('/cache/invalidate', headers={'X-Invalidate-Token': 'secret'})
+            self.assertEqual(response.status_code, 200)
+
+    def test_invalidate_cache_without_token_from_remote_host(self):
+        """
+        Test that without a configured token only local clients may invalidate.
+        """
+        with patch('backend.flaskserver.CACHE_INVALIDATE_TOKEN', None):
+            response = self.app.post('/cache/invalidate', environ_base={'REMOTE_ADDR': '203.0.113.5'})
+            self.assertEqual(response.status_code, 403)
+            response = self.app.post('/cache/invalidate', environ_base={'REMOTE_ADDR': '::1'})
+            self.assertEqual(response.status_code, 200)
+
+    def test_get_cache_stats(self):
+        """
+        Test getting the cache hit and miss counters.
+        """
+        response = self.app.get('/cache/stats')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('hits', response.get_json())
+        self.assertIn('misses', response.get_json())
+
+    def test_get_metrics(self):
+        """
+        Test that /metrics serves the request latencies in the Prometheus text format.
+        """
+        self.app.get('/cache/stats')
+        response = self.app.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain; version=0.0.4'))
+        body = response.get_data(as_text=True)
+        self.assertIn('# TYPE parkspotter_http_request_seconds histogram', body)
+        self.assertIn('parkspotter_http_request_seconds_count{endpoint="/cache/stats",method="GET",status="200"}',
+                      body)
+        self.assertIn('parkspotter_status_subscribers 0', body)
+
+    def test_get_status(self):
+        """
+        Test getting all counters with an ETag and a 304 for an unchanged status.
+        """
+        snapshot = LotSnapshot(3, 1, 10, 2, 'lot.jpg', 42, datetime.datetime(2024, 5, 1, 12, 0))
+        with patch('backend.flaskserver.fetch_lot_snapshot', create=True,
+                   return_value=snapshot) as mock_fetch:
+            response = self.app.get('/status')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.get_json(), {
+                'free_spots': 3, 'free_handicap_spots': 1, 'total_spots': 10,
+                'total_handicap_spots': 2, 'cycle_id': 42, 'updated_at': '2024-05-01T12:00:00',
+            })
+            etag = response.headers['ETag']
+            self.assertTrue(etag.startswith('"42-'))
+
+            response = self.app.get('/status', headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.data, b'')
+
+        mock_fetch.assert_called_once()
+
+    def test_get_status_changes_etag_with_spots(self):
+        """
+        Test that per-spot occupancy sent by the detector is included and changes the ETag.
+        """
+        snapshot = LotSnapshot(3, 1, 10, 2, 'lot.jpg', 42, None)
+        spots = {'north': [{'id': 0, 'handicap': False, 'occupied': True}]}
+        self.addCleanup(SPOT_STATES.update, cycle_id=None, cameras=None)
+        with patch('backend.flaskserver.fetch_lot_snapshot', create=True, return_value=snapshot):
+            etag = self.app.get('/status').headers['ETag']
+            self.app.post('/cache/invalidate', json={'cycle_id': 42, 'spots': spots})
+            response = self.app.get('/status', headers={'If-None-Match': etag})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['spots'], spots)
+
+    def test_invalidate_cache_rejects_invalid_spots(self):
+        """
+        Test that per-spot states not shaped like the detector's are refused and not stored.
+        """
+        self.addCleanup(SPOT_STATES.update, cycle_id=None, cameras=None)
+        spot = {'id': 0, 'handicap': False, 'occupied': True}
+        for spots in (['north'], {'north': spot}, {'north': [{**spot, 'id': 3}]},
+                      {'north': [{**spot, 'occupied': 'yes'}]}, {'north': [{**spot, 'script': 'x'}]},
+                      {'north': [spot] * (flaskserver.MAX_SPOT_STATES + 1)}):
+            response = self.app.post('/cache/invalidate', json={'cycle_id': 1, 'spots': spots})
+            self.assertEqual(response.status_code, 400, spots)
+        response = self.app.post('/cache/invalidate', json={'cycle_id': 'x', 'spots': {'north': [spot]}})
+        self.assertEqual(response.status_code, 400)
+        self.assertIsNone(SPOT_STATES['cameras'])
+
+        response = self.app.post('/cache/invalidate', json={'cycle_id': 1, 'spots': {'north': [spot]}})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(SPOT_STATES['cameras'], {'north': [spot]})
+
+    def test_get_status_unavailable(self):
+        """
+        Test getting the status when the database cannot be read.
+        """
+        with patch('backend.flaskserver.fetch_lot_snapshot', create=True, return_value=None):
+            response = self.app.get('/status')
+            self.assertEqual(response.status_code, 500)
+            self.assertIn('error', response.get_json())
+
+    def test_broker_publish_and_wait(self):
+        """
+        Test that subscribers get a status once and wait for the next change.
+        """
+        broker = Broker()
+
+        self.assertTrue(broker.publish('{"free_spots": 3}', '1-a'))
+        self.assertFalse(broker.publish('{"free_spots": 3}', '1-a'))
+        self.assertEqual(broker.wait(None, 0), (1, '{"free_spots": 3}'))
+        self.assertEqual(broker.wait(1, 0.01), (1, '{"free_spots": 3}'))
+
+        waiter = threading.Thread(target=lambda: results.append(broker.wait(1, 5)))
+        results = []
+        waiter.start()
+        broker.publish('{"free_spots": 2}', '2-b')
+        waiter.join(timeout=5)
+        self.assertEqual(results, [(2, '{"free_spots": 2}')])
+
+    def test_poll_status(self):
+        """
+        Test long-polling the status with a cursor.
+        """
+        snapshot = LotSnapshot(3, 1, 10, 2, 'lot.jpg', 42, None)
+        with patch('backend.flaskserver.fetch_lot_snapshot', create=True, return_value=snapshot), \
+                patch('backend.flaskserver.BROKER', Broker()) as broker, \
+                patch.object(broker, 'watch'):
+            self.app.post('/cache/invalidate', json={'cycle_id': 42})
+            response = self.app.get('/status/poll')
+            self.assertEqual(response.status_code, 200)
+            cursor = response.get_json()['cursor']
+            self.assertEqual(response.get_json()['status']['free_spots'], 3)
+
+            response = self.app.get(f'/status/poll?cursor={cursor}&timeout=0')
+            self.assertEqual(response.status_code, 204)
+            for timeout in ('soon', 'nan', 'inf', '-1'):
+                response = self.app.get(f'/status/poll?timeout={timeout}')
+                self.assertEqual(response.status_code, 400, timeout)
+
+    def test_stream_events(self):
+        """
+        Test that the event stream starts with the current status.
+        """
+        snapshot = LotSnapshot(3, 1, 10, 2, 'lot.jpg', 42, None)
+        with patch('backend.flaskserver.fetch_lot_snapshot', create=True, return_value=snapshot), \
+                patch('backend.flaskserver.BROKER', Broker()) as broker, \
+                patch.object(broker, 'watch'):
+            flaskserver.publish_status()
+            response = self.app.get('/events', buffered=False)
+            self.assertEqual(response.mimetype, 'text/event-stream')
+            event = next(response.response).decode('utf-8')
+            response.close()
+
+        self.assertTrue(event.startswith('id: 1\nevent: status\ndata: {'))
+        self.assertIn('"free_spots": 3', event)
+
+    def save_spots_request(self, data, filename):
+        """
+        Send a /save_spots request uploading the given bytes.
+        """
+        return self.app.put('/save_spots', content_type='multipart/form-data', data={
+            'parking': '10', 'accPark': '2', 'image': (io.BytesIO(data), filename),
+        })
+
+    def test_save_spots_stores_image_once(self):
+        """
+        Test that uploads are stored under their content hash with a preview, and only once.
+        """
+        image = cv2.imencode('.jpg', np.full((400, 600, 3), 128, dtype=np.uint8))[1].tobytes()
+        with tempfile.TemporaryDirectory() as directory, \
+                patch('backend.flaskserver.UPLOAD_DIRECTORY', directory), \
+                patch('backend.flaskserver.save_image', create=True) as mock_save_image, \
+                patch('backend.flaskserver.save_total_spots', create=True), \
+                patch('backend.flaskserver.save_total_handicap_spots', create=True):
+            first = self.save_spots_request(image, 'lot.JPG')
+            second = self.save_spots_request(image, 'other name.jpg')
+            files = sorted(os.listdir(directory))
+            preview = self.app.get(first.get_json()['preview'])
+            preview_shape = cv2.imdecode(np.frombuffer(preview.data, np.uint8), cv2.IMREAD_COLOR).shape
+            preview.close()
+
+        digest = hashlib.sha256(image).hexdigest()
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(files, [f'{digest}.jpg', f'{digest}_preview.jpg'])
+        self.assertEqual(mock_save_image.call_count, 2)
+        self.assertEqual(mock_save_image.call_args.args[0], os.path.join(directory, f'{digest}.jpg'))
+        self.assertEqual(first.get_json()['preview'], f'/previews/{digest}_preview.jpg')
+        self.assertEqual(preview.status_code, 200)
+        self.assertEqual(preview_shape, (200, 300, 3))
+
+    def test_save_spots_keeps_earlier_image(self):
+        """
+        Test that an image stored by an earlier upload is kept when its missing preview cannot be made.
+        """
+        image = cv2.imencode('.jpg', np.full((40, 60, 3), 128, dtype=np.uint8))[1].tobytes()
+        with tempfile.TemporaryDirectory() as directory, \
+                patch('backend.flaskserver.UPLOAD_DIRECTORY', directory), \
+                patch('backend.flaskserver.write_preview', return_value=None):
+            image_path = os.path.join(directory, hashlib.sha256(image).hexdigest() + '.jpg')
+            with open(image_path, 'wb') as file:
+                file.write(image)
+            response = self.save_spots_request(image, 'lot.jpg')
+            files = os.listdir(directory)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(files, [os.path.basename(image_path)])
+
+    def test_save_spots_too_large(self):
+        """
+        Test that an upload over the size limit is refused and not kept.
+        """
+        with tempfile.TemporaryDirectory() as directory, \
+                patch('backend.flaskserver.UPLOAD_DIRECTORY', directory), \
+                patch('backend.flaskserver.UPLOAD_MAX_BYTES', 1000):
+            response = self.save_spots_request(b'x' * 5000, 'lot.jpg')
+            files = os.listdir(directory)
+
+        self.assertEqual(response.status_code, 413)
+        self.assertIn('error', response.get_json())
+        self.assertEqual(files, [])
+
+    def test_save_spots_unsupported_type(self):
+        """
+        Test that uploads which are not images are refused and not kept.
+        """
+        with tempfile.TemporaryDirectory() as directory, \
+                patch('backend.flaskserver.UPLOAD_DIRECTORY', directory):
+            response = self.save_spots_request(b'#!/bin/sh', 'script.sh')
+            not_an_image = self.save_spots_request(b'not a jpeg', 'lot.jpg')
+            files = os.listdir(directory)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(not_an_image.status_code, 400)
+        self.assertEqual(files, [])
+
+    def test_read_cache_expires(self):
+        """
+        Test that cached values are read again after the TTL.
+        """
+        cache = ReadCache(ttl=0)
+        loader = unittest.mock.Mock(return_value=3)
+
+        cache.get('key', loader)
+        cache.get('key', loader)
+
+        self.assertEqual(loader.call_count, 2)
+        self.assertEqual(cache.stats()['misses'], 2)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,218 @@
+"""
+This module contains unit tests for the metrics module.
+"""
+
+import importlib
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+import urllib.error
+import urllib.request
+from unittest.mock import patch
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from backend import metrics
+
+
+class TestMetrics(unittest.TestCase):
+    """
+    This class contains unit tests for the counters, histograms and their rendering.
+    """
+
+    def setUp(self):
+        """
+        Give every test a registry of its own.
+        """
+        self.registry = metrics.Registry()
+
+    def test_counter_counts_per_label(self):
+        """
+        This method tests that a counter keeps one count per label combination.
+        """
+        counter = metrics.Counter('frames_total', 'Frames.', ['camera'], registry=self.registry)
+        counter.inc(camera='north')
+        counter.inc(3, camera='north')
+        counter.inc(camera='south')
+
+        self.assertEqual(counter.value(camera='north'), 4)
+        self.assertEqual(counter.value(camera='south'), 1)
+        self.assertEqual(counter.value(camera='east'), 0)
+
+    def test_labels_are_checked(self):
+        """
+        This method tests that missing or unknown labels raise ValueError.
+        """
+        counter = metrics.Counter('frames_total', 'Frames.', ['camera'], registry=self.registry)
+
+        with self.assertRaises(ValueError):
+            counter.inc()
+        with self.assertRaises(ValueError):
+            counter.inc(camera='north', stage='grab')
+        with self.assertRaises(ValueError):
+            counter.inc(stage='grab')
+
+    def test_same_metric_registered_twice_is_shared(self):
+        """
+        This method tests that registering a metric again records into the first one,
+        and that a name cannot be registered with another type or labels.
+        """
+        first = metrics.Counter('frames_total', 'Frames.', ['camera'], registry=self.registry)
+        second = metrics.Counter('frames_total', 'Frames.', ['camera'], registry=self.registry)
+        first.inc(camera='north')
+        second.inc(camera='north')
+
+        self.assertEqual(first.value(camera='north'), 2)
+        self.assertEqual(self.registry.render().count('frames_total{camera="north"} 2'), 1)
+        with self.assertRaises(ValueError):
+            metrics.Gauge('frames_total', 'Frames.', ['camera'], registry=self.registry)
+        with self.assertRaises(ValueError):
+            metrics.Counter('frames_total', 'Frames.', ['stage'], registry=self.registry)
+
+    def test_module_imported_under_both_paths(self):
+        """
+        This method tests that the database module can be imported as database and as
+        backend.database in one process, like the benchmarks and the unit tests do.
+        """
+        backend_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend')
+        with patch.object(sys, 'path', [backend_dir] + sys.path), patch.dict(sys.modules):
+            for name in ('database', 'backend.database', 'metrics', 'backend.metrics'):
+                sys.modules.pop(name, None)
+            flat = importlib.import_module('database')
+            package = importlib.import_module('backend.database')
+
+            flat.DB_ERRORS.inc(operation='connect')
+            package.DB_ERRORS.inc(operation='connect')
+
+            self.assertIsNot(flat, package)
+            self.assertEqual(package.DB_ERRORS.value(operation='connect'), 2)
+
+    def test_histogram_renders_cumulative_buckets(self):
+        """
+        This method tests that observations are rendered as cumulative buckets with a sum and a count.
+        """
+        histogram = metrics.Histogram('stage_seconds', 'Stage time.', ['stage'],
+                                      registry=self.registry, buckets=(0.1, 1.0))
+        for seconds in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(seconds, stage='roi')
+
+        self.assertEqual(histogram.count(stage='roi'), 4)
+        self.assertEqual(self.registry.render().splitlines(), [
+            '# HELP stage_seconds Stage time.',
+            '# TYPE stage_seconds histogram',
+            'stage_seconds_bucket{stage="roi",le="0.1"} 2',
+            'stage_seconds_bucket{stage="roi",le="1"} 3',
+            'stage_seconds_bucket{stage="roi",le="+Inf"} 4',
+            'stage_seconds_sum{stage="roi"} 2.65',
+            'stage_seconds_count{stage="roi"} 4',
+        ])
+
+    def test_histogram_time(self):
+        """
+        This method tests timing a with block and every call of a decorated function.
+        """
+        histogram = metrics.Histogram('query_seconds', 'Query time.', ['operation'], registry=self.registry)
+
+        with histogram.time(operation='read'):
+            pass
+
+        @histogram.time(operation='write')
+        def write():
+            return 'written'
+
+        self.assertEqual(write(), 'written')
+        self.assertEqual(write(), 'written')
+        self.assertEqual(histogram.count(operation='read'), 1)
+        self.assertEqual(histogram.count(operation='write'), 2)
+
+    def test_gauge_function_and_label_escaping(self):
+        """
+        This method tests that a gauge reads its function on render and that label values are escaped.
+        """
+        metrics.Gauge('subscribers', 'Subscribers.', registry=self.registry, function=lambda: 7)
+        gauge = metrics.Gauge('layout', 'Layout.', ['path'], registry=self.registry)
+        gauge.set(1.5, path='C:\\lots\\"north"\n')
+
+        text = self.registry.render()
+
+        self.assertIn('subscribers 7\n', text)
+        self.assertIn('layout{path="C:\\\\lots\\\\\\"north\\"\\n"} 1.5\n', text)
+
+    def test_shared_registries_are_summed(self):
+        """
+        This method tests that registries sharing a directory render the sum of their values.
+        """
+        with tempfile.TemporaryDirectory() as directory, patch.object(metrics.atexit, 'register'):
+            workers = []
+            for name in ('worker1', 'worker2'):
+                registry = metrics.Registry()
+                counter = metrics.Counter('requests_total', 'Requests.', ['endpoint'], registry=registry)
+                histogram = metrics.Histogram('request_seconds', 'Request time.', registry=registry,
+                                              buckets=(0.1, 1.0))
+                metrics.Gauge('subscribers', 'Subscribers.', registry=registry, function=lambda: 2)
+                registry.share(directory, interval=0, name=name)
+                workers.append((registry, counter, histogram))
+            workers[0][1].inc(endpoint='/status')
+            workers[0][2].observe(0.05)
+            workers[1][1].inc(2, endpoint='/status')
+            workers[1][2].observe(0.5)
+            workers[1][0].write_snapshot()
+
+            text = workers[0][0].render()
+
+        self.assertIn('requests_total{endpoint="/status"} 3\n', text)
+        self.assertIn('request_seconds_bucket{le="0.1"} 1\n', text)
+        self.assertIn('request_seconds_bucket{le="1"} 2\n', text)
+        self.assertIn('request_seconds_count 2\n', text)
+        self.assertIn('subscribers 4\n', text)
+        self.assertEqual(text.count('# TYPE requests_total counter'), 1)
+
+    def test_exited_registries_are_archived(self):
+        """
+        This method tests that the counters of an exited process are kept in the archive
+        and counted once, and that its gauges are dropped.
+        """
+        exited = subprocess.Popen([sys.executable, '-c', ''])
+        exited.wait()
+        with tempfile.TemporaryDirectory() as directory, patch.object(metrics.atexit, 'register'):
+            workers = []
+            for name in ('worker1', 'worker2'):
+                registry = metrics.Registry()
+                counter = metrics.Counter('requests_total', 'Requests.', registry=registry)
+                metrics.Gauge('subscribers', 'Subscribers.', registry=registry, function=lambda: 2)
+                registry.share(directory, interval=0, name=name)
+                workers.append((registry, counter))
+            workers[0][1].inc(2)
+            workers[1][1].inc(3)
+            workers[1][0].pid = exited.pid
+            workers[1][0].write_snapshot()
+
+            first = workers[0][0].render()
+            second = workers[0][0].render()
+            files = sorted(os.listdir(directory))
+
+        self.assertIn('requests_total 5\n', first)
+        self.assertIn('subscribers 2\n', first)
+        self.assertEqual(first, second)
+        self.assertEqual([name for name in files if name.endswith('.json')], ['exited.json', 'worker1.json'])
+
+    def test_http_server_serves_metrics(self):
+        """
+        This method tests that the sidecar server answers a scrape of /metrics and nothing else.
+        """
+        metrics.Counter('scrapes_total', 'Scrapes.', registry=self.registry).inc()
+        server = metrics.start_http_server(0, '127.0.0.1', self.registry)
+        try:
+            url = f"http://127.0.0.1:{server.server_address[1]}"
+            with urllib.request.urlopen(f"{url}/metrics", timeout=5) as response:
+                self.assertEqual(response.headers['Content-Type'], metrics.CONTENT_TYPE)
+                self.assertIn('scrapes_total 1', response.read().decode('utf-8'))
+            with self.assertRaises(urllib.error.HTTPError):
+                urllib.request.urlopen(f"{url}/", timeout=5)  # pylint: disable=consider-using-with
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
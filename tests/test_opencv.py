@@ -6,6 +6,7 @@ import unittest
 from unittest import mock
 import sys
 import os
+import tempfile
 import cv2
 import numpy as np
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
@@ -49,7 +50,24 @@ class TestImageEditor(unittest.TestCase):
         """
         Test case for the load_points method.
         """
-        with mock.patch('pickle.load', return_value=self.points):
+        spots = [([(100, 100), (200, 100), (200, 200)], False), ([(300, 300), (400, 300), (400, 400)], True)]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'spots.layout')
+            with mock.patch('backend.opencv.LAYOUT_PATH', path):
+                editor = ImageEditor()
+                editor.saved_points = spots
+                editor.save_points()
+                loaded_points = editor.load_points()
+                self.assertEqual(loaded_points, spots)
+
+    @mock.patch('backend.opencv.fetch_image', return_value="test_image_path")
+    def test_load_points_legacy(self, mock_fetch_image):
+        """
+        Test case for loading points from the old pickle file when there is no layout file.
+        """
+        with tempfile.TemporaryDirectory() as directory, \
+             mock.patch('backend.opencv.LAYOUT_PATH', os.path.join(directory, 'missing.layout')), \
+             mock.patch('pickle.load', return_value=self.points):
             editor = ImageEditor()
             loaded_points = editor.load_points()
             self.assertEqual(loaded_points, self.points)
@@ -67,21 +85,49 @@ class TestImageEditor(unittest.TestCase):
             self.assertTrue(editor.is_drawing)
             self.assertEqual(editor.current_points, [(100, 100)])
 
+    @mock.patch('backend.opencv.fetch_image', return_value="test_image_path")
+    def test_click_and_draw_simplifies(self, mock_fetch_image):
+        """
+        Test case for simplifying a drawn spot when the mouse button is released.
+        """
+        with mock.patch('cv2.circle'), \
+             mock.patch('cv2.polylines'), \
+             mock.patch('cv2.imshow'):
+            editor = ImageEditor()
+            editor.saved_points = []
+            editor.click_and_draw(cv2.EVENT_RBUTTONDOWN, 0, 0, None, None)
+            for x in range(1, 100):
+                editor.click_and_draw(cv2.EVENT_MOUSEMOVE, x, 0, None, None)
+            for y in range(1, 50):
+                editor.click_and_draw(cv2.EVENT_MOUSEMOVE, 99, y, None, None)
+            for x in range(98, -1, -1):
+                editor.click_and_draw(cv2.EVENT_MOUSEMOVE, x, 49, None, None)
+            editor.click_and_draw(cv2.EVENT_RBUTTONUP, 0, 25, None, None)
+
+            points, is_handicap = editor.saved_points[0]
+            self.assertTrue(is_handicap)
+            self.assertEqual(sorted(points), [(0, 0), (0, 49), (99, 0), (99, 49)])
+
     @mock.patch('backend.opencv.fetch_image', return_value="test_image_path")
     def test_save_points(self, mock_fetch_image):
         """
         Test case for the save_points method.
         """
-        with mock.patch('pickle.dump'):
-            editor = ImageEditor()
-            editor.save_points()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'spots.layout')
+            with mock.patch('backend.opencv.LAYOUT_PATH', path):
+                editor = ImageEditor()
+                editor.save_points()
+                self.assertTrue(os.path.exists(path))
 
     @mock.patch('backend.opencv.fetch_image', return_value="test_image_path")
     def test_run(self, mock_fetch_image):
         """
         Test case for the run method.
         """
-        with mock.patch('cv2.polylines'), \
+        with tempfile.TemporaryDirectory() as directory, \
+             mock.patch('backend.opencv.LAYOUT_PATH', os.path.join(directory, 'spots.layout')), \
+             mock.patch('cv2.polylines'), \
              mock.patch('cv2.namedWindow'), \
              mock.patch('cv2.setMouseCallback'), \
              mock.patch('cv2.imshow'), \
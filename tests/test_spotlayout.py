@@ -0,0 +1,134 @@
+"""
+This module contains unit tests for the spotlayout module.
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+import numpy as np
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from backend import spotlayout
+
+
+def freehand_rectangle(x, y, width, height):
+    """
+    Trace a rectangle one pixel at a time like a mouse stroke.
+    """
+    points = [(x + dx, y) for dx in range(width)]
+    points += [(x + width, y + dy) for dy in range(height)]
+    points += [(x + width - dx, y + height) for dx in range(width)]
+    points += [(x, y + height - dy) for dy in range(height)]
+    return points
+
+
+class TestSpotLayout(unittest.TestCase):
+    """
+    This class contains unit tests for the spot layout functions.
+    """
+
+    def setUp(self):
+        """
+        This method creates a temporary directory for the layout files.
+        """
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'spots.layout')
+
+    def tearDown(self):
+        """
+        This method removes the temporary directory.
+        """
+        self.directory.cleanup()
+
+    def test_simplify_polygon(self):
+        """
+        This method tests that a freehand stroke is reduced to its corners.
+        """
+        simplified = spotlayout.simplify_polygon(freehand_rectangle(10, 20, 200, 100))
+
+        self.assertEqual(simplified.dtype, np.int32)
+        self.assertEqual(sorted(map(tuple, simplified.tolist())),
+                         [(10, 20), (10, 120), (210, 20), (210, 120)])
+
+    def test_simplify_polygon_bounds_vertices(self):
+        """
+        This method tests that a polygon with many true corners is coarsened to the vertex limit.
+        """
+        angles = np.linspace(0, 2 * np.pi, 400, endpoint=False)
+        radius = 200 + 60 * (np.arange(400) % 2)
+        star = np.stack([500 + radius * np.cos(angles), 500 + radius * np.sin(angles)], axis=1)
+
+        simplified = spotlayout.simplify_polygon(star.astype(np.int32), max_vertices=8)
+
+        self.assertGreaterEqual(len(simplified), 3)
+        self.assertLessEqual(len(simplified), 8)
+
+    def test_simplify_polygon_degenerate_stroke(self):
+        """
+        This method tests that a straight stroke keeps the area it covered.
+        """
+        simplified = spotlayout.simplify_polygon([(x, 50) for x in range(100)])
+
+        self.assertEqual(len(simplified), 4)
+
+    def test_round_trip(self):
+        """
+        This method tests that saved spots are loaded back with their ids, flags and vertices.
+        """
+        spots = [([(0, 0), (10, 0), (10, 10)], False), ([(20, 20), (30, 20), (30, 30), (20, 30)], True)]
+
+        spotlayout.save_layout(self.path, spots)
+        layout = spotlayout.load_layout(self.path)
+
+        self.assertEqual(os.path.getsize(self.path), 4 * (4 + 2 * 4 + 2 * 7))
+        np.testing.assert_array_equal(layout.ids, [0, 1])
+        np.testing.assert_array_equal(layout.flags, [0, spotlayout.FLAG_HANDICAP])
+        np.testing.assert_array_equal(layout.spans, [[0, 3], [3, 4]])
+        polygons = spotlayout.layout_polygons(layout)
+        np.testing.assert_array_equal(polygons[0], spots[0][0])
+        np.testing.assert_array_equal(polygons[1], spots[1][0])
+
+    def test_load_layout_releases_file(self):
+        """
+        This method tests that a loaded layout holds no view of the file, so the file can be
+        replaced while the layout is in use.
+        """
+        spotlayout.save_layout(self.path, [(freehand_rectangle(0, 0, 50, 30), False)])
+        layout = spotlayout.load_layout(self.path)
+        polygon = spotlayout.layout_polygons(layout)[0].copy()
+
+        spotlayout.save_layout(self.path, [([(5, 5), (9, 5), (9, 9)], True)])
+
+        self.assertNotIsInstance(layout.vertices, np.memmap)
+        self.assertTrue(np.shares_memory(spotlayout.layout_polygons(layout)[0], layout.vertices))
+        np.testing.assert_array_equal(spotlayout.layout_polygons(layout)[0], polygon)
+        self.assertEqual(spotlayout.load_layout(self.path).flags.tolist(), [spotlayout.FLAG_HANDICAP])
+
+    def test_save_layout_replaces_file(self):
+        """
+        This method tests that saving replaces the layout and leaves no temporary files.
+        """
+        spotlayout.save_layout(self.path, [([(0, 0), (10, 0), (10, 10)], False)] * 3)
+        spotlayout.save_layout(self.path, [])
+
+        self.assertEqual(len(spotlayout.load_layout(self.path).ids), 0)
+        self.assertEqual(os.listdir(self.directory.name), ['spots.layout'])
+
+    def test_load_layout_rejects_invalid_files(self):
+        """
+        This method tests that files that are not complete layouts raise ValueError.
+        """
+        with open(self.path, 'wb') as file:
+            file.write(b'\x80\x04not a layout file')
+        with self.assertRaises(ValueError):
+            spotlayout.load_layout(self.path)
+
+        spotlayout.save_layout(self.path, [([(0, 0), (10, 0), (10, 10)], False)])
+        with open(self.path, 'r+b') as file:
+            file.truncate(os.path.getsize(self.path) - 4)
+        with self.assertRaises(ValueError):
+            spotlayout.load_layout(self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
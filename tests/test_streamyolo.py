@@ -5,6 +5,8 @@ This module contains unit tests for the streamyolo module.
 import os
 import sys
 import time
+import pickle
+import tempfile
 import threading
 import unittest
 from unittest.mock import Mock, patch
@@ -14,6 +16,28 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')
 sys.modules['database'] = Mock()
 import backend.streamyolo as streamyolo
 from backend.streamyolo import boxes_overlap
+from backend.spotlayout import save_layout
+
+
+def make_result(xyxy, cls, conf):
+    """
+    Build a stand-in for an ultralytics result holding the given detections.
+    """
+    result = Mock()
+    result.boxes.xyxy.cpu.return_value.numpy.return_value = np.array(xyxy, dtype=float)
+    result.boxes.cls.cpu.return_value.numpy.return_value = np.array(cls, dtype=float)
+    result.boxes.conf.cpu.return_value.numpy.return_value = np.array(conf, dtype=float)
+    return result
+
+
+def make_camera(name, cycles, occupied, states=(), handicap=()):
+    """
+    Build a stand-in for a camera with the given counts and per-spot states.
+    """
+    camera = Mock(cycles=cycles, occupied=occupied, layout={'is_handicap': np.array(handicap, dtype=bool)})
+    camera.name = name
+    camera.tracker.states = np.array(states, dtype=bool)
+    return camera
 
 
 class TestStreamYolo(unittest.TestCase):
@@ -80,16 +104,92 @@ class TestStreamYolo(unittest.TestCase):
         box2 = [0, 0, 2, 1]
         self.assertTrue(boxes_overlap(box1, box2))
 
+    def test_suppress_duplicates_matches_boxes_overlap(self):
+        """
+        This method tests that vectorized suppression keeps the same boxes as the pairwise loop.
+        """
+        rng = np.random.default_rng(2)
+        corners = rng.uniform(0, 300, (60, 2))
+        boxes = np.concatenate([corners, corners + rng.uniform(20, 60, (60, 2))], axis=1)
+        boxes[30:] = boxes[:30] + rng.normal(0, 2, (30, 4))
+
+        expected = []
+        for box in boxes:
+            expected.append(not any(boxes_overlap(box, other) for other, kept
+                                    in zip(boxes, expected) if kept))
+
+        keep = streamyolo.suppress_duplicates(boxes, block_size=16)
+
+        np.testing.assert_array_equal(keep, expected)
+
+    def test_suppress_duplicates_class_aware(self):
+        """
+        This method tests that class aware suppression keeps overlapping boxes of different classes.
+        """
+        boxes = [[0, 0, 10, 10], [0, 0, 10, 9], [0, 0, 10, 9.5]]
+
+        self.assertEqual(streamyolo.suppress_duplicates(boxes).tolist(), [True, False, False])
+        self.assertEqual(streamyolo.suppress_duplicates(boxes, class_ids=[2, 7, 2]).tolist(),
+                         [True, True, False])
+
+    def test_frame_grabber_decodes_on_demand(self):
+        """
+        This method tests that the grabber only grabs in the background and decodes on read,
+        counting the frames it never decoded as skipped.
+        """
+        capture = Mock()
+        capture.isOpened.return_value = True
+        capture.retrieve.return_value = (True, 'frame')
+        grabber = streamyolo.FrameGrabber('stream', capture, name='lobby')
+
+        self.assertIsNone(grabber.read())
+
+        def grab():
+            if capture.grab.call_count >= 3:
+                grabber.stop_event.set()
+            return True
+        capture.grab.side_effect = grab
+        grabber.run()
+
+        self.assertEqual(grabber.read(), 'frame')
+        capture.retrieve.assert_called_once()
+        self.assertEqual(streamyolo.FRAMES.value(camera='lobby', outcome='decoded'), 1)
+        self.assertEqual(streamyolo.FRAMES.value(camera='lobby', outcome='skipped'), 2)
+
     @patch('backend.streamyolo.cv2.VideoCapture')
-    @patch('backend.streamyolo.pickle.load')
+    def test_frame_grabber_reconnects(self, mock_video_capture):
+        """
+        This method tests that the grabber reopens the stream when it drops.
+        """
+        dropped = Mock()
+        dropped.isOpened.return_value = True
+        dropped.grab.return_value = False
+        reopened = mock_video_capture.return_value
+        reopened.isOpened.return_value = True
+        grabber = streamyolo.FrameGrabber('stream', dropped, reconnect_delay=0)
+
+        def grab():
+            grabber.stop_event.set()
+            return True
+        reopened.grab.side_effect = grab
+        grabber.run()
+
+        dropped.release.assert_called_once()
+        mock_video_capture.assert_called_once_with('stream')
+        self.assertIs(grabber.capture, reopened)
+        self.assertTrue(grabber.has_frame)
+
+    @patch('backend.streamyolo.cv2.VideoCapture')
+    @patch('backend.streamyolo.read_points')
     @patch('backend.streamyolo.YOLO')
-    def test_load_resources(self, mock_yolo, mock_pickle_load, mock_video_capture):
+    def test_load_resources(self, mock_yolo, mock_read_points, mock_video_capture):
         """
         This method tests the load_resources function.
         """
         mock_yolo.return_value = 'dummy_model'
         mock_video_capture.return_value.isOpened.return_value = True
-        mock_pickle_load.return_value = [([[0, 0], [10, 10]], False), ([[20, 20], [30, 30]], True)]
+        mock_read_points.return_value = ([np.array([[0, 0], [10, 0], [10, 10]], dtype=np.int32)],
+                                         [np.array([[20, 20], [30, 20], [30, 30]], dtype=np.int32)])
 
         streamyolo.load_resources()
 
@@ -137,6 +237,568 @@ class TestStreamYolo(unittest.TestCase):
 
         mock_polylines.assert_called_once()
 
+    def test_get_regions_of_interest_matches_full_frame_mask(self):
+        """
+        This method tests that the compiled crops equal masking the full frame.
+        """
+        frame = np.random.default_rng(0).integers(0, 255, (120, 160, 3), dtype=np.uint8)
+        points = np.array([[10, 20], [60, 15], [70, 80], [5, 70]])
+        mask = np.zeros(frame.shape[:2], dtype=np.uint8)
+        cv2.drawContours(mask, [points], -1, (255), thickness=cv2.FILLED)
+        expected = cv2.bitwise_and(frame, frame, mask=mask)[15:81, 5:71]
+
+        spots = streamyolo.compile_spots([points], frame.shape)
+        regions, scales_and_offsets = streamyolo.get_regions_of_interest(frame, spots)
+
+        self.assertEqual(spots[0].rect, (5, 15, 66, 66))
+        self.assertEqual(spots[0].mask.shape, (66, 66))
+        self.assertEqual(scales_and_offsets, [(160 / 66, (5, 15))])
+        self.assertEqual(regions[0].shape, (160, 160, 3))
+        np.testing.assert_array_equal(regions[0], cv2.resize(expected, None, fx=160 / 66, fy=160 / 66))
+
+    def test_read_points_binary_layout(self):
+        """
+        This method tests reading the normal and handicap spots from a binary layout file.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'spots.layout')
+            spots = [([(0, 0), (10, 0), (10, 10)], False), ([(20, 20), (30, 20), (30, 30)], True)]
+            save_layout(path, spots)
+
+            normal_points, handicap_points = streamyolo.read_points(path)
+
+        np.testing.assert_array_equal(normal_points[0], [[0, 0], [10, 0], [10, 10]])
+        np.testing.assert_array_equal(handicap_points[0], [[20, 20], [30, 20], [30, 30]])
+
+    def test_refresh_layout_rebuilds_on_change(self):
+        """
+        This method tests that the layout cache is rebuilt only when the file content changes.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'spots.pkl')
+            with open(path, 'wb') as file:
+                pickle.dump([([(0, 0), (10, 0), (10, 10)], False)], file)
+
+            with patch.object(streamyolo, 'NORMAL_POINTS_NP', None), \
+                 patch.dict(streamyolo.LAYOUT_CACHE, {'path': path, 'signature': None,
+                                                      'frame_shape': None,
+                                                      'normal_points': None}):
+                streamyolo.refresh_layout((100, 100))
+                compiled = streamyolo.LAYOUT_CACHE['normal']
+                streamyolo.refresh_layout((100, 100))
+                self.assertIs(streamyolo.LAYOUT_CACHE['normal'], compiled)
+
+                with open(path, 'wb') as file:
+                    pickle.dump([([(0, 0), (10, 0), (10, 10)], True)], file)
+                os.utime(path, ns=(0, 0))
+                streamyolo.refresh_layout((100, 100))
+                self.assertEqual(len(streamyolo.LAYOUT_CACHE['normal']), 0)
+                self.assertEqual(len(streamyolo.LAYOUT_CACHE['handicap']), 1)
+
+    def test_frame_windows_cover_frame(self):
+        """
+        This method tests that the detection windows overlap and cover the whole frame.
+        """
+        windows = streamyolo.frame_windows((1080, 1920), grid=(2, 2), overlap=0.2)
+
+        self.assertEqual(len(windows), 4)
+        self.assertEqual(max(x + w for x, _, w, _ in windows), 1920)
+        self.assertEqual(max(y + h for _, y, _, h in windows), 1080)
+        self.assertLess(windows[1][0], windows[0][2])
+
+    def test_count_vehicles_full_frame_mode(self):
+        """
+        This method tests that full frame mode runs a single inference pass.
+        """
+        frame = np.zeros((640, 640, 3), dtype=np.uint8)
+        model = Mock(return_value=[
+            make_result([[10, 10, 30, 30], [100, 100, 120, 120], [300, 300, 320, 320]],
+                        [2, 2, 2], [0.9, 0.9, 0.9])
+        ])
+        normal = [np.array([[0, 0], [50, 0], [50, 50], [0, 50]])]
+        handicap = [np.array([[90, 90], [130, 90], [130, 130], [90, 130]])]
+
+        layout = {
+            'normal': streamyolo.compile_spots(normal, frame.shape),
+            'handicap': streamyolo.compile_spots(handicap, frame.shape),
+            'labels': streamyolo.build_label_map(normal, handicap, frame.shape, 2),
+            'is_handicap': np.array([False, True]),
+        }
+
+        with patch.object(streamyolo, 'MODEL', model), \
+             patch.object(streamyolo, 'refresh_layout'), \
+             patch.object(streamyolo, 'CHANGE_GATE', streamyolo.ChangeGate()), \
+             patch.object(streamyolo, 'LABEL_MAP_DOWNSCALE', 2), \
+             patch.dict(streamyolo.LAYOUT_CACHE, layout):
+            normal_cars, handicap_cars, occupancy = streamyolo.count_vehicles(frame, mode='full')
+
+        self.assertEqual((normal_cars, handicap_cars), (1, 1))
+        np.testing.assert_array_equal(occupancy, [True, True])
+        model.assert_called_once()
+
+    def test_change_gate_skips_unchanged_spots(self):
+        """
+        This method tests that only changed spots are inferred and the rest reuse their detections.
+        """
+        frame = np.zeros((100, 100, 3), dtype=np.uint8)
+        spots = streamyolo.compile_spots([
+            np.array([[0, 0], [40, 0], [40, 40], [0, 40]]),
+            np.array([[50, 50], [90, 50], [90, 90], [50, 90]]),
+        ], frame.shape)
+        gate = streamyolo.ChangeGate(threshold=5, refresh_cycles=3)
+        detections = (np.array([[1, 1, 9, 9], [60, 60, 80, 80]]), np.array([2, 7]),
+                      np.array([0.9, 0.9]), np.array([0, 1]))
+
+        self.assertEqual(gate.select(frame, spots), [0, 1])
+        gate.update([0, 1], detections)
+
+        frame[60:80, 60:80] = 255
+        self.assertEqual(gate.select(frame, spots), [1])
+        boxes, class_ids = gate.update([1], (np.empty((0, 4)), np.empty(0),
+                                             np.empty(0), np.empty(0, dtype=int)))
+        np.testing.assert_array_equal(boxes, [[1, 1, 9, 9]])
+        np.testing.assert_array_equal(class_ids, [2])
+
+        self.assertEqual(gate.select(frame, spots), [])
+        gate.update([], (np.empty((0, 4)), np.empty(0), np.empty(0), np.empty(0, dtype=int)))
+        self.assertEqual(gate.select(frame, spots), [0, 1])
+        self.assertAlmostEqual(gate.skip_ratio, 3 / 8)
+
+    def test_occupancy_tracker_debounces_single_frames(self):
+        """
+        This method tests that one missed detection does not flip a spot but a lasting change does.
+        """
+        tracker = streamyolo.OccupancyTracker(alpha=0.5, occupied_threshold=0.7,
+                                              free_threshold=0.3)
+
+        np.testing.assert_array_equal(tracker.update([True, False]), [0, 1])
+        np.testing.assert_array_equal(tracker.update([False, True]), [])
+        np.testing.assert_array_equal(tracker.states, [True, False])
+        np.testing.assert_array_equal(tracker.update([False, True]), [0, 1])
+        np.testing.assert_array_equal(tracker.states, [False, True])
+        np.testing.assert_array_equal(tracker.update([False, True]), [])
+
+    def test_inference_server_merges_requests(self):
+        """
+        This method tests that queued requests share one batch and get their own detections back.
+        """
+        # The regions are padded into 160 tiles at (48, 48)
+        model = Mock(side_effect=lambda tiles, imgsz: [
+            make_result([[48, 48, 112, 112]], [2], [0.9]) for _ in tiles
+        ])
+        server = streamyolo.InferenceServer([model], batch_size=8)
+        region = np.zeros((64, 64, 3), dtype=np.uint8)
+        futures = []
+        for offset in (0, 100):
+            future = streamyolo.Future()
+            server.requests.put(([region, region], [(1, (offset, 0))] * 2, future))
+            futures.append(future)
+        server.requests.put(None)
+
+        server.run(model)
+
+        model.assert_called_once()
+        boxes, _, _, region_ids = futures[1].result()
+        np.testing.assert_allclose(boxes, [[100, 0, 164, 64]] * 2)
+        np.testing.assert_array_equal(region_ids, [0, 1])
+
+    @patch('backend.streamyolo.YOLO')
+    def test_process_inference_server(self, mock_yolo):
+        """
+        This method tests the shared memory handoff between the server and an inference worker.
+        """
+        seen_tiles = []
+
+        def predict(tiles, imgsz):
+            seen_tiles.extend(tile.copy() for tile in tiles)
+            return [make_result([[60, 110, 260, 210]], [2], [0.9]) for _ in tiles]
+        mock_yolo.return_value.side_effect = predict
+
+        server = streamyolo.ProcessInferenceServer('model.pt', workers=0, batch_size=2, slots=2)
+        worker = threading.Thread(target=streamyolo.inference_worker, args=(
+            'model.pt', server.ring.name, 2, streamyolo.TILE_SIZE, server.jobs, server.results))
+        worker.start()
+        server.collector.start()
+        try:
+            regions = [np.full((100, 200, 3), value, dtype=np.uint8) for value in (10, 20, 30)]
+            boxes, _, _, region_ids = server.infer(regions, [(2, (10, 20))] * 3)
+        finally:
+            server.jobs.put(None)
+            worker.join(timeout=10)
+            server.stop()
+
+        np.testing.assert_allclose(boxes, [[10, 20, 110, 70]] * 3)
+        np.testing.assert_array_equal(region_ids, [0, 1, 2])
+        self.assertEqual([tile.shape for tile in seen_tiles], [(320, 320, 3)] * 3)
+        self.assertEqual([int(tile[160, 160, 0]) for tile in seen_tiles], [10, 20, 30])
+
+    def test_shared_tile_ring_reserves_whole_batches(self):
+        """
+        This method tests that a request waiting for slots holds none of them until all are free.
+        """
+        ring = streamyolo.SharedTileRing(4, tile_size=8)
+        try:
+            first = ring.acquire(3)
+            acquired = []
+            waiter = threading.Thread(target=lambda: acquired.append(ring.acquire(2, timeout=5)))
+            waiter.start()
+            time.sleep(0.1)
+            self.assertEqual(acquired, [])
+            self.assertEqual(len(ring.free), 1)
+
+            ring.release(first)
+            waiter.join(timeout=5)
+
+            self.assertEqual(len(acquired[0]), 2)
+            self.assertEqual(len(ring.free), 2)
+            with self.assertRaises(TimeoutError):
+                ring.acquire(3, timeout=0.01)
+            with self.assertRaises(ValueError):
+                ring.acquire(5)
+        finally:
+            ring.close()
+
+    def test_process_inference_server_fails_requests_of_dead_worker(self):
+        """
+        This method tests that requests fail instead of hanging once an inference process died.
+        """
+        server = streamyolo.ProcessInferenceServer('model.pt', workers=0, batch_size=4, slots=2, timeout=5)
+        dead = Mock(exitcode=-9, pid=1234)
+        dead.is_alive.return_value = False
+        try:
+            self.assertEqual(server.batch_size, 2)
+            future = server.submit([np.zeros((10, 10, 3), dtype=np.uint8)], [(1, (0, 0))], 160)
+            server.processes = [dead]
+
+            self.assertTrue(server.check_workers())
+            with self.assertRaises(RuntimeError):
+                future.result(timeout=1)
+            self.assertEqual(len(server.ring.free), 2)
+            self.assertFalse(server.check_workers())
+            with self.assertRaises(RuntimeError):
+                server.infer([np.zeros((10, 10, 3), dtype=np.uint8)], [(1, (0, 0))])
+        finally:
+            server.ring.close()
+
+    @patch('backend.streamyolo.notify_counts_changed')
+    @patch('backend.streamyolo.save_free_counts', return_value=7)
+    @patch('backend.streamyolo.fetch_lot_snapshot', return_value=Mock(total_spots=10, total_handicap_spots=2))
+    def test_count_publisher_sums_cameras(self, fetch_snapshot, save_counts, notify):
+        """
+        This method tests that counts are written once all cameras reported and only on change.
+        """
+        cameras = [make_camera('north', 0, (4, 1), [True, False], [False, True]),
+                   make_camera('south', 1, (3, 0))]
+        publisher = streamyolo.CountPublisher(cameras)
+
+        publisher(cameras[1], np.array([0]))
+        save_counts.assert_not_called()
+
+        cameras[0].cycles = 1
+        publisher(cameras[0], np.array([0]))
+        publisher(cameras[0], np.array([]))
+        publisher(cameras[0], np.array([1]))
+
+        save_counts.assert_called_once_with(3, 1)
+        self.assertEqual(fetch_snapshot.call_count, 3)
+        # Spots changing without changing the counts are still announced
+        self.assertEqual(notify.call_count, 2)
+        self.assertEqual(notify.call_args.args[0], 7)
+        self.assertEqual(notify.call_args.args[1], {
+            'north': [{'id': 0, 'handicap': False, 'occupied': True},
+                      {'id': 1, 'handicap': True, 'occupied': False}],
+            'south': [],
+        })
+
+    @patch('backend.streamyolo.save_free_counts', return_value=None)
+    @patch('backend.streamyolo.fetch_lot_snapshot', return_value=Mock(total_spots=10, total_handicap_spots=2))
+    def test_count_publisher_retries_failed_write(self, _fetch_snapshot, save_counts):
+        """
+        This method tests that counts which could not be written are written again next cycle.
+        """
+        cameras = [make_camera('north', 1, (4, 1))]
+        publisher = streamyolo.CountPublisher(cameras)
+
+        publisher(cameras[0], np.array([0]))
+        publisher(cameras[0], np.array([]))
+
+        self.assertEqual(save_counts.call_count, 2)
+
+    @patch('backend.streamyolo.notify_counts_changed')
+    @patch('backend.streamyolo.save_free_counts', return_value=7)
+    @patch('backend.streamyolo.fetch_lot_snapshot', return_value=Mock(total_spots=10, total_handicap_spots=2))
+    def test_count_publisher_records_history(self, _fetch_snapshot, _save_counts, _notify):
+        """
+        This method tests that count changes and spot state changes are added to the history.
+        """
+        camera = make_camera('north', 1, (4, 1), [True, False], [False, True])
+        history = Mock()
+        publisher = streamyolo.CountPublisher([camera], history)
+
+        publisher(camera, np.array([0, 1]))
+        publisher(camera, np.array([]))
+
+        history.add_counts.assert_called_once_with(7, (6, 1), (10, 2))
+        history.add_spot_events.assert_called_once()
+        self.assertEqual(history.add_spot_events.call_args.args[0], 'north')
+        np.testing.assert_array_equal(history.add_spot_events.call_args.args[1], [0, 1])
+
+    def test_history_writer_batches_rows(self):
+        """
+        This method tests that buffered history rows are written in batches by the background writer.
+        """
+        with patch('backend.streamyolo.save_occupancy_history', return_value=True) as save_history, \
+                patch('backend.streamyolo.save_spot_events', return_value=True) as save_events:
+            writer = streamyolo.HistoryWriter(batch_size=3, flush_interval=60)
+            writer.add_counts(1, (5, 1), (10, 2), recorded_at='t1')
+            writer.add_spot_events('north', [0, 2], [False, False, True], [True, False, False],
+                                   recorded_at='t2')
+            writer.start()
+            for _ in range(100):
+                if not writer.pending():
+                    break
+                time.sleep(0.01)
+            writer.add_counts(2, (4, 1), (10, 2), recorded_at='t3')
+            writer.stop()
+
+        self.assertEqual(save_history.call_args_list[0].args[0], [('t1', 1, 5, 1, 10, 2)])
+        self.assertEqual(save_events.call_args.args[0],
+                         [('t2', 'north', 0, False, True), ('t2', 'north', 2, True, False)])
+        # The rows left below a batch are written when the writer stops
+        self.assertEqual(save_history.call_args_list[1].args[0], [('t3', 2, 4, 1, 10, 2)])
+        self.assertFalse(writer.thread.is_alive())
+
+    def test_history_writer_keeps_failed_rows(self):
+        """
+        This method tests that rows of a failed write are retried in order and the buffer is bounded.
+        """
+        with patch('backend.streamyolo.save_occupancy_history', side_effect=[False, True]) as save_history, \
+                patch('backend.streamyolo.save_spot_events'):
+            writer = streamyolo.HistoryWriter(batch_size=100, max_rows=3)
+            writer.add_counts(1, (5, 1), (10, 2), recorded_at='t1')
+            self.assertFalse(writer.flush())
+            writer.add_counts(2, (4, 1), (10, 2), recorded_at='t2')
+            self.assertTrue(writer.flush())
+            for cycle_id in range(4):
+                writer.add_counts(cycle_id, (4, 1), (10, 2), recorded_at='t3')
+
+        self.assertEqual([row[1] for row in save_history.call_args.args[0]], [1, 2])
+        self.assertEqual(writer.pending(), 3)
+        self.assertEqual(writer.dropped, 1)
+
+    @patch('backend.streamyolo.requests.post')
+    def test_notify_counts_changed(self, mock_post):
+        """
+        This method tests that the server cache is invalidated in the background.
+        """
+        self.assertIsNone(streamyolo.notify_counts_changed(3, url=None))
+
+        streamyolo.notify_counts_changed(3, url='http://server/cache/invalidate').join(timeout=5)
+
+        mock_post.assert_called_once()
+        self.assertEqual(mock_post.call_args.kwargs['json'], {'cycle_id': 3, 'spots': None})
+
+    def test_load_cameras(self):
+        """
+        This method tests reading camera definitions from a JSON file.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cameras.json')
+            with open(path, 'w', encoding='utf-8') as file:
+                file.write('[{"name": "north", "url": "${CAMERA_TEST_URL}/1", '
+                           '"layout": "north.pkl", "interval": 10, "mode": "full"}]')
+            with patch.dict(os.environ, {'CAMERA_TEST_URL': 'rtsp://host'}):
+                cameras = streamyolo.load_cameras(path)
+
+        self.assertEqual(len(cameras), 1)
+        self.assertEqual(cameras[0].name, 'north')
+        self.assertEqual(cameras[0].grabber.source, 'rtsp://host/1')
+        self.assertEqual(cameras[0].layout['path'], 'north.pkl')
+        self.assertEqual((cameras[0].interval, cameras[0].mode), (10, 'full'))
+
+    def test_layout_watcher_swaps_between_cycles(self):
+        """
+        This method tests that a changed layout file is compiled by the watcher
+        and only swapped in by the camera before its next cycle.
+        """
+        def infer(regions, scales_and_offsets):
+            return np.empty((0, 4)), np.empty(0), np.empty(0), np.empty(0, dtype=int)
+
+        frame = np.zeros((100, 100, 3), dtype=np.uint8)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'spots.layout')
+            save_layout(path, [([(0, 0), (40, 0), (40, 40)], False)])
+            camera = streamyolo.Camera('north', 'stream', path, capture=Mock())
+            watcher = streamyolo.LayoutWatcher([camera])
+            camera.process(frame, infer)
+            version = camera.layout['version']
+
+            save_layout(path, [([(0, 0), (40, 0), (40, 40)], False), ([(50, 50), (90, 50), (90, 90)], True)])
+            os.utime(path, ns=(0, 0))
+            streamyolo.count_vehicles(frame, layout=camera.layout, gate=camera.gate, infer=infer)
+            self.assertEqual(len(camera.layout['is_handicap']), 1)
+
+            self.assertEqual(watcher.check(), 1)
+            self.assertEqual(watcher.check(), 0)
+            self.assertEqual(len(camera.layout['is_handicap']), 1)
+            self.assertEqual(camera.pending_layout['labels'].shape, (50, 50))
+
+            camera.process(frame, infer)
+
+        self.assertIsNone(camera.pending_layout)
+        np.testing.assert_array_equal(camera.layout['is_handicap'], [False, True])
+        self.assertEqual(camera.layout['version'], version + 1)
+        self.assertEqual(camera.gate.layout_version, version + 1)
+        self.assertEqual(len(camera.tracker.states), 2)
+
+    def test_camera_process_records_stage_timings(self):
+        """
+        This method tests that processing a frame adds the time spent per stage to a timings dict.
+        """
+        def infer(regions, scales_and_offsets):
+            time.sleep(0.01)
+            return np.empty((0, 4)), np.empty(0), np.empty(0), np.empty(0, dtype=int)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'spots.layout')
+            save_layout(path, [([(0, 0), (40, 0), (40, 40)], False)])
+            camera = streamyolo.Camera('north', 'stream', path, capture=Mock())
+            timings = {'decode': 1.0}
+            camera.process(np.zeros((100, 100, 3), dtype=np.uint8), infer, timings)
+
+        self.assertEqual(set(timings), {'decode', 'roi', 'inference', 'postprocess'})
+        self.assertEqual(timings['decode'], 1.0)
+        self.assertGreaterEqual(timings['inference'], 10)
+
+    def test_camera_run_records_stage_metrics(self):
+        """
+        This method tests that every stage of a cycle run by a camera is recorded in the stage histogram.
+        """
+        def infer(regions, scales_and_offsets):
+            return np.empty((0, 4)), np.empty(0), np.empty(0), np.empty(0, dtype=int)
+
+        stop_event = threading.Event()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'spots.layout')
+            save_layout(path, [([(0, 0), (40, 0), (40, 40)], False)])
+            camera = streamyolo.Camera('gate', 'stream', path, capture=Mock())
+            camera.grabber = Mock()
+            camera.grabber.read.return_value = np.zeros((100, 100, 3), dtype=np.uint8)
+            camera.run(infer, lambda camera, changed_spots: stop_event.set(), stop_event)
+
+        for stage in ('grab', 'roi', 'inference', 'postprocess', 'db'):
+            self.assertEqual(streamyolo.STAGE_SECONDS.count(camera='gate', stage=stage), 1, stage)
+        self.assertEqual(streamyolo.SPOT_INFERENCES.value(camera='gate', outcome='inferred'), 1)
+
+    def test_model_artifact_auto_selection(self):
+        """
+        This method tests that the fastest exported runtime present is picked automatically.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            self.assertEqual(streamyolo.model_artifact('s', 'auto', directory),
+                             os.path.join(directory, 'yolov8s.pt'))
+
+            open(os.path.join(directory, 'yolov8s.torchscript'), 'wb').close()
+            open(os.path.join(directory, 'yolov8s.onnx'), 'wb').close()
+            self.assertEqual(streamyolo.model_artifact('s', 'auto', directory),
+                             os.path.join(directory, 'yolov8s.onnx'))
+
+            self.assertEqual(streamyolo.model_artifact('n', 'openvino', directory),
+                             os.path.join(directory, 'yolov8n_openvino_model'))
+
+    def test_label_map_lookup(self):
+        """
+        This method tests that centroids resolve to spot ids through the label map.
+        """
+        normal = [np.array([[0, 0], [40, 0], [40, 40], [0, 40]])]
+        handicap = [np.array([[20, 20], [80, 20], [80, 80], [20, 80]])]
+
+        labels = streamyolo.build_label_map(normal, handicap, (100, 100), downscale=2)
+        spot_ids = streamyolo.lookup_spots(
+            [[10, 10], [30, 30], [70, 70], [95, 5], [500, 500]], labels, downscale=2)
+
+        self.assertEqual(labels.shape, (50, 50))
+        self.assertEqual(labels.dtype, np.int16)
+        np.testing.assert_array_equal(spot_ids, [0, 0, 1, -1, -1])
+
+    def test_letterbox(self):
+        """
+        This method tests that letterbox keeps the aspect ratio and centres the image.
+        """
+        image = np.full((100, 200, 3), 255, dtype=np.uint8)
+
+        tile, ratio, padding = streamyolo.letterbox(image, size=64)
+
+        self.assertEqual(tile.shape, (64, 64, 3))
+        self.assertAlmostEqual(ratio, 0.32)
+        self.assertEqual(padding, (0, 16))
+        self.assertTrue(np.all(tile[16:48] == 255))
+        self.assertTrue(np.all(tile[:16] == 114))
+
+    def test_letterbox_without_upscale(self):
+        """
+        This method tests that letterbox only pads a small image when upscaling is off.
+        """
+        image = np.full((20, 40, 3), 255, dtype=np.uint8)
+
+        tile, ratio, padding = streamyolo.letterbox(image, size=64, upscale=False)
+
+        self.assertEqual(ratio, 1)
+        self.assertEqual(padding, (12, 22))
+        self.assertTrue(np.all(tile[22:42, 12:52] == 255))
+        self.assertEqual(int((tile == 255).all(axis=2).sum()), 20 * 40)
+
+    def test_run_batched_inference(self):
+        """
+        This method tests that batched inference maps boxes back to frame coordinates.
+        """
+        regions = [np.zeros((100, 200, 3), dtype=np.uint8)] * 3
+        scales_and_offsets = [(2, (10, 20))] * 3
+        # The regions are padded into 320 tiles at (60, 110) without resizing
+        model = Mock(side_effect=lambda tiles, imgsz: [
+            make_result([[60, 110, 260, 210], [60, 110, 260, 210]], [2, 0], [0.9, 0.9])
+            for _ in tiles
+        ])
+
+        boxes, class_ids, _, region_ids = streamyolo.run_batched_inference(
+            model, regions, scales_and_offsets, batch_size=2)
+
+        self.assertEqual(model.call_count, 2)
+        self.assertEqual([len(call.args[0]) for call in model.call_args_list], [2, 1])
+        np.testing.assert_allclose(boxes, [[10, 20, 110, 70]] * 3)
+        np.testing.assert_array_equal(class_ids, [2, 2, 2])
+        np.testing.assert_array_equal(region_ids, [0, 1, 2])
+
+    def test_run_batched_inference_groups_input_sizes(self):
+        """
+        This method tests that regions are batched per input size and keep their region ids.
+        """
+        regions = [np.zeros((size, size, 3), dtype=np.uint8) for size in (160, 640, 100, 300)]
+        model = Mock(side_effect=lambda tiles, imgsz: [
+            make_result([[0, 0, imgsz, imgsz]], [2], [0.9]) for _ in tiles
+        ])
+
+        boxes, _, _, region_ids = streamyolo.run_batched_inference(
+            model, regions, [(1, (0, 0))] * 4, sizes=(160, 320, 640))
+
+        self.assertEqual([(len(call.args[0]), call.kwargs['imgsz']) for call in model.call_args_list],
+                         [(2, 160), (1, 640), (1, 320)])
+        np.testing.assert_array_equal(region_ids, [0, 1, 2, 3])
+        # Smaller regions are padded, not upscaled, so the tile edge lies beyond them by the padding
+        np.testing.assert_allclose(boxes[:, 2], [160, 640, 130, 310])
+
+    def test_compile_spots_input_sizes(self):
+        """
+        This method tests that spots are scaled to the smallest input size that fits them.
+        """
+        def square(size):
+            return np.array([[0, 0], [size - 1, 0], [size - 1, size - 1], [0, size - 1]])
+        spots = streamyolo.compile_spots([square(100), square(500), square(20), square(1000)],
+                                         (1080, 1920), sizes=(160, 320, 640), max_upscale=4)
+
+        np.testing.assert_allclose([spot.scale for spot in spots], [1.6, 1.28, 4, 0.64])
+        self.assertEqual(spots[3].interpolation, cv2.INTER_AREA)
+
 @patch('backend.streamyolo.get_regions_of_interest')
 def test_get_regions_of_interest(self, mock_get_regions):
     """